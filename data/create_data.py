@@ -114,8 +114,13 @@ def create_knn_query(input_path, output_path, query_number_limit, n_list):
 def geohash_and_sort(input_path, output_path, data_precision, region):
     geohash = Geohash.init_by_precision(data_precision=data_precision, region=region)
     data_list = np.load(input_path, allow_pickle=True)
-    data_list = [(data[0], data[1], geohash.encode(data[0], data[1]), data[2], data[3]) for data in data_list]
-    data_list.sort(key=lambda x: x[2])
+    # 兼容add_key_field后的object二维数组和npy_to_table后的table表格
+    if data_list.dtype.names:
+        ghs = geohash.encode_batch(data_list['0'], data_list['1'])
+    else:
+        ghs = geohash.encode_batch(data_list[:, 0].astype(np.float64), data_list[:, 1].astype(np.float64))
+    order = np.argsort(ghs, kind='stable')
+    data_list = [(data[0], data[1], gh, data[2], data[3]) for data, gh in zip(data_list[order], ghs[order].tolist())]
     np.save(output_path, data_list)
 
 
@@ -0,0 +1,100 @@
+from collections import OrderedDict
+
+PAGE_SIZE = 4096
+
+
+class BufferPool:
+    """
+    索引共享的页缓冲池，按实际访问的页统计IO，替代每次查询都假设冷缓存的io_cost公式
+    1. 索引把index entries/hr/cr/block/node的元数据/model映射为(file, page_id)，查询时逐页访问
+    2. 页在缓冲池中记为hit，否则记为miss，读入时缓冲池已满则按policy淘汰一页
+    3. policy: lru=淘汰最久没有访问的页，clock=时钟算法，按引用位近似lru
+    """
+
+    def __init__(self, capacity, policy='lru'):
+        """
+        :param capacity: 缓冲池可容纳的页数量，内存预算=capacity * PAGE_SIZE
+        """
+        assert capacity > 0, "capacity of buffer pool must be positive"
+        assert policy in ('lru', 'clock'), "policy of buffer pool must be lru or clock"
+        self.capacity = capacity
+        self.policy = policy
+        self.hits = 0
+        self.misses = 0
+        # lru: {page: None}，末尾为最近访问
+        self.lru = OrderedDict()
+        # clock: frames[i]为第i个frame中的页，refs[i]为引用位，slots为页到frame的映射，hand为时钟指针
+        self.frames = []
+        self.refs = []
+        self.slots = {}
+        self.hand = 0
+
+    @property
+    def bytes_read(self):
+        return self.misses * PAGE_SIZE
+
+    def stats(self):
+        """
+        :return: hits, misses, bytes_read
+        """
+        return self.hits, self.misses, self.bytes_read
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        """
+        清空缓冲池，不重置统计
+        """
+        self.lru.clear()
+        self.frames = []
+        self.refs = []
+        self.slots = {}
+        self.hand = 0
+
+    def read_items(self, file, start, end, items_per_page):
+        """
+        访问file中第[start, end)项所在的页
+        """
+        if end > start:
+            self.read(file, start // items_per_page, (end - 1) // items_per_page)
+
+    def read(self, file, first_page, last_page):
+        """
+        访问file中第[first_page, last_page]页
+        """
+        for page_id in range(first_page, last_page + 1):
+            self.read_page((file, page_id))
+
+    def read_page(self, page):
+        if self.policy == 'lru':
+            if page in self.lru:
+                self.lru.move_to_end(page)
+                self.hits += 1
+                return
+            self.misses += 1
+            if len(self.lru) >= self.capacity:
+                self.lru.popitem(last=False)
+            self.lru[page] = None
+        else:
+            slot = self.slots.get(page)
+            if slot is not None:
+                self.refs[slot] = True
+                self.hits += 1
+                return
+            self.misses += 1
+            if len(self.frames) < self.capacity:
+                self.slots[page] = len(self.frames)
+                self.frames.append(page)
+                self.refs.append(True)
+                return
+            # 跳过并清除引用位为True的frame，淘汰第一个引用位为False的frame
+            while self.refs[self.hand]:
+                self.refs[self.hand] = False
+                self.hand = (self.hand + 1) % self.capacity
+            del self.slots[self.frames[self.hand]]
+            self.frames[self.hand] = page
+            self.refs[self.hand] = True
+            self.slots[page] = self.hand
+            self.hand = (self.hand + 1) % self.capacity
@@ -5,6 +5,7 @@ from enum import Enum
 
 import numpy as np
 
+from src.buffer_pool import BufferPool
 from src.utils.common_utils import Region
 
 
@@ -177,6 +178,22 @@ def test_query(index, data_distribution, type):
     return sum_search_time / 5, sum_io_cost / 5
 
 
+def test_query_buffer_pool(index, data_distribution, type, capacity, policy='lru'):
+    """
+    在容量为capacity页的缓冲池下执行一遍查询，缓冲池从空开始
+    :return: 每个查询平均的hits, misses, bytes_read
+    """
+    index_test_querys = [index.test_point_query, index.test_range_query, index.test_knn_query]
+    query_list = load_query(data_distribution, type).tolist()
+    buffer_pool = BufferPool(capacity, policy)
+    old_buffer_pool, index.buffer_pool = index.buffer_pool, buffer_pool
+    try:
+        index_test_querys[type](query_list)
+    finally:
+        index.buffer_pool = old_buffer_pool
+    return [stat / len(query_list) for stat in buffer_pool.stats()]
+
+
 def filter_data_by_date(data, end_time):
     i = 0
     while data[i][2] <= end_time:
@@ -0,0 +1,158 @@
+import logging
+import math
+import os
+import time
+
+import numpy as np
+
+from src.experiment.common_utils import Distribution, load_data, load_query, data_precision, data_region
+from src.proposed_sli.slbrin import SLBRIN
+from src.sli.zm_index import ZMIndex
+from src.utils.geohash_utils import curves
+
+"""
+实验探究：对比Geohash(z-order)和Hilbert曲线的局部性
+1. 曲线：range query按[最小编码, 最大编码]扫描的长度，以及window分解为编码范围后扫描的长度和范围的数量
+2. 曲线：knn query从查询点的编码位置出发，在编码顺序上需要连续扫描多少个索引项才能包含k个最近邻
+3. 索引：分别用两种曲线构建SLBRIN和ZMIndex，对比range/knn query的时间和io cost
+"""
+
+
+def test_curve_range_query(geohash, ghs, xs, ys, range_query_list):
+    """
+    :param ghs/xs/ys: 按编码排序的数据
+    :return: 每个查询平均的结果数、[最小编码, 最大编码]的扫描长度、分解后的扫描长度和编码范围的数量
+    """
+    result_len = scan_len = ranges_scan_len = ranges_num = 0
+    for window in range_query_list:
+        result_len += np.count_nonzero((window[0] <= ys) & (ys <= window[1]) & (window[2] <= xs) & (xs <= window[3]))
+        gh1, gh2 = geohash.encode_window(window)
+        scan_len += np.searchsorted(ghs, gh2, side='right') - np.searchsorted(ghs, gh1)
+        # window分解到边长约为window边长1/4的节点，每个window的编码范围数量有上界
+        window_bits = int(math.log2(max((window[3] - window[2]) / geohash.region_width,
+                                        (window[1] - window[0]) / geohash.region_height) * geohash.max_num))
+        ranges = np.array(geohash.ranges_by_window(window, 2 * (geohash.dim_bits - max(window_bits - 2, 0))))
+        ranges_scan_len += (np.searchsorted(ghs, ranges[:, 1], side='right') - np.searchsorted(ghs, ranges[:, 0])).sum()
+        ranges_num += len(ranges)
+    query_len = len(range_query_list)
+    return result_len / query_len, scan_len / query_len, ranges_scan_len / query_len, ranges_num / query_len
+
+
+def test_curve_knn_query(geohash, ghs, xs, ys, knn_query_list):
+    """
+    :param ghs/xs/ys: 按编码排序的数据
+    :return: 每个查询平均需要扫描的索引项数量，即包含查询点的编码位置和k个最近邻的最短连续范围
+    """
+    candidate_len = 0
+    for x, y, k in knn_query_list:
+        positions = np.argpartition((xs - x) ** 2 + (ys - y) ** 2, int(k) - 1)[:int(k)]
+        position = np.searchsorted(ghs, geohash.encode(x, y))
+        candidate_len += max(positions.max(), position) - min(positions.min(), position) + 1
+    return candidate_len / len(knn_query_list)
+
+
+if __name__ == '__main__':
+    os.chdir(os.path.dirname(os.path.realpath(__file__)))
+    parent_path = "model/compare_curve/"
+    if not os.path.exists(parent_path):
+        os.makedirs(parent_path)
+    logging.basicConfig(filename=os.path.join(parent_path, "log.file"),
+                        level=logging.INFO,
+                        format="%(message)s")
+    data_distributions = [Distribution.UNIFORM_10W, Distribution.NORMAL_10W, Distribution.NYCT_10W]
+    for data_distribution in data_distributions:
+        build_data_list = load_data(data_distribution, 0)
+        range_query_list = load_query(data_distribution, 1).tolist()
+        knn_query_list = load_query(data_distribution, 2).tolist()
+        for curve in curves:
+            logging.info("*************start %s %s************" % (data_distribution.name, curve))
+            # 1. 曲线的局部性
+            geohash = curves[curve].init_by_precision(data_precision=data_precision[data_distribution],
+                                                      region=data_region[data_distribution])
+            ghs = geohash.encode_batch(build_data_list['0'], build_data_list['1'])
+            order = np.argsort(ghs, kind='stable')
+            ghs, xs, ys = ghs[order], build_data_list['0'][order], build_data_list['1'][order]
+            for i in range(len(range_query_list) // 1000):
+                tmp_range_query_list = range_query_list[i * 1000:(i + 1) * 1000]
+                result_len, scan_len, ranges_scan_len, ranges_num = test_curve_range_query(geohash, ghs, xs, ys,
+                                                                                           tmp_range_query_list)
+                logging.info("Range query result len: %s" % result_len)
+                logging.info("Range query scan len: %s" % scan_len)
+                logging.info("Range query ranges scan len: %s" % ranges_scan_len)
+                logging.info("Range query ranges num: %s" % ranges_num)
+            for i in range(len(knn_query_list) // 1000):
+                tmp_knn_query_list = knn_query_list[i * 1000:(i + 1) * 1000]
+                candidate_len = test_curve_knn_query(geohash, ghs, xs, ys, tmp_knn_query_list)
+                logging.info("KNN query candidate len: %s" % candidate_len)
+            # 2. 索引的检索性能，叶模型使用误差有界的样条，避免模型训练的随机性影响对比
+            for index_class in [SLBRIN, ZMIndex]:
+                model_path = parent_path + "%s/%s_%s" % (index_class.__name__.lower(), data_distribution.name, curve)
+                if not os.path.exists(model_path):
+                    os.makedirs(model_path)
+                logging.info("*************start %s************" % model_path)
+                index = index_class(model_path=model_path)
+                start_time = time.time()
+                if index_class is SLBRIN:
+                    index.build(data_list=build_data_list,
+                                is_sorted=False,
+                                threshold_number=1000,
+                                data_precision=data_precision[data_distribution],
+                                region=data_region[data_distribution],
+                                threshold_err=1,
+                                threshold_summary=1000,
+                                threshold_merge=5,
+                                is_new=True,
+                                is_simple=False,
+                                weight=1,
+                                core=[1, 128],
+                                train_step=5000,
+                                batch_num=64,
+                                learning_rate=0.1,
+                                use_threshold=False,
+                                threshold=0,
+                                retrain_time_limit=0,
+                                thread_pool_size=12,
+                                leaf_model='spline',
+                                curve=curve)
+                else:
+                    index.build(data_list=build_data_list,
+                                is_sorted=False,
+                                data_precision=data_precision[data_distribution],
+                                region=data_region[data_distribution],
+                                is_new=True,
+                                is_simple=False,
+                                weight=1,
+                                stages=[1, 100],
+                                cores=[[1, 128], [1, 128]],
+                                train_steps=[5000, 5000],
+                                batch_nums=[64, 64],
+                                learning_rates=[0.1, 0.1],
+                                use_thresholds=[False, True],
+                                thresholds=[0, 0],
+                                retrain_time_limits=[5, 2],
+                                thread_pool_size=8,
+                                leaf_model='spline',
+                                curve=curve)
+                index.save()
+                end_time = time.time()
+                build_time = end_time - start_time
+                logging.info("Build time: %s" % build_time)
+                io_cost = index.io_cost
+                for i in range(len(range_query_list) // 1000):
+                    tmp_range_query_list = range_query_list[i * 1000:(i + 1) * 1000]
+                    start_time = time.time()
+                    index.test_range_query(tmp_range_query_list)
+                    end_time = time.time()
+                    search_time = (end_time - start_time) / len(tmp_range_query_list)
+                    logging.info("Range query time: %s" % search_time)
+                    logging.info("Range query io cost: %s" % ((index.io_cost - io_cost) / len(tmp_range_query_list)))
+                    io_cost = index.io_cost
+                for i in range(len(knn_query_list) // 1000):
+                    tmp_knn_query_list = knn_query_list[i * 1000:(i + 1) * 1000]
+                    start_time = time.time()
+                    index.test_knn_query(tmp_knn_query_list)
+                    end_time = time.time()
+                    search_time = (end_time - start_time) / len(tmp_knn_query_list)
+                    logging.info("KNN query time: %s" % search_time)
+                    logging.info("KNN query io cost: %s" % ((index.io_cost - io_cost) / len(tmp_knn_query_list)))
+                    io_cost = index.io_cost
@@ -0,0 +1,363 @@
+import heapq
+import logging
+import math
+import multiprocessing
+import os
+import time
+import traceback
+
+import numpy as np
+
+from src.experiment.common_utils import load_data, Distribution, load_query
+from src.proposed_sli.slbrin import SLBRIN, Meta, HistoryRange, CurrentRange, IE_DTYPE
+from src.spatial_index import SpatialIndex
+from src.utils.common_utils import Region
+from src.utils.geohash_utils import curves
+
+
+class ShardedSLBRIN(SpatialIndex):
+    """
+    按geohash把SLBRIN的hr目录分成shard_num段连续的key范围，每段由一个worker进程中的子SLBRIN负责
+    1. 子SLBRIN保留完整的hr目录，不负责的hr为空，因此hr目录始终覆盖整个key空间，查询算法和SLBRIN一致
+    2. 点查询/插入/删除按geohash路由到唯一的shard，hr只会在所在shard中分裂，shard的key范围不变
+    3. 范围查询只发送到key范围和window的[gh1, gh2]相交、并且有hr的scope和window相交的shard，结果按shard拼接
+    4. knn先在查询点所在的shard得到k个结果，以第k近的距离为上界发送到hr的scope在上界内的其他shard，合并后取前k个
+    查询按shard批量发送，各shard并行执行，查询结果的集合和单个SLBRIN一致
+    """
+
+    def __init__(self, model_path=None):
+        super(ShardedSLBRIN, self).__init__("ShardedSLBRIN")
+        self.model_path = model_path
+        logging.basicConfig(filename=os.path.join(self.model_path, "log.file"),
+                            level=logging.INFO,
+                            format="%(asctime)s - %(levelname)s - %(message)s",
+                            datefmt="%Y/%m/%d %H:%M:%S %p")
+        self.logging = logging.getLogger(self.name)
+        self.geohash = None
+        # shard i负责geohash在[bounds[i], bounds[i + 1])的索引项，长度为shard数量+1
+        self.bounds = None
+        # 每个shard负责的hr的scope表，shape为(hr数量, 4)，子hr的scope合起来等于父hr，因此分裂后不需要更新
+        self.shard_scopes = None
+        self.workers = []
+        self.conns = []
+
+    def build(self, index, shard_num):
+        """
+        把已经build的SLBRIN按索引项数量均分为shard_num段连续的hr，每个shard保存到model_path/shard_i
+        cr和tail中的索引项按geohash插入所在shard的cr
+        """
+        assert shard_num <= index.meta.last_hr + 1, "shard_num exceed the number of hr"
+        for hr_key in range(index.meta.last_hr + 1):
+            index.compact_hr(hr_key)
+        hr_num = index.meta.last_hr + 1
+        # 1. cut hrs by the cumulative number of index entries
+        numbers = np.cumsum([hr.number for hr in index.history_ranges])
+        cuts = [0]
+        for i in range(1, shard_num):
+            cut = int(np.searchsorted(numbers, numbers[-1] * i / shard_num, side='left')) + 1
+            cuts.append(min(max(cut, cuts[-1] + 1), hr_num - shard_num + i))
+        cuts.append(hr_num)
+        bounds = [index.history_ranges[cut].value for cut in cuts[:-1]] + [1 << index.meta.geohash.sum_bits]
+        # 2. route entries in crs and tail
+        cr_ies = [ie for ies in index.index_entries[index.meta.last_hr + 1:] for ie in ies] + index.tail_entries()
+        cr_shards = np.searchsorted(bounds, [ie[2] for ie in cr_ies], side='right') - 1
+        # 3. create and save sub SLBRIN
+        for i in range(shard_num):
+            shard_path = os.path.join(self.model_path, 'shard_%d' % i)
+            os.makedirs(shard_path, exist_ok=True)
+            shard = SLBRIN(model_path=shard_path)
+            shard.meta = Meta(index.meta.last_hr, 0, index.meta.threshold_number, index.meta.threshold_length,
+                              index.meta.threshold_err, index.meta.threshold_summary, index.meta.threshold_merge,
+                              index.meta.geohash)
+            shard.weight = index.weight
+            shard.cores = index.cores
+            shard.train_step = index.train_step
+            shard.batch_num = index.batch_num
+            shard.learning_rate = index.learning_rate
+            shard.history_ranges = []
+            shard.index_entries = []
+            for hr_key in range(hr_num):
+                hr = index.history_ranges[hr_key]
+                if cuts[i] <= hr_key < cuts[i + 1]:
+                    shard.history_ranges.append(hr)
+                    shard.index_entries.append(index.index_entries[hr_key])
+                else:
+                    shard.history_ranges.append(HistoryRange(hr.value, hr.length, 0, hr.model, 0, hr.scope,
+                                                             hr.value_diff))
+                    shard.index_entries.append(np.empty(0, dtype=IE_DTYPE))
+            shard.current_ranges = [CurrentRange(value=None, number=0, state=0)]
+            shard.index_entries.append([])
+            shard.update_cr_mbrs()
+            for j in np.flatnonzero(cr_shards == i).tolist():
+                shard.insert_cr(cr_ies[j])
+            shard.save()
+        np.save(os.path.join(self.model_path, 'sharded_slbrin_bounds.npy'), np.array(bounds, dtype=np.int64))
+        self.load()
+
+    def load(self):
+        """
+        启动每个shard的worker进程，worker从model_path/shard_i加载子SLBRIN
+        """
+        self.close()
+        self.bounds = np.load(os.path.join(self.model_path, 'sharded_slbrin_bounds.npy'))
+        for i in range(len(self.bounds) - 1):
+            conn, worker_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=shard_worker,
+                                             args=(os.path.join(self.model_path, 'shard_%d' % i), worker_conn),
+                                             daemon=True)
+            worker.start()
+            self.workers.append(worker)
+            self.conns.append(conn)
+        infos = self.scatter({i: (shard_info, (self.bounds[i], self.bounds[i + 1])) for i in range(len(self.conns))})
+        data_precision, region, curve = infos[0][0], infos[0][1], infos[0][3]
+        self.geohash = curves[curve].init_by_precision(data_precision=data_precision, region=Region(*region))
+        self.shard_scopes = [infos[i][2] for i in range(len(self.conns))]
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        self.conns = []
+
+    def scatter(self, tasks):
+        """
+        tasks: {shard: (func, args)}，worker中执行func(子SLBRIN, *args)，所有shard并行
+        return: {shard: func的返回值}
+        """
+        for shard, task in tasks.items():
+            self.conns[shard].send(task)
+        results = {}
+        errors = []
+        for shard in tasks:
+            result, error = self.conns[shard].recv()
+            if error:
+                errors.append("shard %s failed in worker:\n%s" % (shard, error))
+            results[shard] = result
+        if errors:
+            raise RuntimeError("\n".join(errors))
+        return results
+
+    def broadcast(self, func, *args):
+        return self.scatter({i: (func, args) for i in range(len(self.conns))})
+
+    def shard_of(self, ghs):
+        return np.searchsorted(self.bounds, ghs, side='right') - 1
+
+    def route(self, ghs):
+        """
+        按geohash把下标分到shard
+        :return: {shard: 下标数组}
+        """
+        shards = self.shard_of(ghs)
+        return {shard: np.flatnonzero(shards == shard) for shard in np.unique(shards).tolist()}
+
+    def insert_single(self, point):
+        self.insert(np.array([point]))
+
+    def insert(self, points):
+        """
+        points和SLBRIN.insert一致，按geohash分到shard后各shard并行insert
+        """
+        points = np.asarray(points)
+        # 和SLBRIN.insert_batch一致，支持结构化数组和二维数组
+        if points.dtype.names:
+            ghs = self.geohash.encode_batch(points[points.dtype.names[0]], points[points.dtype.names[1]])
+        else:
+            ghs = self.geohash.encode_batch(points[:, 0], points[:, 1])
+        self.scatter({shard: (SLBRIN.insert, (points[ids],)) for shard, ids in self.route(ghs).items()})
+
+    def delete(self, point):
+        shard = self.shard_of(self.geohash.encode(point[0], point[1])).item()
+        return self.scatter({shard: (SLBRIN.delete, (point,))})[shard]
+
+    def merge_outdated_cr(self):
+        """
+        各shard合并所有outdated的cr
+        """
+        self.broadcast(merge_outdated_cr)
+
+    def point_query_single(self, point):
+        return self.point_query([point])[0]
+
+    def point_query(self, points):
+        points = np.asarray(points)
+        results = [None] * len(points)
+        routes = self.route(self.geohash.encode_batch(points[:, 0], points[:, 1]))
+        shard_results = self.scatter({shard: (SLBRIN.point_query, (points[ids].tolist(),))
+                                      for shard, ids in routes.items()})
+        for shard, ids in routes.items():
+            for i, result in zip(ids.tolist(), shard_results[shard]):
+                results[i] = result
+        return results
+
+    def range_query_single(self, window):
+        return self.range_query([window])[0]
+
+    def range_query(self, windows):
+        windows = np.asarray(windows)
+        # 1. shards whose key range intersects [gh1, gh2]
+        if self.geohash.monotone:
+            shard1 = self.shard_of(self.geohash.encode_batch(windows[:, 2], windows[:, 0]))
+            shard2 = self.shard_of(self.geohash.encode_batch(windows[:, 3], windows[:, 1]))
+        else:
+            shard1, shard2 = self.shard_of(np.array([self.geohash.encode_window(window) for window in windows]).T)
+        # 2. shards with hr scopes intersecting the window
+        routes = {}
+        for i in range(len(windows)):
+            window = windows[i]
+            for shard in range(shard1[i], shard2[i] + 1):
+                scopes = self.shard_scopes[shard]
+                if np.any((scopes[:, 0] <= window[1]) & (window[0] <= scopes[:, 1]) &
+                          (scopes[:, 2] <= window[3]) & (window[2] <= scopes[:, 3])):
+                    routes.setdefault(shard, []).append(i)
+        shard_results = self.scatter({shard: (SLBRIN.range_query, (windows[ids].tolist(),))
+                                      for shard, ids in routes.items()})
+        results = [[] for i in range(len(windows))]
+        for shard in sorted(routes):
+            for i, result in zip(routes[shard], shard_results[shard]):
+                results[i].extend(result)
+        return results
+
+    def knn_query_single(self, knn):
+        return self.knn_query([knn])[0]
+
+    def knn_query(self, knns):
+        """
+        1. 查询点所在的shard得到初始的k个结果
+        2. 第k近的距离作为全局上界，只发送到hr的scope和查询点最小距离不超过上界的其他shard
+        3. 合并各shard的(dst, key)，取前k个
+        """
+        knns = np.asarray(knns)
+        ks = knns[:, 2].astype(int).tolist()
+        # 1. query in the shard of point
+        routes = self.route(self.geohash.encode_batch(knns[:, 0], knns[:, 1]))
+        shard_results = self.scatter({shard: (knn_query_dsts, (knns[ids].tolist(), [math.inf] * len(ids)))
+                                      for shard, ids in routes.items()})
+        results = [None] * len(knns)
+        point_shards = [None] * len(knns)
+        for shard, ids in routes.items():
+            for i, result in zip(ids.tolist(), shard_results[shard]):
+                results[i] = result
+                point_shards[i] = shard
+        # 2. query in other shards with the kth distance as bound
+        routes = {}
+        for i in range(len(knns)):
+            x, y = knns[i][0], knns[i][1]
+            dst_bound = results[i][-1][0] if len(results[i]) == ks[i] else math.inf
+            for shard in range(len(self.conns)):
+                if shard == point_shards[i]:
+                    continue
+                scopes = self.shard_scopes[shard]
+                dxs = np.maximum(np.maximum(scopes[:, 2] - x, x - scopes[:, 3]), 0)
+                dys = np.maximum(np.maximum(scopes[:, 0] - y, y - scopes[:, 1]), 0)
+                if np.min(dxs ** 2 + dys ** 2) <= dst_bound:
+                    routes.setdefault(shard, ([], []))
+                    routes[shard][0].append(i)
+                    routes[shard][1].append(dst_bound)
+        shard_results = self.scatter({shard: (knn_query_dsts, (knns[ids].tolist(), dst_bounds))
+                                      for shard, (ids, dst_bounds) in routes.items()})
+        # 3. merge
+        for shard, (ids, dst_bounds) in routes.items():
+            for i, result in zip(ids, shard_results[shard]):
+                results[i] = list(heapq.merge(results[i], result))[:ks[i]]
+        return [[key for dst, key in result] for result in results]
+
+    def save(self):
+        self.broadcast(SLBRIN.save)
+
+    def size(self):
+        """
+        各shard的structure_size和ie_size之和
+        """
+        sizes = self.broadcast(SLBRIN.size)
+        return sum(size[0] for size in sizes.values()), sum(size[1] for size in sizes.values())
+
+
+def shard_worker(model_path, conn):
+    index = SLBRIN(model_path=model_path)
+    index.load()
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        func, args = task
+        try:
+            conn.send((func(index, *args), None))
+        except Exception:
+            conn.send((None, traceback.format_exc()))
+
+
+def shard_info(index, left, right):
+    """
+    return: geohash的data_precision/region，以及geohash在[left, right)的hr的scope表和曲线的name
+    """
+    region = index.meta.geohash.region
+    scopes = index.get_hr_scopes()
+    values = np.array([hr.value for hr in index.history_ranges], dtype=np.int64)
+    return index.meta.geohash.data_precision, (region.bottom, region.up, region.left, region.right), \
+        scopes[(left <= values) & (values < right)], index.meta.geohash.name
+
+
+def knn_query_dsts(index, knns, dst_bounds):
+    return [index.knn_query_dsts(knn, dst_bound) for knn, dst_bound in zip(knns, dst_bounds)]
+
+
+def merge_outdated_cr(index):
+    while index.current_ranges[0].state == 2:
+        index.post_merge_outdated_cr()
+        index.get_merge_outdated_cr()
+
+
+def main():
+    os.chdir(os.path.dirname(os.path.realpath(__file__)))
+    model_path = "model/sharded_slbrin_10w/"
+    data_distribution = Distribution.NYCT_10W_SORTED
+    if os.path.exists(model_path) is False:
+        os.makedirs(model_path)
+    index = ShardedSLBRIN(model_path=model_path)
+    load_index_from_file = True
+    if load_index_from_file:
+        index.load()
+    else:
+        # 先用slbrin.py的main构建并保存model/slbrin_10w/
+        slbrin = SLBRIN(model_path="model/slbrin_10w/")
+        slbrin.load()
+        index.build(slbrin, shard_num=4)
+    structure_size, ie_size = index.size()
+    logging.info("Structure size: %s" % structure_size)
+    logging.info("Index entry size: %s" % ie_size)
+    point_query_list = load_query(data_distribution, 0).tolist()
+    start_time = time.time()
+    results = index.point_query(point_query_list)
+    end_time = time.time()
+    search_time = (end_time - start_time) / len(point_query_list)
+    logging.info("Point query time: %s" % search_time)
+    np.savetxt(model_path + 'point_query_result.csv', np.array(results, dtype=object), delimiter=',', fmt='%s')
+    range_query_list = load_query(data_distribution, 1).tolist()
+    start_time = time.time()
+    results = index.range_query(range_query_list)
+    end_time = time.time()
+    search_time = (end_time - start_time) / len(range_query_list)
+    logging.info("Range query time: %s" % search_time)
+    np.savetxt(model_path + 'range_query_result.csv', np.array(results, dtype=object), delimiter=',', fmt='%s')
+    knn_query_list = load_query(data_distribution, 2).tolist()
+    start_time = time.time()
+    results = index.knn_query(knn_query_list)
+    end_time = time.time()
+    search_time = (end_time - start_time) / len(knn_query_list)
+    logging.info("KNN query time: %s" % search_time)
+    np.savetxt(model_path + 'knn_query_result.csv', np.array(results, dtype=object), delimiter=',', fmt='%s')
+    update_data_list = load_data(Distribution.NYCT_10W, 1)
+    start_time = time.time()
+    index.insert(update_data_list)
+    index.merge_outdated_cr()
+    end_time = time.time()
+    logging.info("Update time: %s" % (end_time - start_time))
+    index.save()
+    index.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,12 @@
+import bisect
+import copy
+import functools
 import gc
+import heapq
 import logging
 import math
-import multiprocessing
 import os
+import threading
 import time
 
 import numpy as np
@@ -11,16 +15,41 @@ from src.experiment.common_utils import load_data, Distribution, data_precision,
 from src.mlp import MLP
 from src.mlp_simple import MLPSimple
 from src.spatial_index import SpatialIndex
-from src.utils.common_utils import Region, binary_search_less_max, relu, biased_search_almost, \
-    biased_search_duplicate, get_mbr_by_points, merge_sorted_list, intersect, binary_search_duplicate
-from src.utils.geohash_utils import Geohash
+from src.buffer_pool import PAGE_SIZE
+from src.query_cache import QueryCache
+from src.train_pool import get_train_pool
+from src.utils.common_utils import Region, relu, get_mbr_by_points, intersect, \
+    searchsorted_duplicate, searchsorted_almost, merge_sorted_array, PiecewiseLinearNN, \
+    ErrorBoundedSpline, pack_bits, unpack_bits
+from src.utils.geohash_utils import Geohash, curves
 
-PAGE_SIZE = 4096
 HR_SIZE = 8 + 1 + 2 + 4 + 1  # 16
 CR_SIZE = 8 * 4 + 2 + 1  # 35
 MODEL_SIZE = 2000
 ITEM_SIZE = 8 * 3 + 4  # 28
 ITEMS_PER_PAGE = int(PAGE_SIZE / ITEM_SIZE)
+HRS_PER_PAGE = int(PAGE_SIZE / HR_SIZE)
+CRS_PER_PAGE = int(PAGE_SIZE / CR_SIZE)
+IE_DTYPE = [("0", 'f8'), ("1", 'f8'), ("2", 'i8'), ("3", 'i4'), ("4", 'i4')]  # x, y, geohash, t, key
+WAL_DTYPE = IE_DTYPE + [("5", 'i1')]  # index entry + op: 1=insert, 0=delete
+# hr压缩页的参数：x/y/t/key的最小值和位宽，is_packed=0时按IE_DTYPE原样存储，items_per_page为每页的索引项数量
+CODEC_DTYPE = [("x_min", 'i8'), ("y_min", 'i8'), ("t_min", 'i8'), ("key_min", 'i8'), ("x_bits", 'i1'),
+               ("y_bits", 'i1'), ("t_bits", 'i1'), ("key_bits", 'i1'), ("is_packed", 'i1'), ("items_per_page", 'i4')]
+
+
+def with_snapshot(func):
+    """
+    后台维护线程运行时，查询持有SLBRIN.lock，看到的hr/cr/index entries是一致的快照
+    """
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if self.maintenance_thread is None:
+            return func(self, *args, **kwargs)
+        with self.lock:
+            return func(self, *args, **kwargs)
+
+    return wrapper
 
 
 class SLBRIN(SpatialIndex):
@@ -33,6 +62,8 @@ class SLBRIN(SpatialIndex):
 
     def __init__(self, model_path=None):
         super(SLBRIN, self).__init__("SLBRIN")
+        # index entries: hr部分是IE_DTYPE的结构化数组，build/load后为同一连续数组按hr的offset/number切出的视图
+        # cr部分是(x, y, geohash, t, key)的list，便于追加
         self.index_entries = None
         self.model_path = model_path
         logging.basicConfig(filename=os.path.join(self.model_path, "log.file"),
@@ -60,11 +91,35 @@ class SLBRIN(SpatialIndex):
         # scope: 优化计算所需
         # value_diff: 优化计算所需：下一个hr value - hr value
         self.history_ranges = None
+        # hr的scope表[bottom, up, left, right]，shape为(hr数量, 4)，用于knn计算点到所有hr的距离
+        # hr变化时（build/load/split_hr）置为None，使用时重建
+        self.hr_scopes = None
+        # hr的value表(int64数组和list)和value前radix_bits位的radix表，用于找到geohash所在的hr
+        # hr变化时（build/load/split_hr）置为None，使用时重建
+        self.hr_directory = None
         # current range pages由多个cr分页组成
         # value: 改动：mbr
         # number: 新增：range范围内索引项的数据量
         # state: 新增：状态，1=full, 2=outdated
         self.current_ranges = None
+        # cr的MBR表，和current_ranges一一对应，shape为(cr数量, 4)，用于查询时一次性过滤cr
+        # 还没统计MBR的cr(最后一个cr)为nan，查询时作为特殊情况逐个索引项判断
+        self.cr_mbrs = None
+        # cr的t的zone map，shape为(cr数量, 2)，每行为[min t, max t]，用于时空查询时按时间过滤cr
+        # 还没统计MBR的cr为nan；cr_mbrs重建时置为None，使用时重建
+        self.cr_ts = None
+        # 每个range(hr在前，cr在后)的第一个索引项在slbrin_data.npy中的偏移，用于把索引项映射到buffer_pool的页
+        # range的number变化时（合并/分裂/压缩/新增cr/删除cr中的索引项）置为None，使用时重建
+        self.ie_offsets = None
+        # 已合并到hr的cr数量，cr_offset + cr_key为cr的绝对编号，合并后不变，用于query_cache按cr记录增量结果
+        self.cr_offset = 0
+        # hr的index entries是否按压缩页存储：坐标量化为hr内的偏移、geohash由坐标计算不存储、t/key为hr内的偏移，按位宽打包
+        # 开启后save写slbrin_hr_pages.npy，size和io_cost按压缩页统计；内存中的hr仍为IE_DTYPE的结构化数组
+        self.compression = False
+        # 可选的查询结果缓存，enable_query_cache后点查询按geohash、范围查询按取整到data_precision的window缓存结果
+        # 条目为[hr_deps, cr_results]，hr_deps: [(hr, hr.version, hr部分的结果)]，全部hr的version不变时直接复用
+        # cr_results: {cr的绝对编号: [cr.version, 已扫描的索引项数量, cr部分的结果]}，只扫描之后追加的索引项
+        self.query_cache = None
         # for train
         self.weight = None
         self.cores = None
@@ -76,15 +131,41 @@ class SLBRIN(SpatialIndex):
         self.merge_outdated_cr_time = 0.0
         self.retrain_inefficient_model_time = 0.0
         self.retrain_inefficient_model_num = 0
+        # for delete: hr中存活索引项的比例低于该值时压缩hr并重新计算模型误差
+        self.threshold_live = 0.5
         # for compute
         self.io_cost = 0
+        # for maintenance: 后台维护线程启动后，insert_single只追加到tail，
+        # 由后台线程按ts_summary整块写入cr，并统计MBR、合并outdated cr和重训练低效模型
+        # lock保护hr/cr/index entries/meta，查询持有lock以看到一致的快照；tail_lock只保护tail
+        self.tail = []
+        self.tail_lock = threading.Lock()
+        self.lock = threading.RLock()
+        self.maintenance_thread = None
+        self.maintenance_event = threading.Event()
+        self.maintenance_stop = False
+        self.maintenance_error = None
+        # 后台维护在副本上合并和重训练期间，记录原索引中删除的索引项和被压缩的hr，替换hr目录前在副本上重做删除
+        self.shadow_deletes = None
+        self.shadow_compacted = None
+        # 只在副本上不为None，shadow_hrs: 取副本时的hr，shadow_replaced: 副本中被复制或分裂的原hr
+        self.shadow_hrs = None
+        self.shadow_replaced = None
+        # for persistence: open_wal后insert/delete先记录到wal_buffer，满ts_summary条时整体写入wal并fsync(group commit)
+        # checkpoint只重写segment为None（新建/合并/分裂/重训练/压缩过）的hr，recover从checkpoint加上wal恢复
+        self.wal_file = None
+        self.wal_id = 0
+        self.wal_buffer = []
+        self.next_segment = 0
 
     def build(self, data_list, is_sorted, threshold_number, data_precision, region, threshold_err,
               threshold_summary, threshold_merge,
               is_new, is_simple, weight, core, train_step, batch_num, learning_rate, use_threshold, threshold,
-              retrain_time_limit, thread_pool_size):
+              retrain_time_limit, thread_pool_size, leaf_model='nn', spline_err=32, curve='Geohash'):
         """
         构建SLBRIN
+        leaf_model: hr的模型类型，nn=AbstractNN，spline=误差有界的分段线性样条AbstractSpline，spline_err为样条的key误差上限
+        curve: 空间填充曲线的name，Geohash=z-order，Hilbert=Hilbert曲线，见geohash_utils.curves
         1. order data by geohash
         2. build SLBRIN
         2.1. init hr
@@ -99,13 +180,21 @@ class SLBRIN(SpatialIndex):
         self.batch_num = batch_num
         self.learning_rate = learning_rate
         # 1. order data by geohash
-        geohash = Geohash.init_by_precision(data_precision=data_precision, region=region)
+        geohash = curves[curve].init_by_precision(data_precision=data_precision, region=region)
         if is_sorted:
-            data_list = data_list.tolist()
+            data_list = np.asarray(data_list, dtype=IE_DTYPE)
         else:
-            data_list = [(data_list[i][0], data_list[i][1], geohash.encode(data_list[i][0], data_list[i][1]), i)
-                         for i in range(len(data_list))]
-            data_list.sort(key=lambda x: x[2])
+            # 优化: 逐点encode->encode_batch，sort->argsort
+            ghs = geohash.encode_batch(data_list['0'], data_list['1'])
+            order = np.argsort(ghs, kind='stable')
+            sorted_data_list = np.empty(len(data_list), dtype=IE_DTYPE)
+            sorted_data_list['0'] = data_list['0'][order]
+            sorted_data_list['1'] = data_list['1'][order]
+            sorted_data_list['2'] = ghs[order]
+            sorted_data_list['3'] = data_list['2'][order]
+            sorted_data_list['4'] = data_list['3'][order]
+            data_list = sorted_data_list
+        geohashes = data_list['2']
         # 2. build SLBRIN
         # 2.1. init hr
         n = len(data_list)
@@ -117,6 +206,7 @@ class SLBRIN(SpatialIndex):
             cur = range_stack.pop(-1)
             if cur[2] > threshold_number and cur[1] < threshold_length:
                 child_regions = cur[4].split()
+                child_quadrants = geohash.child_quadrants(cur[0], cur[1])
                 l_key = cur[3]
                 r_key = cur[3] + cur[2] - 1
                 tmp_l_key = l_key
@@ -126,14 +216,15 @@ class SLBRIN(SpatialIndex):
                 for i in range(4):
                     value = r_bound
                     r_bound = cur[0] + (i + 1 << geohash.sum_bits - length)
-                    tmp_r_key = binary_search_less_max(data_list, 2, r_bound, tmp_l_key, r_key)
-                    child_list[i] = (value, length, tmp_r_key - tmp_l_key + 1, tmp_l_key, child_regions[i])
+                    tmp_r_key = tmp_l_key + int(np.searchsorted(geohashes[tmp_l_key:r_key + 1], r_bound)) - 1
+                    child_list[i] = (value, length, tmp_r_key - tmp_l_key + 1, tmp_l_key,
+                                     child_regions[child_quadrants[i]])
                     tmp_l_key = tmp_r_key + 1
                 range_stack.extend(child_list[::-1])  # 倒着放入init中，保持顺序
             else:
                 # 把不需要分裂的hr加入结果list，加入的时候顺序为[左上，右下，左上，右上]的逆序，因为堆栈
                 range_list.append(cur)
-        # 2.3. reorganize index entries
+        # 2.3. reorganize index entries: 每个hr是连续数组data_list上的视图
         self.index_entries = [data_list[r[3]: r[3] + r[2]] for r in range_list]
         # 2.4. create slbrin
         self.meta = Meta(len(range_list) - 1, -1, threshold_number, threshold_length, threshold_err, threshold_summary,
@@ -141,11 +232,28 @@ class SLBRIN(SpatialIndex):
         region_offset = pow(10, -data_precision - 1)
         self.history_ranges = [HistoryRange(r[0], r[1], r[2], None, 0, r[4].up_right_less_region(region_offset),
                                             2 << geohash.sum_bits - r[1] - 1) for r in range_list]
+        self.hr_scopes = None
+        self.hr_directory = None
+        self.ie_offsets = None
+        self.cr_offset = 0
+        if self.query_cache is not None:
+            self.query_cache.clear()
         self.current_ranges = []
         self.create_cr()
         # 3. build learned model
-        self.build_nn_multiprocess(is_new, is_simple, weight, core, train_step, batch_num, learning_rate,
-                                   use_threshold, threshold, retrain_time_limit, thread_pool_size)
+        if leaf_model == 'spline':
+            self.build_spline(spline_err)
+        else:
+            self.build_nn_multiprocess(is_new, is_simple, weight, core, train_step, batch_num, learning_rate,
+                                       use_threshold, threshold, retrain_time_limit, thread_pool_size)
+
+    def build_spline(self, spline_err):
+        """
+        用误差有界的分段线性样条作为hr的模型，单次遍历拟合，不需要训练
+        """
+        for hr_key in range(self.meta.last_hr + 1):
+            hr = self.history_ranges[hr_key]
+            hr.model = fit_spline(self.index_entries[hr_key]['2'], hr.value, hr.value_diff, spline_err)
 
     def build_nn_multiprocess(self, is_new, is_simple, weight, core, train_step, batch_num, learning_rate,
                               use_threshold, threshold, retrain_time_limit, thread_pool_size):
@@ -155,34 +263,38 @@ class SLBRIN(SpatialIndex):
         model_png_dir = os.path.join(self.model_path, "png/")
         if os.path.exists(model_png_dir) is False:
             os.makedirs(model_png_dir)
-        pool = multiprocessing.Pool(processes=thread_pool_size)
-        mp_dict = multiprocessing.Manager().dict()
+        # 优化: 每次新建Pool+Manager且pickle每个hr的inputs->复用TrainPool，geohash列通过shared_memory发布一次
+        inputs = np.concatenate([ies['2'] for ies in self.index_entries[:self.meta.last_hr + 1]])
+        tasks = []
+        offset = 0
         for hr_key in range(self.meta.last_hr + 1):
             hr = self.history_ranges[hr_key]
-            # 训练数据为左下角点+分区数据+右上角点
-            inputs = [ie[2] for ie in self.index_entries[hr_key]]
-            inputs.insert(0, hr.value)
-            inputs.append(hr.value + hr.value_diff)
-            data_num = hr.number + 2
-            labels = list(range(data_num))
-            batch_size = 2 ** math.ceil(math.log(data_num / batch_num, 2))
-            if batch_size < 1:
-                batch_size = 1
-            # batch_size = batch_num
-            pool.apply_async(build_nn, (self.model_path, hr_key, inputs, labels, is_new, is_simple,
-                                        weight, core, train_step, batch_size, learning_rate,
-                                        use_threshold, threshold, retrain_time_limit, mp_dict))
-        pool.close()
-        pool.join()
-        for (key, value) in mp_dict.items():
+            tasks.append((hr_key, offset, hr.number,
+                          (self.model_path, hr_key, hr.value, hr.value_diff, is_new, is_simple, weight, core,
+                           train_step, batch_num, learning_rate, use_threshold, threshold, retrain_time_limit)))
+            offset += hr.number
+        for (key, value) in get_train_pool(thread_pool_size).map(train_hr, inputs, None, tasks).items():
             self.history_ranges[key].model = value
 
     def insert_single(self, point):
         # 1. encode p to geohash and create index entry(x, y, geohash, t, pointer)
         point = (point[0], point[1], self.meta.geohash.encode(point[0], point[1]), point[2], point[3])
+        if self.maintenance_thread is None:
+            self.log_wal([point], 1)
+            self.insert_cr(point)
+        else:
+            # 优化: 后台维护时只追加到tail，tail满一个cr时唤醒后台线程
+            with self.tail_lock:
+                self.log_wal([point], 1)
+                self.tail.append(point)
+                tail_len = len(self.tail)
+            if tail_len >= self.meta.threshold_summary:
+                self.maintenance_event.set()
+
+    def insert_cr(self, point):
         # 2. insert into cr
         self.current_ranges[-1].number += 1
-        self.index_entries[-1].append(tuple(point))
+        self.index_entries[-1].append(point)
         # 3. parallel transactions
         self.get_sum_up_full_cr()
         self.get_merge_outdated_cr()
@@ -197,12 +309,324 @@ class SLBRIN(SpatialIndex):
         for point in points:
             self.insert_single(point)
         # 理论上重训练发生在get_retrain_inefficient_model，但TS和TM一旦变小，重训练的次数就指数上升，因此可以在每次插入任务结束时进行
+        # 后台维护时由后台线程重训练
+        if self.maintenance_thread is None:
+            self.post_retrain_inefficient_model()
+
+    def insert_batch(self, points):
+        """
+        批量插入，结果（包括save后的文件）和insert逐点插入一致
+        1. encode_batch一次计算所有点的geohash
+        2. 按ts_summary把点切成块，每块整体追加到last cr
+        3. last cr满时用块的min/max统计MBR，并检查一次ts_merge
+        优化: 逐点encode/append/检查阈值->每块一次
+        """
+        self.sum_up_full_cr_time = 0.0
+        self.merge_outdated_cr_time = 0.0
+        self.retrain_inefficient_model_time = 0.0
+        self.retrain_inefficient_model_num = 0
+        if len(points) == 0:
+            return
+        # 和point[0]/point[1]/point[2]/point[3]一致，支持结构化数组和二维数组
+        columns = [points[name] for name in points.dtype.names[:4]] if points.dtype.names else \
+            [points[:, i] for i in range(4)]
+        # 1. encode all points
+        ghs = self.meta.geohash.encode_batch(columns[0], columns[1])
+        ies = list(zip(columns[0].tolist(), columns[1].tolist(), ghs.tolist(), columns[2].tolist(),
+                       columns[3].tolist()))
+        if self.maintenance_thread is not None:
+            with self.tail_lock:
+                self.log_wal(ies, 1)
+                self.tail.extend(ies)
+                tail_len = len(self.tail)
+            if tail_len >= self.meta.threshold_summary:
+                self.maintenance_event.set()
+            return
+        self.log_wal(ies, 1)
+        # 2. insert into cr by chunks
+        start = 0
+        while start < len(ies):
+            cr = self.current_ranges[-1]
+            end = min(start + self.meta.threshold_summary - cr.number, len(ies))
+            self.index_entries[-1].extend(ies[start:end])
+            cr.number += end - start
+            # 3. sum up full cr
+            if cr.number >= self.meta.threshold_summary:
+                start_time = time.time()
+                cr.state = 1
+                self.create_cr()
+                cr_ies = self.index_entries[-2]
+                xs = np.array([ie[0] for ie in cr_ies])
+                ys = np.array([ie[1] for ie in cr_ies])
+                cr.value = [ys.min().item(), ys.max().item(), xs.min().item(), xs.max().item()]
+                cr.state = 0
+                self.update_cr_mbrs()
+                self.sum_up_full_cr_time += time.time() - start_time
+            self.get_merge_outdated_cr()
+            start = end
+        self.post_retrain_inefficient_model()
+
+    def delete(self, point):
+        """
+        删除索引项，point和insert的点一致为(x, y, t, key)
+        1. hr中的索引项只打上tombstone，查询时跳过，位置不变所以模型误差仍然有效
+        2. cr和tail中的索引项直接删除
+        3. hr中存活比例低于threshold_live时压缩hr，tombstone在cr合并到hr时也会被压缩
+        :return: 是否找到并删除
+        """
+        x, y, key = point[0], point[1], point[3]
+        gh = self.meta.geohash.encode(x, y)
+        with self.lock:
+            with self.tail_lock:
+                self.log_wal([(x, y, gh, point[2], key)], 0)
+            if not self.delete_entry(x, y, gh, key):
+                return False
+            if self.shadow_deletes is not None:
+                self.shadow_deletes.append((gh, key))
+            return True
+
+    def delete_entry(self, x, y, gh, key):
+        """
+        delete中查找并删除索引项的部分，不记录wal，调用方持有lock
+        """
+        # 1. find in hr
+        if self.delete_hr_entry(gh, key):
+            return True
+        # 2. find in cr
+        for cr_key in self.point_query_cr(x, y):
+            cr = self.current_ranges[cr_key]
+            cr_ies = self.index_entries[cr_key + 1 + self.meta.last_hr]
+            for i in range(len(cr_ies)):
+                if cr_ies[i][2] == gh and cr_ies[i][4] == key:
+                    del cr_ies[i]
+                    cr.number -= 1
+                    cr.version += 1
+                    self.ie_offsets = None
+                    return True
+        with self.tail_lock:
+            for i in range(len(self.tail)):
+                if self.tail[i][2] == gh and self.tail[i][4] == key:
+                    del self.tail[i]
+                    return True
+        return False
+
+    def delete_hr_entry(self, gh, key):
+        """
+        在hr中给索引项打上tombstone，调用方持有lock
+        """
+        hr_key = self.point_query_hr(gh)
+        hr = self.history_ranges[hr_key]
+        if hr.number:
+            hr_data = self.index_entries[hr_key]
+            l_key, r_key = searchsorted_duplicate(hr_data['2'], gh, 0, hr.max_key)
+            for i in range(l_key, r_key):
+                if hr_data[i]['4'] == key and (hr.tombstones is None or not hr.tombstones[i]):
+                    if hr.tombstones is None:
+                        hr.tombstones = np.zeros(hr.number, dtype=bool)
+                    hr.tombstones[i] = True
+                    hr.deleted_number += 1
+                    hr.version += 1
+                    if hr.number - hr.deleted_number < self.threshold_live * hr.number:
+                        self.compact_hr(hr_key)
+                    return True
+        return False
+
+    def update_point(self, point, new_point):
+        """
+        更新索引项的位置：删除point，再以new_point的x/y和point的t/key插入
+        :return: 是否找到point
+        """
+        with self.lock:
+            if not self.delete(point):
+                return False
+            self.insert_single((new_point[0], new_point[1], point[2], point[3]))
+        return True
+
+    def compact_hr(self, hr_key):
+        """
+        去掉hr中打上tombstone的索引项，并用全部索引项重新计算模型误差
+        """
+        hr = self.history_ranges[hr_key]
+        if hr.tombstones is None:
+            return
+        if self.shadow_compacted is not None:
+            self.shadow_compacted.add(hr)
+        self.index_entries[hr_key] = self.index_entries[hr_key][~hr.tombstones]
+        hr.segment = None
+        hr.version += 1
+        hr.t_blocks = None
+        hr.codec = None
+        self.ie_offsets = None
+        hr.tombstones = None
+        hr.deleted_number = 0
+        hr.number = len(self.index_entries[hr_key])
+        hr.max_key = hr.number - 1
+        old_err = hr.model.max_err - hr.model.min_err
+        # 压缩后所有索引项的位置都变了，用全部索引项计算误差
+        hr.update_error_range(self.index_entries[hr_key], is_exact=True)
+        self.get_retrain_inefficient_model(hr_key, old_err)
+
+    def start_maintenance(self, interval=1.0):
+        """
+        启动后台维护线程，真正并行的事务：insert_single只追加到tail，
+        后台线程把tail按ts_summary整块写入cr、统计MBR、合并outdated cr、重训练低效模型
+        :param interval: 后台线程没有被唤醒时的轮询间隔，单位秒
+        """
+        if self.maintenance_thread is not None:
+            return
+        self.maintenance_stop = False
+        self.maintenance_thread = threading.Thread(target=self.maintenance, args=(interval,), daemon=True)
+        self.maintenance_thread.start()
+
+    def stop_maintenance(self):
+        """
+        停止后台维护线程，把tail中剩余的索引项写入cr，之后insert回到同步执行
+        """
+        if self.maintenance_thread is None:
+            return
+        self.maintenance_stop = True
+        self.maintenance_event.set()
+        self.maintenance_thread.join()
+        self.maintenance_thread = None
+        if self.maintenance_error is not None:
+            error, self.maintenance_error = self.maintenance_error, None
+            raise RuntimeError("maintenance thread failed") from error
+        with self.lock:
+            self.maintain(flush=True)
+
+    def maintenance(self, interval):
+        try:
+            while not self.maintenance_stop:
+                self.maintenance_event.wait(interval)
+                self.maintenance_event.clear()
+                self.maintain_concurrently()
+        except Exception as e:
+            self.logging.exception("Maintenance failed")
+            self.maintenance_error = e
+
+    def maintain(self, flush=False):
+        """
+        后台维护的一轮，调用方持有lock
+        1. 从tail取出整块的索引项写入cr，tail中不足一个cr的部分留给查询直接扫描，flush时全部取出
+        2. 合并所有outdated cr
+        3. 重训练所有低效状态的hr
+        """
+        self.maintain_tail(flush)
+        while self.current_ranges[0].state == 2:
+            self.post_merge_outdated_cr()
+            self.get_merge_outdated_cr()
         self.post_retrain_inefficient_model()
 
+    def maintain_tail(self, flush=False):
+        """
+        从tail取出整块的索引项写入cr，flush时全部取出，调用方持有lock
+        """
+        with self.tail_lock:
+            size = len(self.tail) if flush else len(self.tail) - len(self.tail) % self.meta.threshold_summary
+            points = self.tail[:size]
+            del self.tail[:size]
+        for point in points:
+            self.insert_cr(point)
+
+    def maintain_concurrently(self):
+        """
+        后台维护线程的一轮，和maintain的结果一致，只在取副本和替换时持有lock
+        1. 持有lock：从tail取出整块的索引项写入cr，取hr目录的副本
+        2. 不持有lock：在副本上合并outdated cr、重训练低效模型，查询和删除仍使用原来的hr目录
+        3. 持有lock：在副本上重做期间的删除后替换hr目录，副本修改过的hr期间被压缩时丢弃副本，在lock内重做
+        优化: 整轮维护持有lock->合并和重训练不持有lock，查询只在替换hr目录时等待
+        """
+        with self.lock:
+            self.maintain_tail()
+            if self.current_ranges[0].state != 2 and not self.retrain_state:
+                return
+            shadow = self.shadow()
+            self.shadow_deletes = []
+            self.shadow_compacted = set()
+        try:
+            while shadow.current_ranges[0].state == 2:
+                shadow.post_merge_outdated_cr()
+                shadow.get_merge_outdated_cr()
+            shadow.post_retrain_inefficient_model()
+            with self.lock:
+                if not self.swap_shadow(shadow):
+                    self.maintain()
+        finally:
+            with self.lock:
+                self.shadow_deletes = None
+                self.shadow_compacted = None
+
+    def shadow(self):
+        """
+        用于在lock外合并和重训练的副本：hr/cr/index entries的list和meta是复制的，hr和cr对象是共享的
+        副本修改hr前由writable_hr复制hr，cr只会被整体删除或修改state
+        """
+        shadow = copy.copy(self)
+        shadow.meta = copy.copy(self.meta)
+        shadow.history_ranges = self.history_ranges[:]
+        # IndexEntries的切片会解码所有hr，因此按list复制未解码的元素
+        shadow.index_entries = type(self.index_entries)(list.copy(self.index_entries))
+        shadow.current_ranges = self.current_ranges[:]
+        shadow.shadow_hrs = set(self.history_ranges)
+        shadow.shadow_replaced = []
+        return shadow
+
+    def writable_hr(self, hr_key):
+        """
+        将要被修改的hr，在副本上修改原来的hr时先复制hr、模型和tombstone，原来的hr仍由查询和删除使用
+        """
+        hr = self.history_ranges[hr_key]
+        if self.shadow_hrs is not None and hr in self.shadow_hrs:
+            self.shadow_replaced.append(hr)
+            hr = copy.copy(hr)
+            hr.model = copy.deepcopy(hr.model)
+            if hr.tombstones is not None:
+                hr.tombstones = hr.tombstones.copy()
+            self.history_ranges[hr_key] = hr
+        return hr
+
+    def swap_shadow(self, shadow):
+        """
+        用副本替换hr目录，调用方持有lock
+        1. 副本修改过的原hr期间被压缩时，副本中该hr的index entries已经过期，不替换
+        2. 副本没有修改的hr和原来共享对象，期间被压缩时换为原来的index entries
+        3. 在副本上重做期间的删除：共享的hr和cr中已经删除，只会在副本修改过的hr中找到，所以只查找hr
+           合并时整体复制cr的索引项，复制后删除的索引项在合并后的hr中
+        :return: 是否替换
+        """
+        if any(hr in self.shadow_compacted for hr in shadow.shadow_replaced):
+            return False
+        index_entries = dict(zip(self.history_ranges, list.copy(self.index_entries)))
+        for hr_key in range(shadow.meta.last_hr + 1):
+            hr = shadow.history_ranges[hr_key]
+            if hr in index_entries:
+                list.__setitem__(shadow.index_entries, hr_key, index_entries[hr])
+        shadow.shadow_hrs = None
+        for gh, key in self.shadow_deletes:
+            shadow.delete_hr_entry(gh, key)
+        for name in ['meta', 'history_ranges', 'index_entries', 'current_ranges', 'hr_directory', 'hr_scopes',
+                     'cr_mbrs', 'cr_offset', 'merge_outdated_cr_time', 'retrain_inefficient_model_time',
+                     'retrain_inefficient_model_num']:
+            setattr(self, name, getattr(shadow, name))
+        self.cr_ts = None
+        self.ie_offsets = None
+        # 期间删除导致的压缩可能把共享的hr设为低效状态
+        self.retrain_state = int(any(hr.state for hr in self.history_ranges))
+        return True
+
+    def tail_entries(self):
+        """
+        还没有写入cr的索引项快照，调用方持有lock
+        """
+        with self.tail_lock:
+            return self.tail[:]
+
     def create_cr(self):
         self.current_ranges.append(CurrentRange(value=None, number=0, state=0))
         self.meta.last_cr += 1
         self.index_entries.append([])
+        self.update_cr_mbrs()
+        self.ie_offsets = None
 
     def get_sum_up_full_cr(self):
         """
@@ -223,8 +647,9 @@ class SLBRIN(SpatialIndex):
             cr = self.current_ranges[cr_key]
             if cr.state == 1:
                 start_time = time.time()
-                cr.value = get_mbr_by_points(self.index_entries[self.meta.last_hr + 1])
+                cr.value = get_mbr_by_points(self.index_entries[self.meta.last_hr + 1 + cr_key])
                 cr.state = 0
+                self.update_cr_mbrs()
                 end_time = time.time()
                 self.sum_up_full_cr_time += end_time - start_time
                 break
@@ -247,41 +672,83 @@ class SLBRIN(SpatialIndex):
         if self.current_ranges[0].state == 2:
             start_time = time.time()
             # 1. order index entries in outdated crs(first ts_merge cr)
-            old_data_len = self.meta.threshold_merge * self.meta.threshold_summary
+            # 优化: list.sort(key=lambda)->在geohash列上argsort(stable和list.sort一致)
             first_cr_key = self.meta.last_hr + 1
             old_data = []
             for range_ies in self.index_entries[first_cr_key:first_cr_key + self.meta.threshold_merge]:
                 old_data.extend(range_ies)
-            old_data.sort(key=lambda x: x[2])
+            old_data = np.array(old_data, dtype=IE_DTYPE)
+            old_data = old_data[np.argsort(old_data['2'], kind='stable')]
             # 2. merge index entries into hrs
+            # 优化: split_data_by_hr递归二分->在hr的value上一次searchsorted得到所有hr的分界
             hr_num = self.meta.last_hr + 1
-            bks = [0] * hr_num
-            self.split_data_by_hr(old_data, 0, self.meta.last_hr, 0, old_data_len - 1, bks)
-            tmp_bk = 0
+            bks = np.searchsorted(old_data['2'], self.get_hr_directory()[0], side='left').tolist()
+            bks[0] = 0
+            bks.append(len(old_data))
             offset = 0  # update_hr中若出现split_hr，会导致后续hr_key向后偏移，因此用offset来记录偏移量
             for i in range(hr_num):
-                bk = bks[i]
-                if bk and bk > tmp_bk:  # split中取mid的做法会导致部分右边界出现在前面的hr，因此bk > tmp_bk来过滤这种情况
-                    offset += self.update_hr(i + offset, old_data[tmp_bk:bk])
-                    tmp_bk = bk
+                if bks[i + 1] > bks[i]:
+                    offset += self.update_hr(i + offset, old_data[bks[i]:bks[i + 1]])
             # 3. delete crs/index entries
             del self.current_ranges[:self.meta.threshold_merge]
             self.meta.last_cr -= self.meta.threshold_merge
+            self.cr_offset += self.meta.threshold_merge
             first_cr_key += offset
             del self.index_entries[first_cr_key:first_cr_key + self.meta.threshold_merge]
+            self.update_cr_mbrs()
+            self.ie_offsets = None
             end_time = time.time()
             self.merge_outdated_cr_time += end_time - start_time
 
-    def split_data_by_hr(self, data, l_hr_key, r_hr_key, l_data_key, r_data_key, result):
-        m_hr_key = (l_hr_key + r_hr_key) // 2
-        m_data_key = binary_search_less_max(data, 2, self.history_ranges[m_hr_key].value, l_data_key, r_data_key)
-        result[m_hr_key - 1] = m_data_key + 1
-        if m_data_key >= l_data_key:
-            if m_hr_key > l_hr_key:
-                self.split_data_by_hr(data, l_hr_key, m_hr_key - 1, l_data_key, m_data_key, result)
-        if m_data_key < r_data_key:
-            if m_hr_key < r_hr_key:
-                self.split_data_by_hr(data, m_hr_key + 1, r_hr_key, m_data_key + 1, r_data_key, result)
+    def update_cr_mbrs(self):
+        """
+        cr的MBR变化时（新增cr/统计MBR/合并cr）重建cr_mbrs
+        """
+        self.cr_mbrs = np.array([cr.value if cr.value is not None else [np.nan] * 4 for cr in self.current_ranges],
+                                dtype=np.float64).reshape(-1, 4)
+        self.cr_ts = None
+
+    def get_cr_ts(self):
+        """
+        cr按插入顺序追加，t基本递增，所以统计过MBR的cr的t范围很窄，时空查询可以跳过大部分旧的cr
+        cr的t范围在统计MBR后计算一次，之后只会删除索引项，范围仍然有效
+        """
+        if self.cr_ts is None:
+            for cr_key in range(self.meta.last_cr + 1):
+                cr = self.current_ranges[cr_key]
+                if cr.t_range is None and cr.value is not None and cr.number:
+                    ts = [ie[3] for ie in self.index_entries[self.meta.last_hr + 1 + cr_key]]
+                    cr.t_range = [min(ts), max(ts)]
+            self.cr_ts = np.array([cr.t_range if cr.t_range is not None else [np.nan] * 2
+                                   for cr in self.current_ranges], dtype=np.float64).reshape(-1, 2)
+        return self.cr_ts
+
+    def point_query_cr(self, x, y):
+        """
+        找到MBR包含点的cr和还没统计MBR的cr
+        优化: 逐个cr判断MBR->在cr_mbrs上整体判断，只遍历命中的cr
+        """
+        mbrs = self.cr_mbrs
+        return np.flatnonzero(((mbrs[:, 0] <= y) & (y <= mbrs[:, 1]) & (mbrs[:, 2] <= x) & (x <= mbrs[:, 3]))
+                              | np.isnan(mbrs[:, 0])).tolist()
+
+    def range_query_cr(self, window, t_range=None):
+        """
+        找到MBR和window相交的cr和还没统计MBR的cr，以及window是否包含cr，和intersect的判断一致
+        :param t_range: [t_from, t_to]，不为None时再跳过t范围和t_range不相交的cr
+        :return: [(cr_key, is_contain)]
+        """
+        mbrs = self.cr_mbrs
+        is_intersect = (mbrs[:, 0] <= window[1]) & (window[0] <= mbrs[:, 1]) & \
+                       (mbrs[:, 2] <= window[3]) & (window[2] <= mbrs[:, 3])
+        is_contain = (window[0] <= mbrs[:, 0]) & (mbrs[:, 1] <= window[1]) & \
+                     (window[2] <= mbrs[:, 2]) & (mbrs[:, 3] <= window[3])
+        is_candidate = is_intersect | np.isnan(mbrs[:, 0])
+        if t_range is not None:
+            cr_ts = self.get_cr_ts()
+            is_candidate &= ~((cr_ts[:, 0] > t_range[1]) | (cr_ts[:, 1] < t_range[0]))
+        cr_keys = np.flatnonzero(is_candidate)
+        return list(zip(cr_keys.tolist(), is_contain[cr_keys].tolist()))
 
     def get_retrain_inefficient_model(self, hr_key, old_err):
         """
@@ -298,23 +765,28 @@ class SLBRIN(SpatialIndex):
         重训练单个低效状态的HR
         """
         start_time = time.time()
-        hr = self.history_ranges[hr_key]
-        inputs = [j[2] for j in self.index_entries[hr_key]]
-        inputs.insert(0, hr.value)
-        inputs.append(hr.value + hr.value_diff)
-        data_num = hr.number + 2
-        labels = list(range(data_num))
-        batch_size = 2 ** math.ceil(math.log(data_num / self.batch_num, 2))
-        if batch_size < 1:
-            batch_size = 1
-        tmp_index = NN(self.model_path, str(hr_key), inputs, labels, True, self.weight,
-                       self.cores, self.train_step, batch_size, self.learning_rate, False, None, None)
-        # tmp_index.build_simple(None)
-        tmp_index.build_simple(hr.model.matrices)
-        hr.model = AbstractNN(tmp_index.matrices, hr.model.hl_nums,
-                              math.floor(tmp_index.min_err),
-                              math.ceil(tmp_index.max_err))
+        hr = self.writable_hr(hr_key)
+        if isinstance(hr.model, AbstractSpline):
+            hr.model = fit_spline(self.index_entries[hr_key]['2'], hr.value, hr.value_diff, hr.model.err)
+        else:
+            inputs = self.index_entries[hr_key]['2'].tolist()
+            inputs.insert(0, hr.value)
+            inputs.append(hr.value + hr.value_diff)
+            data_num = hr.number + 2
+            labels = list(range(data_num))
+            batch_size = 2 ** math.ceil(math.log(data_num / self.batch_num, 2))
+            if batch_size < 1:
+                batch_size = 1
+            tmp_index = NN(self.model_path, str(hr_key), inputs, labels, True, self.weight,
+                           self.cores, self.train_step, batch_size, self.learning_rate, False, None, None)
+            # tmp_index.build_simple(None)
+            tmp_index.build_simple(hr.model.matrices)
+            hr.model = AbstractNN(tmp_index.matrices, hr.model.hl_nums,
+                                  math.floor(tmp_index.min_err),
+                                  math.ceil(tmp_index.max_err))
         hr.state = 0
+        hr.segment = None
+        hr.version += 1
         end_time = time.time()
         self.retrain_inefficient_model_time += end_time - start_time
         self.retrain_inefficient_model_num += 1
@@ -334,10 +806,21 @@ class SLBRIN(SpatialIndex):
         update hr by points
         """
         # merge cr data into hr data
-        hr = self.history_ranges[hr_key]
-        # quicksort->merge_sorted_array->sorted->binary_search and insert => 50:2:1:0.5
+        hr = self.writable_hr(hr_key)
         hr_data = self.index_entries[hr_key]
-        merge_sorted_list(hr_data, points)
+        hr.segment = None
+        hr.version += 1
+        hr.t_blocks = None
+        hr.codec = None
+        self.ie_offsets = None
+        # 合并时压缩tombstone，之后的update_error_range/split_hr会重新计算模型误差
+        if hr.tombstones is not None:
+            hr_data = hr_data[~hr.tombstones]
+            hr.tombstones = None
+            hr.deleted_number = 0
+        # quicksort->merge_sorted_array->sorted->binary_search and insert => 50:2:1:0.5
+        hr_data = merge_sorted_array(hr_data, np.asarray(points, dtype=IE_DTYPE))
+        self.index_entries[hr_key] = hr_data
         hr_number = len(hr_data)
         if hr_number > self.meta.threshold_number and hr.length < self.meta.threshold_length:
             # split hr
@@ -360,6 +843,7 @@ class SLBRIN(SpatialIndex):
             cur = range_stack.pop(-1)
             if cur[2] > self.meta.threshold_number and cur[1] < self.meta.threshold_length:
                 child_regions = cur[4].split()
+                child_quadrants = self.meta.geohash.child_quadrants(cur[0], cur[1])
                 l_key = cur[3]
                 r_key = cur[3] + cur[2] - 1
                 tmp_l_key = l_key
@@ -370,20 +854,24 @@ class SLBRIN(SpatialIndex):
                 for i in range(4):
                     value = r_bound
                     r_bound = cur[0] + (i + 1 << self.meta.geohash.sum_bits - length)
-                    tmp_r_key = binary_search_less_max(hr_data, 2, r_bound, tmp_l_key, r_key)
-                    child_list[i] = (value, length, tmp_r_key - tmp_l_key + 1, tmp_l_key, child_regions[i],
-                                     child_matrices_list[i])
+                    tmp_r_key = tmp_l_key + int(np.searchsorted(hr_data['2'][tmp_l_key:r_key + 1], r_bound)) - 1
+                    child_list[i] = (value, length, tmp_r_key - tmp_l_key + 1, tmp_l_key,
+                                     child_regions[child_quadrants[i]], child_matrices_list[i])
                     tmp_l_key = tmp_r_key + 1
                 range_stack.extend(child_list[::-1])
             else:
                 range_list.append(cur)
         child_len = len(range_list)
         child_ranges = []
+        old_err = hr.model.max_err - hr.model.min_err
         for r in range_list:
             child_data = hr_data[r[3]:r[3] + r[2]]
             child_hr = HistoryRange(r[0], r[1], r[2], r[5], 0, r[4].up_right_less_region(region_offset),
                                     2 << self.meta.geohash.sum_bits - r[1] - 1)
             child_hr.update_error_range(child_data)
+            # 优化: 继承的模型低效时先只重新拟合输出层，仍然低效的才在retrain_inefficient_model中重训练
+            if child_hr.model.max_err - child_hr.model.min_err > self.meta.threshold_err * old_err:
+                child_hr.refit_model(child_data)
             child_ranges.append([child_hr, child_data])
         # 2. replace old hr and data
         del self.index_entries[hr_key]
@@ -394,8 +882,9 @@ class SLBRIN(SpatialIndex):
             self.index_entries.insert(hr_key, child_range[1])
         # 3. update meta
         self.meta.last_hr += child_len - 1
+        self.hr_scopes = None
+        self.hr_directory = None
         # 4. check model inefficient
-        old_err = hr.model.max_err - hr.model.min_err
         for i in range(child_len):
             self.get_retrain_inefficient_model(hr_key + i, old_err)
         return child_len
@@ -410,46 +899,51 @@ class SLBRIN(SpatialIndex):
 
     def range_query_hr(self, point1, point2):
         """
-        根据geohash1/geohash2找到之间所有hr的key以及和window的位置关系
-        1. 通过geohash_int1/geohash_int2找到window对应的所有org_geohash和对应window的position
-        2. 通过前缀匹配过滤org_geohash来找到tgt_geohash
-        3. 根据tgt_geohash分组并合并position
+        根据geohash1/geohash2找到window覆盖的所有hr的key以及和window的位置关系
+        1. 从window两个角的geohash的公共前缀节点开始按hr的前缀结构递归四分，节点和window不相交时跳过
+        2. 节点恰好是一个hr时，按window的边是否落在hr内计算position
+        3. 节点被window严格包含时，节点内所有hr的position为0，按hr key的范围整体加入
+        4. 否则展开四个子节点，只有和window的边相交的节点会继续展开
+        优化: 枚举window内max_length粒度的所有格子并排序+逐格前缀匹配hr->递归四分，代价和window的周长相关
         """
-        # 1. 通过geohash_int1/geohash_int2找到window对应的所有org_geohash和对应window的position
         hr_key1 = self.binary_search_less_max(point1, 0, self.meta.last_hr)
-        hr_key2 = self.binary_search_less_max(point2, hr_key1, self.meta.last_hr)
-        if hr_key1 == hr_key2:
+        if hr_key1 == self.binary_search_less_max(point2, hr_key1, self.meta.last_hr):
             return {hr_key1: 15}
-        else:
-            max_length = max(self.history_ranges[hr_key1].length, self.history_ranges[hr_key2].length)
-            org_geohash_list = self.meta.geohash.ranges_by_int(point1, point2, max_length)
-            # 2. 通过前缀匹配过滤org_geohash来找到tgt_geohash
-            # 3. 根据tgt_geohash分组并合并position
-            size = len(org_geohash_list) - 1
-            i = 1
-            tgt_geohash_dict = {hr_key1: org_geohash_list[0][1],
-                                hr_key2: org_geohash_list[-1][1]}
-            while True:
-                if self.history_ranges[hr_key1].value > org_geohash_list[i][0]:
-                    key = hr_key1 - 1
-                    pos = org_geohash_list[i][1]
-                    if self.history_ranges[key].length > max_length:
-                        tgt_geohash_dict[key] = pos
-                        tgt_geohash_dict[key + 1] = pos
-                        tgt_geohash_dict[key + 2] = pos
-                        tgt_geohash_dict[key + 3] = pos
-                    else:
-                        tgt_geohash_dict[key] = tgt_geohash_dict.get(key, 0) | org_geohash_list[i][1]
-                    i += 1
-                    if i >= size:
-                        break
-                else:
-                    hr_key1 += 1
-                    if hr_key1 > self.meta.last_hr:
-                        tgt_geohash_dict[hr_key2] = tgt_geohash_dict[hr_key2] | org_geohash_list[i][1]
-                        break
-            return tgt_geohash_dict
-            # 前缀匹配太慢：时间复杂度=O(len(window对应的geohash个数)*(j-i))
+        geohash = self.meta.geohash
+        x1, y1 = geohash.split_bits(point1)
+        x2, y2 = geohash.split_bits(point2)
+        value_list = self.get_hr_directory()[1]
+        result = {}
+        # window在两个角的格子的公共祖先节点内
+        dim_shift = max((x1 ^ x2).bit_length(), (y1 ^ y2).bit_length())
+        length = geohash.sum_bits - dim_shift * 2
+        value = point1 >> dim_shift * 2 << dim_shift * 2
+        # (节点的geohash, 节点的geohash长度, 节点左下角的经度格子, 纬度格子, 节点在曲线中的状态)
+        stack = [(value, length, x1 >> dim_shift << dim_shift, y1 >> dim_shift << dim_shift,
+                  geohash.node_state(value, length))]
+        while stack:
+            value, length, left, bottom, state = stack.pop()
+            size = 1 << geohash.dim_bits - length // 2
+            right = left + size - 1
+            up = bottom + size - 1
+            if left > x2 or x1 > right or bottom > y2 or y1 > up:
+                continue
+            hr_key = bisect.bisect_right(value_list, value) - 1
+            if self.history_ranges[hr_key].length <= length:
+                result[hr_key] = int(x2 <= right) | int(x1 >= left) << 1 | int(y2 <= up) << 2 | int(y1 >= bottom) << 3
+            elif x1 < left and right < x2 and y1 < bottom and up < y2:
+                last_key = bisect.bisect_right(value_list, value + (1 << geohash.sum_bits - length) - 1) - 1
+                result.update(dict.fromkeys(range(hr_key, last_key + 1), 0))
+            else:
+                # 子节点i的象限由曲线的children给出，象限的经度偏移为quadrant & 1，纬度偏移为quadrant >> 1
+                half = size >> 1
+                child_bits = geohash.sum_bits - length - 2
+                children = geohash.children[state]
+                for i in (3, 2, 1, 0):
+                    quadrant, child_state = children[i]
+                    stack.append((value + (i << child_bits), length + 2, left + (quadrant & 1) * half,
+                                  bottom + (quadrant >> 1) * half, child_state))
+        return result
 
     def range_query_blk(self, window):
         """
@@ -462,79 +956,105 @@ class SLBRIN(SpatialIndex):
     def knn_query_hr(self, center_hr_key, point1, point2, point3):
         """
         根据geohash1/geohash2找到之间所有hr的key以及和window的位置关系，并基于和point3距离排序
-        1. 通过geohash_int1/geohash_int2找到window对应的所有org_geohash和对应window的position
-        2. 通过前缀匹配过滤org_geohash来找到tgt_geohash
-        3. 根据tgt_geohash分组并合并position
-        4. 计算每个tgt_geohash和point3的距离，并进行降序排序
-        """
-        # 1. 通过geohash_int1/geohash_int2找到window对应的所有org_geohash和对应window的position
-        hr_key1 = self.biased_search_less_max(point1, center_hr_key, 0, center_hr_key)
-        hr_key2 = self.biased_search_less_max(point2, center_hr_key, center_hr_key, self.meta.last_hr)
-        if hr_key1 == hr_key2:
-            return [[hr_key1, 15, 0]]
-        else:
-            max_length = max(self.history_ranges[hr_key1].length, self.history_ranges[hr_key2].length)
-            org_geohash_list = self.meta.geohash.ranges_by_int(point1, point2, max_length)
-            # 2. 通过前缀匹配过滤org_geohash来找到tgt_geohash
-            # 3. 根据tgt_geohash分组并合并position
-            size = len(org_geohash_list) - 1
-            i = 1
-            tgt_geohash_dict = {hr_key1: org_geohash_list[0][1],
-                                hr_key2: org_geohash_list[-1][1]}
-            while True:
-                if self.history_ranges[hr_key1].value > org_geohash_list[i][0]:
-                    key = hr_key1 - 1
-                    pos = org_geohash_list[i][1]
-                    if self.history_ranges[key].length > max_length:
-                        tgt_geohash_dict[key] = pos
-                        tgt_geohash_dict[key + 1] = pos
-                        tgt_geohash_dict[key + 2] = pos
-                        tgt_geohash_dict[key + 3] = pos
-                    else:
-                        tgt_geohash_dict[key] = tgt_geohash_dict.get(key, 0) | org_geohash_list[i][1]
-                    i += 1
-                    if i >= size:
-                        break
-                else:
-                    hr_key1 += 1
-                    if hr_key1 > self.meta.last_hr:
-                        tgt_geohash_dict[hr_key2] = tgt_geohash_dict[hr_key2] | org_geohash_list[i][1]
-                        break
-            # 4. 计算每个tgt_geohash和point3的距离，并进行降序排序
-            return sorted([[tgt_geohash,
-                            tgt_geohash_dict[tgt_geohash],
-                            self.history_ranges[tgt_geohash].scope.get_min_distance_pow_by_point_list(point3)]
-                           for tgt_geohash in tgt_geohash_dict], key=lambda x: x[2])
+        1. 通过range_query_hr找到window覆盖的所有hr和position
+        2. 计算每个hr和point3的距离，并进行升序排序
+        """
+        hr_list = self.range_query_hr(point1, point2)
+        return sorted([[hr_key, hr_list[hr_key],
+                        self.history_ranges[hr_key].scope.get_min_distance_pow_by_point_list(point3)]
+                       for hr_key in hr_list], key=lambda x: x[2])
+
+    def get_hr_directory(self):
+        """
+        :return: hr的value的int64数组、list、radix表和geohash到radix前缀的右移位数
+        radix[p]为value前缀>=p的第一个hr，前缀为p的geohash所在的hr在[radix[p] - 1, radix[p + 1] - 1]内
+        """
+        if self.hr_directory is None:
+            values = np.array([hr.value for hr in self.history_ranges], dtype=np.int64)
+            radix_bits = min(self.meta.geohash.sum_bits, len(values).bit_length() + 2)
+            shift = self.meta.geohash.sum_bits - radix_bits
+            radix = np.searchsorted(values >> shift, np.arange((1 << radix_bits) + 1), side='left').tolist()
+            self.hr_directory = (values, values.tolist(), radix, shift)
+        return self.hr_directory
 
     def binary_search_less_max(self, x, left, right):
         """
         二分查找比x小的最大值
         优化: 循环->二分->最左匹配:15->1->0.75
+        优化: 在hr对象的value属性上二分->radix表按前缀缩小到少量hr，再在value的list上bisect
         """
-        while left <= right:
-            mid = (left + right) // 2
-            if self.history_ranges[mid].value <= x:
-                # 最左匹配
-                if self.meta.last_hr == mid or self.history_ranges[mid + 1].value > x:
-                    return mid
-                left = mid + 1
-            else:
-                right = mid - 1
+        directory = self.hr_directory
+        if directory is None:
+            directory = self.get_hr_directory()
+        radix = directory[2]
+        prefix = x >> directory[3]
+        if prefix >= len(radix) - 1:
+            prefix = len(radix) - 2
+        lo = radix[prefix] - 1
+        hi = radix[prefix + 1]
+        return bisect.bisect_right(directory[1], x, lo if lo > left else left, hi if hi <= right else right + 1) - 1
 
     def biased_search_less_max(self, x, mid, left, right):
         """
         二分查找比x小的最大值，指定初始mid
         优化: 二分->biased二分:3->1
+        radix表缩小的范围已经只有少量hr，不再需要mid
         """
-        while left <= right:
-            if self.history_ranges[mid].value <= x:
-                if self.meta.last_hr == mid or self.history_ranges[mid + 1].value > x:
-                    return mid
-                left = mid + 1
-            else:
-                right = mid - 1
-            mid = (left + right) // 2
+        return self.binary_search_less_max(x, left, right)
+
+    def enable_query_cache(self, capacity):
+        """
+        开启查询结果缓存，缓存最近capacity个点查询和范围查询
+        """
+        self.query_cache = QueryCache(capacity)
+
+    def disable_query_cache(self):
+        self.query_cache = None
+
+    def query_hr_cached(self, hr_deps, get_hr_list, query_hr):
+        """
+        query_cache条目的hr部分
+        1. hr_deps中全部hr的version不变时，hr没有合并/分裂/删除/重训练，查询涉及的hr也不变，直接复用
+        2. 否则重新找到查询涉及的hr，只重新查询新的hr和version变化的hr
+        :param get_hr_list: 返回查询涉及的[(hr_key, arg)]
+        :param query_hr: query_hr(hr_key, arg)返回hr部分的结果
+        :return: 新的hr_deps
+        """
+        if hr_deps and all(hr.version == version for hr, version, result in hr_deps):
+            return hr_deps
+        old_deps = {id(hr): (version, result) for hr, version, result in hr_deps}
+        new_deps = []
+        for hr_key, arg in get_hr_list():
+            hr = self.history_ranges[hr_key]
+            dep = old_deps.get(id(hr))
+            if dep is None or dep[0] != hr.version:
+                dep = (hr.version, query_hr(hr_key, arg))
+            new_deps.append((hr, dep[0], dep[1]))
+        return new_deps
+
+    def query_cr_cached(self, cr_results, cr_list, query_cr):
+        """
+        query_cache条目的cr部分，cr按绝对编号记录已扫描的索引项数量，只扫描之后追加的索引项
+        :param cr_list: 查询涉及的[(cr_key, arg)]
+        :param query_cr: query_cr(cr_key, arg, start)返回cr中从start开始的索引项的结果
+        """
+        result = []
+        for cr_key, arg in cr_list:
+            cr = self.current_ranges[cr_key]
+            cr_id = self.cr_offset + cr_key
+            cached = cr_results.get(cr_id)
+            if cached is None or cached[0] != cr.version:
+                cached = cr_results[cr_id] = [cr.version, 0, []]
+            if cr.number > cached[1]:
+                cached[2].extend(query_cr(cr_key, arg, cached[1]))
+                cached[1] = cr.number
+            result.extend(cached[2])
+        # 已合并到hr的cr
+        for cr_id in [cr_id for cr_id in cr_results if cr_id < self.cr_offset]:
+            del cr_results[cr_id]
+        return result
 
+    @with_snapshot
     def point_query_single(self, point):
         """
         1. compute geohash from x/y of points
@@ -545,30 +1065,139 @@ class SLBRIN(SpatialIndex):
         """
         # 1. compute geohash from x/y of point
         gh = self.meta.geohash.encode(point[0], point[1])
-        # 2. find hr within geohash by slbrin.point_query
-        hr_key = self.point_query_hr(gh)
+        if self.query_cache is None:
+            # 2. find hr within geohash by slbrin.point_query
+            result = self.point_query_hr_result(self.point_query_hr(gh), gh)
+            # 5. filter cr by mbr
+            self.read_crs()
+            for cr_key in self.point_query_cr(point[0], point[1]):
+                result.extend(self.point_query_cr_result(cr_key, gh, 0))
+        else:
+            # 结果只取决于geohash，同一格子内的点共享条目
+            entry = self.query_cache.get(('point', gh), lambda: [[], {}])
+            entry[0] = self.query_hr_cached(entry[0], lambda: [(self.point_query_hr(gh), None)],
+                                            lambda hr_key, arg: self.point_query_hr_result(hr_key, gh))
+            result = entry[0][0][2][:]
+            self.read_crs()
+            result.extend(self.query_cr_cached(entry[1], [(cr_key, None) for cr_key in
+                                                          self.point_query_cr(point[0], point[1])],
+                                               lambda cr_key, arg, start: self.point_query_cr_result(cr_key, gh,
+                                                                                                     start)))
+        # 6. filter tail
+        result.extend([ie[4] for ie in self.tail_entries() if ie[2] == gh])
+        return result
+
+    def point_query_hr_result(self, hr_key, gh):
+        """
+        hr中geohash为gh的存活索引项的key
+        """
         hr = self.history_ranges[hr_key]
+        self.read_hr(hr_key)
         if hr.number == 0:
-            result = []
-        else:
-            # 3. predict by leaf model
-            pre = hr.model_predict(gh)
+            return []
+        # 3. predict by leaf model
+        self.read_model(hr_key)
+        pre = hr.model_predict(gh)
+        target_ies = self.index_entries[hr_key]
+        # 4. biased search in scope [pre - max_err, pre + min_err]
+        l_bound = max(pre - hr.model.max_err, 0)
+        r_bound = min(pre - hr.model.min_err, hr.max_key)
+        self.io_cost += math.ceil((r_bound - l_bound) / self.hr_items_per_page(hr_key))
+        self.read_ies(hr_key, l_bound, r_bound + 1)
+        l_key, r_key = searchsorted_duplicate(target_ies['2'], gh, l_bound, r_bound)
+        return hr.live_entries(target_ies[l_key:r_key], l_key)['4'].tolist()
+
+    def point_query_cr_result(self, cr_key, gh, start):
+        """
+        cr中从start开始、geohash为gh的索引项的key
+        cr的索引项按插入顺序排列，没有按geohash排序，所以逐个判断
+        """
+        cr = self.current_ranges[cr_key]
+        if cr.number <= start:
+            return []
+        self.io_cost += math.ceil((cr.number - start) / ITEMS_PER_PAGE)
+        self.read_ies(cr_key + 1 + self.meta.last_hr, start, cr.number)
+        cr_ies = self.index_entries[cr_key + 1 + self.meta.last_hr]
+        return [ie[4] for ie in (cr_ies[start:] if start else cr_ies) if ie[2] == gh]
+
+    @with_snapshot
+    def point_query_batch(self, points):
+        """
+        批量点查询，结果和point_query一致
+        1. compute geohash from x/y of all points at once
+        2. find hrs by np.searchsorted over the values of hrs
+        3. group points by hr and predict by leaf model once per hr
+        4. bounded search in scope [pre - max_err, pre - min_err] by np.searchsorted
+        5. filter cr by mbr
+        优化: 逐点encode/二分hr/predict->每批encode一次、searchsorted一次、每个hr predict一次
+        """
+        points = np.asarray(points)
+        xs = points[:, 0]
+        ys = points[:, 1]
+        # 1. compute geohash from x/y of all points at once
+        ghs = self.meta.geohash.encode_batch(xs, ys)
+        # 2. find hrs by np.searchsorted over the values of hrs
+        hr_keys = np.maximum(np.searchsorted(self.get_hr_directory()[0], ghs, side='right') - 1, 0)
+        results = [[] for i in range(len(points))]
+        # 3. group points by hr and predict by leaf model once per hr
+        order = np.argsort(hr_keys, kind='stable')
+        for group in np.split(order, np.flatnonzero(np.diff(hr_keys[order])) + 1):
+            if len(group) == 0:
+                continue
+            hr_key = int(hr_keys[group[0]])
+            hr = self.history_ranges[hr_key]
+            if hr.number == 0:
+                continue
+            group_ghs = ghs[group]
+            pres = hr.model_predicts(group_ghs)
+            # 4. bounded search in scope [pre - max_err, pre - min_err] by np.searchsorted
+            l_bounds = np.maximum(pres - hr.model.max_err, 0)
+            r_bounds = np.minimum(pres - hr.model.min_err, hr.max_key)
+            self.io_cost += int(np.ceil((r_bounds - l_bounds) / self.hr_items_per_page(hr_key)).sum())
+            if self.buffer_pool is not None:
+                for l_bound, r_bound in zip(l_bounds.tolist(), r_bounds.tolist()):
+                    self.read_hr(hr_key)
+                    self.read_model(hr_key)
+                    self.read_ies(hr_key, l_bound, r_bound + 1)
             target_ies = self.index_entries[hr_key]
-            # 4. biased search in scope [pre - max_err, pre + min_err]
-            l_bound = max(pre - hr.model.max_err, 0)
-            r_bound = min(pre - hr.model.min_err, hr.max_key)
-            self.io_cost += math.ceil((r_bound - l_bound) / ITEMS_PER_PAGE)
-            result = [target_ies[key][4] for key in biased_search_duplicate(target_ies, 2, gh, pre, l_bound, r_bound)]
+            l_keys = np.clip(np.searchsorted(target_ies['2'], group_ghs, side='left'), l_bounds, r_bounds + 1)
+            r_keys = np.clip(np.searchsorted(target_ies['2'], group_ghs, side='right'), l_bounds, r_bounds + 1)
+            target_keys = target_ies['4']
+            for i, l_key, r_key in zip(group.tolist(), l_keys.tolist(), r_keys.tolist()):
+                if hr.tombstones is None:
+                    results[i] = target_keys[l_key:r_key].tolist()
+                else:
+                    results[i] = target_keys[l_key:r_key][~hr.tombstones[l_key:r_key]].tolist()
         # 5. filter cr by mbr
+        mbrs = self.cr_mbrs
         for cr_key in range(self.meta.last_cr + 1):
             cr = self.current_ranges[cr_key]
-            if cr.number and cr.value[0] <= point[1] <= cr.value[1] and cr.value[2] <= point[0] <= cr.value[3]:
-                self.io_cost += math.ceil(cr.number / ITEMS_PER_PAGE)
-                result.extend(binary_search_duplicate(self.index_entries[cr_key + 1 + self.meta.last_hr],
-                                                      2, gh, 0, cr.number - 1))
-        return result
+            if cr.number:
+                if cr.value is None:
+                    in_mbr = np.ones(len(points), dtype=bool)
+                else:
+                    in_mbr = (mbrs[cr_key, 0] <= ys) & (ys <= mbrs[cr_key, 1]) & \
+                             (mbrs[cr_key, 2] <= xs) & (xs <= mbrs[cr_key, 3])
+                point_keys = np.flatnonzero(in_mbr).tolist()
+                if not point_keys:
+                    continue
+                cr_ies = self.index_entries[cr_key + 1 + self.meta.last_hr]
+                cr_ghs = np.array([ie[2] for ie in cr_ies], dtype=np.int64)
+                for i in point_keys:
+                    self.io_cost += math.ceil(cr.number / ITEMS_PER_PAGE)
+                    self.read_ies(cr_key + 1 + self.meta.last_hr, 0, cr.number)
+                    results[i].extend([cr_ies[j][4] for j in np.flatnonzero(cr_ghs == ghs[i]).tolist()])
+        # 6. filter tail
+        tail = self.tail_entries()
+        if tail:
+            tail_ghs = np.array([ie[2] for ie in tail], dtype=np.int64)
+            tail_keys = [ie[4] for ie in tail]
+            for i in range(len(points)):
+                results[i].extend([tail_keys[j] for j in np.flatnonzero(tail_ghs == ghs[i]).tolist()])
+        return results
 
-    def range_query_single(self, window):
+    @with_snapshot
+    def range_query_single(self, window, t_from=None, t_to=None):
         """
         1. compute geohash from window_left and window_right
         2. get all relative hrs with key and relationship
@@ -577,228 +1206,606 @@ class SLBRIN(SpatialIndex):
         5. filter all the point of scope[min_key/max_key] by range.contain(point)
         6. filter cr by mbr
         耗时操作：range_query_hr/nn predict/精确过滤: 15/24/37.6
+        :param t_from/t_to: 不为None时只返回t_from <= t <= t_to的索引项，按hr每页和cr的t的zone map跳过不相交的页和cr
+        """
+        t_range = get_t_range(t_from, t_to)
+        if self.query_cache is not None and t_range is None:
+            return self.range_query_cached(window)
+        result = []
+        for ies in self.range_query_ies(window, t_range):
+            if isinstance(ies, list):
+                result.extend([ie[-1] for ie in ies])
+            else:
+                result.extend(ies['4'].tolist())
+        return result
+
+    @with_snapshot
+    def range_count(self, window, t_from=None, t_to=None):
+        """
+        window内的索引项数量，不物化key
+        优化: window包含的hr/cr直接用number，只在边界hr上用列掩码过滤
+        """
+        return sum(len(ies) for ies in self.range_query_ies(window, get_t_range(t_from, t_to)))
+
+    @with_snapshot
+    def range_histogram(self, window, nx, ny, t_from=None, t_to=None):
+        """
+        window内的索引项在nx*ny网格上的直方图，不物化key
+        :param t_from/t_to: 不为None时只统计t_from <= t <= t_to的索引项，和range_count一致
+        :return: shape为(ny, nx)的int64数组，行为y从小到大，列为x从小到大
+        """
+        histogram = np.zeros(ny * nx, dtype=np.int64)
+        x_step = (window[3] - window[2]) / nx
+        y_step = (window[1] - window[0]) / ny
+        for ies in self.range_query_ies(window, get_t_range(t_from, t_to)):
+            if len(ies) == 0:
+                continue
+            if isinstance(ies, list):
+                ies = np.array(ies, dtype=IE_DTYPE)
+            xs = ((ies['0'] - window[2]) / x_step).astype(np.int64) if x_step else np.zeros(len(ies), np.int64)
+            ys = ((ies['1'] - window[0]) / y_step).astype(np.int64) if y_step else np.zeros(len(ies), np.int64)
+            # 在window右边界/上边界上的点归到最后一格
+            histogram += np.bincount(np.minimum(ys, ny - 1) * nx + np.minimum(xs, nx - 1), minlength=ny * nx)
+        return histogram.reshape(ny, nx)
+
+    def range_query_iter(self, window, chunk_size=65536):
+        """
+        range_query_single的流式版本，按hr的Z-order逐个hr、再按cr产出key数组，每个数组最多chunk_size个key
+        内存只和chunk_size有关，不需要物化整个结果
+        后台维护线程运行时，在lock内取快照后在lock外产出，迭代不阻塞维护线程和其他查询：
+        hr的索引项只会被整体替换、不会原地修改，因此保留视图；cr和tail会原地修改，因此复制为新的list
+        """
+        if self.maintenance_thread is None:
+            yield from self.range_query_chunks(self.range_query_ies(window), chunk_size)
+        else:
+            with self.lock:
+                snapshot = [ies[:] if isinstance(ies, list) else ies for ies in self.range_query_ies(window)]
+            yield from self.range_query_chunks(snapshot, chunk_size)
+
+    def range_query_chunks(self, ies_list, chunk_size):
+        chunks = []
+        chunk_len = 0
+        for ies in ies_list:
+            if isinstance(ies, list):
+                keys = np.array([ie[-1] for ie in ies], dtype=np.int64)
+            else:
+                keys = ies['4']
+            chunks.append(keys)
+            chunk_len += len(keys)
+            if chunk_len >= chunk_size:
+                keys = np.concatenate(chunks)
+                for i in range(0, len(keys) - chunk_size + 1, chunk_size):
+                    yield keys[i:i + chunk_size]
+                keys = keys[len(keys) - len(keys) % chunk_size:]
+                chunks = [keys]
+                chunk_len = len(keys)
+        if chunk_len:
+            yield np.concatenate(chunks)
+
+    def range_query_ies(self, window, t_range=None):
+        """
+        按hr的Z-order逐个hr、再按cr产出window内的索引项
+        hr产出IE_DTYPE的结构化数组，window包含hr时为hr的视图；cr和tail产出(x, y, geohash, t, key)的list
+        :param t_range: [t_from, t_to]，不为None时只产出t在t_range内的索引项
         """
         # 1. compute geohash of window_left and window_right
         gh1 = self.meta.geohash.encode(window[2], window[0])
         gh2 = self.meta.geohash.encode(window[3], window[1])
         # 2. get all relative hrs with key and relationship
         hr_list = self.range_query_hr(gh1, gh2)
-        result = []
         # 3. get min_geohash and max_geohash of every hr for different relation
-        for hr_key in hr_list:
-            hr = self.history_ranges[hr_key]
-            if hr.number == 0:  # hr is empty
-                continue
-            position = hr_list[hr_key]
-            hr_data = self.index_entries[hr_key]
-            if position == 0:  # window contain hr
-                result.extend([ie[4] for ie in hr_data])
-                self.io_cost += math.ceil(len(hr_data) / ITEMS_PER_PAGE)
-            else:
-                # wrong child hr from range_by_int
-                is_valid = valid_position_funcs[position](hr.scope, window)
-                if not is_valid:
-                    continue
-                # if-elif-else->lambda, 30->4
-                gh_new1, gh_new2, compare_func = range_position_funcs[position](hr.scope, window, gh1, gh2,
-                                                                                self.meta.geohash)
-                # 4 predict min_key/max_key by nn
-                if gh_new1:
-                    pre1 = hr.model_predict(gh_new1)
-                    l_bound1 = max(pre1 - hr.model.max_err, 0)
-                    r_bound1 = min(pre1 - hr.model.min_err, hr.max_key)
-                    left_key = min(biased_search_almost(hr_data, 2, gh_new1, pre1, l_bound1, r_bound1))
-                else:
-                    l_bound1 = 0
-                    left_key = 0
-                if gh_new2:
-                    pre2 = hr.model_predict(gh_new2)
-                    l_bound2 = max(pre2 - hr.model.max_err, 0)
-                    r_bound2 = min(pre2 - hr.model.min_err, hr.max_key)
-                    right_key = max(biased_search_almost(hr_data, 2, gh_new2, pre2, l_bound2, r_bound2)) + 1
-                else:
-                    r_bound2 = hr.number
-                    right_key = hr.number
-                # 5 filter all the point of scope[min_key/max_key] by range.contain(point)
-                # 优化: region.contain->compare_func不同位置的点做不同的判断: 638->474mil
-                result.extend([ie[4] for ie in hr_data[left_key:right_key] if compare_func(ie)])
-                self.io_cost += math.ceil((r_bound2 - l_bound1) / ITEMS_PER_PAGE)
+        for hr_key in sorted(hr_list):
+            ies = self.range_query_hr_ies(hr_key, hr_list[hr_key], window, gh1, gh2, t_range)
+            if ies is not None:
+                yield ies
         # 6. filter cr by mbr
-        for cr_key in range(self.meta.last_cr + 1):
-            cr = self.current_ranges[cr_key]
-            if cr.number:
-                pos = intersect(window, cr.value)
-                if pos == 0:
-                    continue
-                elif pos == 2:
-                    self.io_cost += math.ceil(cr.number / ITEMS_PER_PAGE)
-                    result.extend([ie[-1] for ie in self.index_entries[cr_key + 1 + self.meta.last_hr]])
-                else:
-                    self.io_cost += math.ceil(cr.number / ITEMS_PER_PAGE)
-                    result.extend([ie[-1] for ie in self.index_entries[cr_key + 1 + self.meta.last_hr]
-                                   if window[0] <= ie[1] <= window[1] and window[2] <= ie[0] <= window[3]])
+        self.read_crs()
+        for cr_key, is_contain in self.range_query_cr(window, t_range):
+            if self.current_ranges[cr_key].number:
+                yield self.range_query_cr_ies(cr_key, is_contain, window, 0, t_range)
+        # 7. filter tail
+        tail = [ie for ie in self.tail_entries() if window[0] <= ie[1] <= window[1] and window[2] <= ie[0] <= window[3]]
+        if t_range is not None:
+            tail = [ie for ie in tail if t_range[0] <= ie[3] <= t_range[1]]
+        yield tail
+
+    def range_query_cached(self, window):
+        """
+        range_query_single的query_cache版本，结果的顺序和range_query_ies一致
+        1. window按data_precision取整作为key，坐标的浮点误差不影响命中
+        2. 条目缓存key外扩10^-data_precision的window内的索引项，包含取整到同一个key的所有window，返回前按window精确过滤
+        """
+        key, cache_window, gh1, gh2 = self.get_cache_window(window)
+        entry = self.query_cache.get(('range',) + key, lambda: [[], {}])
+
+        def query_hr(hr_key, position):
+            ies = self.range_query_hr_ies(hr_key, position, cache_window, gh1, gh2)
+            return ies[['0', '1', '4']] if ies is not None else None
+
+        entry[0] = self.query_hr_cached(entry[0], lambda: sorted(self.range_query_hr(gh1, gh2).items()), query_hr)
+        result = []
+        for hr, version, ies in entry[0]:
+            if ies is not None:
+                result.extend(ies['4'][(window[0] <= ies['1']) & (ies['1'] <= window[1]) &
+                                       (window[2] <= ies['0']) & (ies['0'] <= window[3])].tolist())
+        self.read_crs()
+        cr_ies = self.query_cr_cached(entry[1], self.range_query_cr(cache_window),
+                                      lambda cr_key, is_contain, start:
+                                      self.range_query_cr_ies(cr_key, is_contain, cache_window, start))
+        result.extend([ie[4] for ie in cr_ies if window[0] <= ie[1] <= window[1] and window[2] <= ie[0] <= window[3]])
+        result.extend([ie[4] for ie in self.tail_entries()
+                       if window[0] <= ie[1] <= window[1] and window[2] <= ie[0] <= window[3]])
         return result
 
-    def knn_query_single(self, knn):
+    def get_cache_window(self, window):
+        """
+        范围查询在query_cache中的key和条目缓存的window
+        :return: key, 条目缓存的window, window两个角的geohash
+        """
+        precision = self.meta.geohash.data_precision
+        key = tuple(round(v, precision) for v in window)
+        pad = pow(10, -precision)
+        cache_window = [key[0] - pad, key[1] + pad, key[2] - pad, key[3] + pad]
+        self.meta.geohash.region.clip_region(cache_window, precision)
+        gh1 = self.meta.geohash.encode(cache_window[2], cache_window[0])
+        gh2 = self.meta.geohash.encode(cache_window[3], cache_window[1])
+        return key, cache_window, gh1, gh2
+
+    def range_query_hr_ies(self, hr_key, position, window, gh1, gh2, t_range=None):
+        """
+        hr中window内（和t_range内）的存活索引项，没有时返回None
+        """
+        hr = self.history_ranges[hr_key]
+        if hr.number == 0:  # hr is empty
+            return None
+        hr_data = self.index_entries[hr_key]
+        # 4. predict min_key/max_key by nn
+        left_key, right_key, compare_func = self.range_query_hr_keys(hr_key, hr_data, position, window, gh1, gh2,
+                                                                     t_range is None)
+        if left_key >= right_key:
+            return None
+        # 5 filter all the point of scope[min_key/max_key] by range.contain(point)
+        # 优化: region.contain->compare_func不同位置的点做不同的判断: 638->474mil
+        # 优化: 逐个ie判断->在x/y列视图上整体判断
+        if t_range is None:
+            ies = hr.live_entries(hr_data[left_key:right_key], left_key)
+        else:
+            ies = self.hr_time_entries(hr_key, left_key, right_key, t_range)
+            if ies is None:
+                return None
+        if compare_func is not None:
+            ies = ies[compare_func((ies['0'], ies['1']))]
+        return ies
+
+    def get_t_blocks(self, hr_key):
+        hr = self.history_ranges[hr_key]
+        if hr.t_blocks is None:
+            ts = self.index_entries[hr_key]['3']
+            starts = np.arange(0, len(ts), self.hr_items_per_page(hr_key))
+            if len(ts):
+                hr.t_blocks = np.stack([np.minimum.reduceat(ts, starts), np.maximum.reduceat(ts, starts)], axis=1)
+            else:
+                hr.t_blocks = np.empty((0, 2), dtype=ts.dtype)
+        return hr.t_blocks
+
+    def hr_time_entries(self, hr_key, left_key, right_key, t_range):
+        """
+        hr中[left_key, right_key)内t在t_range内的存活索引项，没有时返回None
+        只访问t的zone map和t_range相交的页，相邻的页合并为一段读取
+        """
+        hr = self.history_ranges[hr_key]
+        hr_data = self.index_entries[hr_key]
+        items_per_page = self.hr_items_per_page(hr_key)
+        first_page = left_key // items_per_page
+        t_blocks = self.get_t_blocks(hr_key)[first_page:(right_key - 1) // items_per_page + 1]
+        is_hit = (t_blocks[:, 0] <= t_range[1]) & (t_blocks[:, 1] >= t_range[0])
+        # 命中页的段：is_hit从False变为True的位置为段的开始，从True变为False的位置为段的结束
+        bounds = np.flatnonzero(np.diff(np.concatenate(([False], is_hit, [False])).astype(np.int8))) + first_page
+        pieces = []
+        for start_page, end_page in bounds.reshape(-1, 2).tolist():
+            l_key = max(start_page * items_per_page, left_key)
+            r_key = min(end_page * items_per_page, right_key)
+            self.io_cost += math.ceil((r_key - l_key) / items_per_page)
+            self.read_ies(hr_key, l_key, r_key)
+            ies = hr.live_entries(hr_data[l_key:r_key], l_key)
+            pieces.append(ies[(t_range[0] <= ies['3']) & (ies['3'] <= t_range[1])])
+        if not pieces:
+            return None
+        return pieces[0] if len(pieces) == 1 else np.concatenate(pieces)
+
+    def range_query_cr_ies(self, cr_key, is_contain, window, start, t_range=None):
+        """
+        cr中从start开始、window内（和t_range内）的索引项
+        """
+        cr = self.current_ranges[cr_key]
+        if cr.number <= start:
+            return []
+        self.io_cost += math.ceil((cr.number - start) / ITEMS_PER_PAGE)
+        self.read_ies(cr_key + 1 + self.meta.last_hr, start, cr.number)
+        cr_ies = self.index_entries[cr_key + 1 + self.meta.last_hr]
+        if start:
+            cr_ies = cr_ies[start:]
+        if t_range is not None:
+            cr_ies = [ie for ie in cr_ies if t_range[0] <= ie[3] <= t_range[1]]
+        if is_contain:
+            return cr_ies
+        return [ie for ie in cr_ies if window[0] <= ie[1] <= window[1] and window[2] <= ie[0] <= window[3]]
+
+    def range_query_hr_keys(self, hr_key, hr_data, position, window, gh1, gh2, is_scan=True):
+        """
+        找到hr中window覆盖的索引项范围
+        :param is_scan: 是否访问范围内的所有页，为False时只访问模型预测的查找范围，由调用方访问需要扫描的页
+        :return: left_key, right_key, compare_func(None表示不需要精确过滤)
+        """
+        hr = self.history_ranges[hr_key]
+        self.read_hr(hr_key)
+        if position == 0:  # window contain hr
+            if is_scan:
+                self.io_cost += math.ceil(hr.number / self.hr_items_per_page(hr_key))
+                self.read_ies(hr_key, 0, hr.number)
+            return 0, hr.number, None
+        # wrong child hr from range_query_hr
+        if not valid_position_funcs[position](hr.scope, window):
+            return 0, 0, None
+        gh_new1, gh_new2, compare_func = self.range_query_hr_geohashes(hr, position, window, gh1, gh2)
+        if gh_new1 or gh_new2:
+            self.read_model(hr_key)
+        if gh_new1:
+            pre1 = hr.model_predict(gh_new1)
+            l_bound1 = max(pre1 - hr.model.max_err, 0)
+            r_bound1 = min(pre1 - hr.model.min_err, hr.max_key)
+            left_key = searchsorted_almost(hr_data['2'], gh_new1, l_bound1, r_bound1)[0]
+        else:
+            l_bound1 = 0
+            left_key = 0
+        if gh_new2:
+            pre2 = hr.model_predict(gh_new2)
+            l_bound2 = max(pre2 - hr.model.max_err, 0)
+            r_bound2 = min(pre2 - hr.model.min_err, hr.max_key)
+            right_key = searchsorted_almost(hr_data['2'], gh_new2, l_bound2, r_bound2)[1]
+        else:
+            r_bound2 = hr.number
+            right_key = hr.number
+        if is_scan:
+            self.io_cost += math.ceil((r_bound2 - l_bound1) / self.hr_items_per_page(hr_key))
+            self.read_ies(hr_key, l_bound1, min(r_bound2 + 1, hr.number))
+        else:
+            # 查找范围的页大多也在调用方扫描的页中，io_cost只由调用方统计，buffer_pool按实际访问的页去重
+            if gh_new1:
+                self.read_ies(hr_key, l_bound1, r_bound1 + 1)
+            if gh_new2:
+                self.read_ies(hr_key, l_bound2, r_bound2 + 1)
+        return left_key, right_key, compare_func
+
+    def range_query_hr_geohashes(self, hr, position, window, gh1, gh2):
+        """
+        window在hr内的编码范围，position不为0且valid_position_funcs通过时调用
+        :return: gh_new1, gh_new2(None表示从hr的头/到hr的尾), compare_func
+        """
+        # if-elif-else->lambda, 30->4
+        gh_new1, gh_new2, compare_func = range_position_funcs[position](hr.scope, window, gh1, gh2,
+                                                                        self.meta.geohash)
+        if not self.meta.geohash.monotone:
+            # 曲线在hr内不单调时，window的边和hr的交点不是编码范围的端点，按window和hr.scope的交集计算编码范围
+            gh_new1, gh_new2 = self.meta.geohash.encode_window([max(window[0], hr.scope.bottom),
+                                                                min(window[1], hr.scope.up),
+                                                                max(window[2], hr.scope.left),
+                                                                min(window[3], hr.scope.right)])
+            if gh_new1 == hr.value:
+                gh_new1 = None
+            if gh_new2 == hr.value + hr.value_diff - 1:
+                gh_new2 = None
+        return gh_new1, gh_new2, compare_func
+
+    def get_hr_scopes(self):
+        if self.hr_scopes is None:
+            self.hr_scopes = np.array([[hr.scope.bottom, hr.scope.up, hr.scope.left, hr.scope.right]
+                                       for hr in self.history_ranges], dtype=np.float64).reshape(-1, 4)
+        return self.hr_scopes
+
+    def get_ie_offsets(self):
+        if self.ie_offsets is None:
+            if self.compression:
+                # hr部分为hr的第一页在slbrin_hr_pages.npy中的偏移，cr部分为cr的第一个索引项在slbrin_data.npy中的偏移
+                pages = [math.ceil(self.history_ranges[hr_key].number / self.hr_items_per_page(hr_key))
+                         for hr_key in range(self.meta.last_hr + 1)]
+                numbers = [cr.number for cr in self.current_ranges]
+                self.ie_offsets = [0] + np.cumsum(pages).tolist()[:-1] + [0] + np.cumsum(numbers).tolist()
+            else:
+                numbers = [hr.number for hr in self.history_ranges] + [cr.number for cr in self.current_ranges]
+                self.ie_offsets = [0] + np.cumsum(numbers).tolist()
+        return self.ie_offsets
+
+    def set_compression(self, compression):
         """
-        1. get the nearest key of query point
-        2. get the nn points to create range query window
-        3. filter point by distance
+        设置hr的index entries是否按压缩页存储，影响之后的save、size和io_cost
+        """
+        self.compression = compression
+        self.ie_offsets = None
+        for hr in self.history_ranges:
+            hr.t_blocks = None
+
+    def get_hr_codec(self, hr_key):
+        hr = self.history_ranges[hr_key]
+        if hr.codec is None:
+            hr.codec = get_codec(self.index_entries[hr_key], self.meta.geohash)
+        return hr.codec
+
+    def hr_items_per_page(self, hr_key):
+        """
+        hr的每页索引项数量，压缩时由hr的位宽决定
+        """
+        if self.compression:
+            return int(self.get_hr_codec(hr_key)['items_per_page'])
+        return ITEMS_PER_PAGE
+
+    def read_hr(self, hr_key):
+        """
+        访问hr在slbrin_hrs.npy中的页
+        """
+        self.read_items('slbrin_hrs', hr_key, hr_key + 1, HRS_PER_PAGE)
+
+    def read_model(self, hr_key):
+        """
+        访问hr的model在slbrin_models.npy中的页
+        """
+        self.read_pages('slbrin_models', hr_key * MODEL_SIZE // PAGE_SIZE, ((hr_key + 1) * MODEL_SIZE - 1) // PAGE_SIZE)
+
+    def read_crs(self):
+        """
+        访问slbrin_crs.npy的所有页，用于按mbr过滤cr
+        """
+        self.read_items('slbrin_crs', 0, self.meta.last_cr + 1, CRS_PER_PAGE)
+
+    def read_ies(self, range_key, start, end):
+        """
+        访问第range_key个range(hr在前，cr在后)中第[start, end)个索引项在slbrin_data.npy中的页
+        """
+        if self.buffer_pool is not None:
+            offset = self.get_ie_offsets()[range_key]
+            if self.compression and range_key <= self.meta.last_hr:
+                if end > start:
+                    items_per_page = self.hr_items_per_page(range_key)
+                    self.buffer_pool.read('slbrin_hr_pages', offset + start // items_per_page,
+                                          offset + (end - 1) // items_per_page)
+            else:
+                self.buffer_pool.read_items('slbrin_data', offset + start, offset + end, ITEMS_PER_PAGE)
+
+    def knn_query_hr_scope(self, hr_key, hr_data, window, gh1, gh2, is_scan=True):
+        """
+        找到hr中window覆盖的索引项范围，根据window的边是否在hr.scope内计算位置关系，和range_query_hr的position一致
+        :return: left_key, right_key, compare_func(None表示不需要精确过滤)
+        """
+        scope = self.history_ranges[hr_key].scope
+        position = int(window[3] < scope.right) | int(window[2] > scope.left) << 1 | \
+                   int(window[1] < scope.up) << 2 | int(window[0] > scope.bottom) << 3
+        return self.range_query_hr_keys(hr_key, hr_data, position, window, gh1, gh2, is_scan)
+
+    @with_snapshot
+    def knn_query_single(self, knn, t_from=None, t_to=None):
+        """
+        :param t_from/t_to: 不为None时只在t_from <= t <= t_to的索引项中找k个最近的
+        """
+        return [key for dst, key in self.knn_query_dsts(knn, t_range=get_t_range(t_from, t_to))]
+
+    def knn_query_dsts(self, knn, dst_bound=math.inf, t_range=None):
+        """
+        best-first knn
+        1. 计算点到所有hr的最小距离，按距离从小到大遍历hr
+        2. 点所在hr中模型预测位置前后各取k个作为初始结果，放入大小为k的最大堆
+        3. hr的最小距离超过第k近的距离时停止，否则以第k近的距离为半径的window在hr中模型预测子范围，按距离过滤
         4. filter cr by mbr
-        耗时操作：knn_query_hr/nn predict/精确过滤: 6.1/30/40.5
+        优化: 初始window+knn_query_hr+每个hr后sorted(tp_list)[:k]->hr按最小距离best-first+最大堆，window随第k近的距离收紧
+        :param dst_bound: 距离平方的上界，已知其他索引中有k个不超过该距离的索引项时用于剪枝，超过的索引项可能不返回
+        :param t_range: [t_from, t_to]，不为None时只考虑t在t_range内的索引项，hr按每页的t的zone map跳过不相交的页
+        :return: 按(dst, key)排序的[(dst, key)]，dst为距离平方
         """
         x, y, k = knn
         k = int(k)
-        # 1. get the nearest key of query point
+        heap = []
+        # 1. 计算点到所有hr的最小距离
+        scopes = self.get_hr_scopes()
+        dxs = np.maximum(np.maximum(scopes[:, 2] - x, x - scopes[:, 3]), 0)
+        dys = np.maximum(np.maximum(scopes[:, 0] - y, y - scopes[:, 1]), 0)
+        hr_dsts = dxs ** 2 + dys ** 2
+        # 2. 点所在hr中模型预测位置前后各取k个作为初始结果
         qp_g = self.meta.geohash.encode(x, y)
         qp_hr_key = self.point_query_hr(qp_g)
         qp_hr = self.history_ranges[qp_hr_key]
-        qp_hr_data = self.index_entries[qp_hr_key]
-        if qp_hr.number == 0:
-            qp_ie_key = 0
-            tp_ie_list = []
-        else:
+        seed_l = seed_r = 0
+        self.read_hr(qp_hr_key)
+        if qp_hr.number:
+            qp_hr_data = self.index_entries[qp_hr_key]
+            self.read_model(qp_hr_key)
             pre = qp_hr.model_predict(qp_g)
             l_bound = max(pre - qp_hr.model.max_err, 0)
             r_bound = min(pre - qp_hr.model.min_err, qp_hr.max_key)
-            qp_ie_key = biased_search_almost(qp_hr_data, 2, qp_g, pre, l_bound, r_bound)[0]
-            tp_ie_list = [qp_hr_data[qp_ie_key]]
-        # 2. get the n points to create range query window
-        # 三种初始结果集选取方法：
-        # 1. 任意选k个
-        # 2. 点查询得到p，在p前后选k/2个
-        # 3. （当前所选方法）点查询得到p，在p前后选k个，dst（初始检索范围）变大，但是跳跃性的干扰变小
-        cur_ie_key = qp_ie_key + 1
-        cur_hr_data = qp_hr_data
-        cur_hr = qp_hr
-        cur_hr_key = qp_hr_key
-        i = k
-        while i > 0:
-            right_ie_len = cur_hr.number - cur_ie_key + 1
-            if right_ie_len >= i:
-                tp_ie_list.extend(cur_hr_data[cur_ie_key:cur_ie_key + i])
-                break
-            else:
-                tp_ie_list.extend(cur_hr_data[cur_ie_key:])
-                if cur_hr_key == self.meta.last_hr:
-                    break
-                i -= right_ie_len
-                cur_hr_key += 1
-                cur_hr_data = self.index_entries[cur_hr_key]
-                cur_hr = self.history_ranges[cur_hr_key]
-                cur_ie_key = 0
-        cur_ie_key = qp_ie_key
-        cur_hr_key = qp_hr_key
-        cur_hr_data = qp_hr_data
-        i = k
-        while i > 0:
-            left_ie_len = cur_ie_key
-            if left_ie_len >= i:
-                tp_ie_list.extend(cur_hr_data[cur_ie_key - i:cur_ie_key])
-                break
-            else:
-                tp_ie_list.extend(cur_hr_data[cur_ie_key - left_ie_len:cur_ie_key])
-                if cur_hr_key == 0:
-                    break
-                i -= left_ie_len
-                cur_hr_key -= 1
-                cur_hr_data = self.index_entries[cur_hr_key]
-                cur_ie_key = self.history_ranges[cur_hr_key].number
-        tp_list = sorted([[(tp_ie[0] - x) ** 2 + (tp_ie[1] - y) ** 2, tp_ie[4]] for tp_ie in tp_ie_list])[:k]
-        dst = tp_list[-1][0]
-        if dst == 0:
-            return [tp[1] for tp in tp_list]
-        dst_pow = dst ** 0.5
-        window = [y - dst_pow, y + dst_pow, x - dst_pow, x + dst_pow]
-        # 处理超出边界的情况
-        self.meta.geohash.region.clip_region(window, self.meta.geohash.data_precision)
-        gh1 = self.meta.geohash.encode(window[2], window[0])
-        gh2 = self.meta.geohash.encode(window[3], window[1])
-        tp_window_hrs = self.knn_query_hr(qp_hr_key, gh1, gh2, knn)
-        tp_list = []
-        for tp_window_hr in tp_window_hrs:
-            if tp_window_hr[2] > dst:
+            self.read_ies(qp_hr_key, l_bound, r_bound + 1)
+            qp_ie_key = searchsorted_almost(qp_hr_data['2'], qp_g, l_bound, r_bound)[0]
+            seed_l = max(qp_ie_key - k, 0)
+            seed_r = min(qp_ie_key + k + 1, qp_hr.number)
+            self.read_ies(qp_hr_key, seed_l, seed_r)
+            ies = qp_hr.live_entries(qp_hr_data[seed_l:seed_r], seed_l)
+            if t_range is not None:
+                ies = ies[(t_range[0] <= ies['3']) & (ies['3'] <= t_range[1])]
+            push_knn(heap, k, ies, x, y)
+        # 3. best-first遍历hr，初始结果已满k个时只需要排序最小距离不超过第k近的距离的hr
+        dst = min(-heap[0][0], dst_bound) if len(heap) == k else dst_bound
+        if dst != math.inf:
+            hr_order = np.flatnonzero(hr_dsts <= dst)
+            hr_order = hr_order[np.argsort(hr_dsts[hr_order], kind='stable')].tolist()
+        else:
+            hr_order = np.argsort(hr_dsts, kind='stable').tolist()
+        hr_dsts = hr_dsts.tolist()
+        radius = None
+        window = gh1 = gh2 = None
+        for hr_key in hr_order:
+            dst = min(-heap[0][0], dst_bound) if len(heap) == k else dst_bound
+            if hr_dsts[hr_key] > dst:
                 break
-            hr_key = tp_window_hr[0]
             hr = self.history_ranges[hr_key]
             if hr.number == 0:  # hr is empty
                 continue
-            position = tp_window_hr[1]
             hr_data = self.index_entries[hr_key]
-            if position == 0:  # window contain hr
-                tmp_list = [[(ie[0] - x) ** 2 + (ie[1] - y) ** 2, ie[4]] for ie in hr_data]
-                self.io_cost += math.ceil(len(hr_data) / ITEMS_PER_PAGE)
+            if dst == math.inf:
+                self.read_hr(hr_key)
+                if t_range is None:
+                    self.io_cost += math.ceil(hr.number / self.hr_items_per_page(hr_key))
+                    self.read_ies(hr_key, 0, hr.number)
+                left_key, right_key, compare_func = 0, hr.number, None
             else:
-                # wrong child hr from range_by_int
-                is_valid = valid_position_funcs[position](hr.scope, window)
-                if not is_valid:
-                    continue
-                gh_new1, gh_new2, compare_func = range_position_funcs[tp_window_hr[1]](hr.scope, window, gh1, gh2,
-                                                                                       self.meta.geohash)
-                if gh_new1:
-                    pre1 = hr.model_predict(gh_new1)
-                    l_bound1 = max(pre1 - hr.model.max_err, 0)
-                    r_bound1 = min(pre1 - hr.model.min_err, hr.max_key)
-                    left_key = min(biased_search_almost(hr_data, 2, gh_new1, pre1, l_bound1, r_bound1))
-                else:
-                    l_bound1 = 0
-                    left_key = 0
-                if gh_new2:
-                    pre2 = hr.model_predict(gh_new2)
-                    l_bound2 = max(pre2 - hr.model.max_err, 0)
-                    r_bound2 = min(pre2 - hr.model.min_err, hr.max_key)
-                    right_key = max(biased_search_almost(hr_data, 2, gh_new2, pre2, l_bound2, r_bound2)) + 1
-                else:
-                    r_bound2 = hr.number
-                    right_key = hr.number
-                # 3. filter point by distance
-                tmp_list = [[(ie[0] - x) ** 2 + (ie[1] - y) ** 2, ie[4]]
-                            for ie in hr_data[left_key:right_key] if compare_func(ie)]
-                self.io_cost += math.ceil((r_bound2 - l_bound1) / ITEMS_PER_PAGE)
-            if len(tmp_list) > 0:
-                tp_list.extend(tmp_list)
-                tp_list = sorted(tp_list)[:k]
-                dst = tp_list[-1][0]
+                if dst != radius:
+                    radius = dst
+                    dst_pow = dst ** 0.5
+                    window = [y - dst_pow, y + dst_pow, x - dst_pow, x + dst_pow]
+                    # 处理超出边界的情况
+                    self.meta.geohash.region.clip_region(window, self.meta.geohash.data_precision)
+                    gh1 = self.meta.geohash.encode(window[2], window[0])
+                    gh2 = self.meta.geohash.encode(window[3], window[1])
+                left_key, right_key, compare_func = self.knn_query_hr_scope(hr_key, hr_data, window, gh1, gh2,
+                                                                            t_range is None)
+            # 初始结果已经在堆中，跳过
+            if hr_key == qp_hr_key:
+                pieces = [(left_key, min(right_key, seed_l)), (max(left_key, seed_r), right_key)]
+            else:
+                pieces = [(left_key, right_key)]
+            for l_key, r_key in pieces:
+                if l_key < r_key:
+                    if t_range is None:
+                        ies = hr.live_entries(hr_data[l_key:r_key], l_key)
+                    else:
+                        ies = self.hr_time_entries(hr_key, l_key, r_key, t_range)
+                        if ies is None:
+                            continue
+                    if compare_func is not None:
+                        ies = ies[compare_func((ies['0'], ies['1']))]
+                    push_knn(heap, k, ies, x, y)
         # 4. filter cr by mbr
-        dst_pow = dst ** 0.5
+        dst_pow = (min(-heap[0][0], dst_bound) if len(heap) == k else dst_bound) ** 0.5
         window = [y - dst_pow, y + dst_pow, x - dst_pow, x + dst_pow]
-        for cr_key in range(self.meta.last_cr + 1):
-            cr = self.current_ranges[cr_key]
-            if cr.number:
-                pos = intersect(window, cr.value)
-                if pos == 0:
-                    continue
-                elif pos == 2:
-                    self.io_cost += math.ceil(cr.number / ITEMS_PER_PAGE)
-                    tp_list.extend([[(ie[0] - x) ** 2 + (ie[1] - y) ** 2, ie[4]]
-                                    for ie in self.index_entries[cr_key + 1 + self.meta.last_hr]])
-                else:
-                    self.io_cost += math.ceil(cr.number / ITEMS_PER_PAGE)
-                    tp_list.extend([[(ie[0] - x) ** 2 + (ie[1] - y) ** 2, ie[4]]
-                                    for ie in self.index_entries[cr_key + 1 + self.meta.last_hr]
-                                    if window[0] <= ie[1] <= window[1] and window[2] <= ie[0] <= window[3]])
-        tp_list = sorted(tp_list)[:k]
-        return [tp[1] for tp in tp_list]
+        self.read_crs()
+        for cr_key, is_contain in self.range_query_cr(window, t_range):
+            if self.current_ranges[cr_key].number:
+                push_knn(heap, k, np.array(self.range_query_cr_ies(cr_key, is_contain, window, 0, t_range),
+                                           dtype=IE_DTYPE), x, y)
+        # 5. filter tail
+        tail = [ie for ie in self.tail_entries() if window[0] <= ie[1] <= window[1] and window[2] <= ie[0] <= window[3]]
+        if t_range is not None:
+            tail = [ie for ie in tail if t_range[0] <= ie[3] <= t_range[1]]
+        push_knn(heap, k, np.array(tail, dtype=IE_DTYPE), x, y)
+        return [(-item[0], -item[1]) for item in sorted(heap, reverse=True)]
 
     def save(self):
         assert self.meta.threshold_number < 2 ** (16 - 1), "threshold_number exceed the store size int16"
-        slbrin_meta = np.array((self.meta.last_hr, self.meta.last_cr,
-                                self.meta.threshold_number, self.meta.threshold_length,
-                                self.meta.threshold_err, self.meta.threshold_summary, self.meta.threshold_merge,
-                                self.meta.geohash.data_precision,
-                                self.meta.geohash.region.bottom, self.meta.geohash.region.up,
-                                self.meta.geohash.region.left, self.meta.geohash.region.right,
-                                self.weight, self.train_step, self.batch_num, self.learning_rate),
-                               dtype=[("0", 'i4'), ("1", 'i4'), ("2", 'i2'), ("3", 'i2'), ("4", 'i2'), ("5", 'i2'),
-                                      ("6", 'i2'), ("7", 'i1'),
-                                      ("8", 'f8'), ("9", 'f8'), ("10", 'f8'), ("11", 'f8'),
-                                      ("12", 'f4'), ("13", 'i2'), ("14", 'i2'), ("15", 'f4')])
-        slbrin_models = np.array([hr.model for hr in self.history_ranges])
-        slbrin_hrs = np.array([(hr.value, hr.length, hr.number, hr.state, hr.value_diff,
-                                hr.scope.bottom, hr.scope.up, hr.scope.left, hr.scope.right)
-                               for hr in self.history_ranges],
-                              dtype=[("0", 'i8'), ("1", 'i1'), ("2", 'i2'), ("3", 'i1'), ("4", 'i8'),
-                                     ("5", 'f8'), ("6", 'f8'), ("7", 'f8'), ("8", 'f8')])
+        np.save(os.path.join(self.model_path, 'slbrin_meta.npy'), self.meta_array())
+        np.save(os.path.join(self.model_path, 'slbrin_model_cores.npy'), self.cores)
+        np.save(os.path.join(self.model_path, 'slbrin_hrs.npy'), self.hrs_array())
+        np.save(os.path.join(self.model_path, 'slbrin_models.npy'), np.array([hr.model for hr in self.history_ranges]))
+        np.save(os.path.join(self.model_path, 'slbrin_crs.npy'), self.crs_array())
+        codecs_path = os.path.join(self.model_path, 'slbrin_hr_codecs.npy')
+        pages_path = os.path.join(self.model_path, 'slbrin_hr_pages.npy')
+        if self.compression:
+            # hr部分按压缩页写入slbrin_hr_pages.npy，slbrin_data.npy只有cr部分
+            codecs = np.array([self.get_hr_codec(hr_key) for hr_key in range(self.meta.last_hr + 1)],
+                              dtype=CODEC_DTYPE)
+            pages = [encode_pages(self.index_entries[hr_key], codecs[hr_key], self.meta.geohash)
+                     for hr_key in range(self.meta.last_hr + 1)]
+            np.save(codecs_path, codecs)
+            np.save(pages_path, np.concatenate(pages))
+            range_entries = self.index_entries[self.meta.last_hr + 1:]
+        else:
+            for path in (codecs_path, pages_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            range_entries = self.index_entries
+        # hr部分本身是结构化数组，cr部分是list，统一转为IE_DTYPE后拼接
+        index_entries = np.concatenate([np.array(ies, dtype=IE_DTYPE) for ies in range_entries])
+        np.save(os.path.join(self.model_path, 'slbrin_data.npy'), index_entries)
+        # tombstone按hr的顺序拼接后写入slbrin_tombstones.npy，save不压缩hr，没有删除时不写该文件
+        tombstones_path = os.path.join(self.model_path, 'slbrin_tombstones.npy')
+        if any(hr.tombstones is not None for hr in self.history_ranges):
+            np.save(tombstones_path, np.concatenate([np.zeros(hr.number, dtype=bool) if hr.tombstones is None
+                                                     else hr.tombstones for hr in self.history_ranges]))
+        elif os.path.exists(tombstones_path):
+            os.remove(tombstones_path)
+
+    def load(self, mmap=False):
+        """
+        mmap=True时slbrin_data.npy以只读内存映射打开，hr的ies为映射上的视图，查询只读入实际访问的页
+        hr的ies在merge时会被替换为内存中的新数组，不会写回文件
+        hr按压缩页保存时，mmap=True时slbrin_hr_pages.npy也以只读内存映射打开，每个hr在第一次访问时才解码为内存中的结构化数组
+        优化: load时解码所有hr->第一次访问时解码，只解码查询实际访问的hr
+        """
+        slbrin_meta = np.load(os.path.join(self.model_path, 'slbrin_meta.npy'), allow_pickle=True).item()
+        slbrin_hrs = np.load(os.path.join(self.model_path, 'slbrin_hrs.npy'), allow_pickle=True)
+        slbrin_models = np.load(os.path.join(self.model_path, 'slbrin_models.npy'), allow_pickle=True)
+        slbrin_crs = np.load(os.path.join(self.model_path, 'slbrin_crs.npy'), allow_pickle=True)
+        if mmap:
+            index_entries = np.load(os.path.join(self.model_path, 'slbrin_data.npy'), mmap_mode='r')
+        else:
+            index_entries = np.load(os.path.join(self.model_path, 'slbrin_data.npy'), allow_pickle=True)
+        self.cores = np.load(os.path.join(self.model_path, 'slbrin_model_cores.npy'), allow_pickle=True).tolist()
+        self.load_structure(slbrin_meta, slbrin_hrs, slbrin_models, slbrin_crs)
+        codecs_path = os.path.join(self.model_path, 'slbrin_hr_codecs.npy')
+        self.set_compression(os.path.exists(codecs_path))
+        self.index_entries = []
+        offset = 0
+        if self.compression:
+            self.index_entries = IndexEntries()
+            codecs = np.load(codecs_path)
+            pages = np.load(os.path.join(self.model_path, 'slbrin_hr_pages.npy'), mmap_mode='r' if mmap else None)
+            page_offset = 0
+            for hr, codec in zip(self.history_ranges, codecs):
+                page_num = math.ceil(hr.number / codec['items_per_page'])
+                self.index_entries.append(EncodedEntries(pages[page_offset:page_offset + page_num], codec, hr.number,
+                                                         self.meta.geohash))
+                hr.codec = codec
+                page_offset += page_num
+        else:
+            # 构建hr部分的ies: 直接使用结构化数组的视图，不再tolist
+            for hr in self.history_ranges:
+                self.index_entries.append(index_entries[offset:offset + hr.number])
+                offset += hr.number
+        # 构建cr部分的ies
+        for cr in self.current_ranges:
+            self.index_entries.append(index_entries[offset:offset + cr.number].tolist())
+            offset += cr.number
+        # 恢复hr的tombstone
+        tombstones_path = os.path.join(self.model_path, 'slbrin_tombstones.npy')
+        if os.path.exists(tombstones_path):
+            tombstones = np.load(tombstones_path)
+            offset = 0
+            for hr in self.history_ranges:
+                hr_tombstones = tombstones[offset:offset + hr.number]
+                offset += hr.number
+                deleted_number = int(np.count_nonzero(hr_tombstones))
+                if deleted_number:
+                    hr.tombstones = hr_tombstones.copy()
+                    hr.deleted_number = deleted_number
+
+    def meta_array(self):
+        return np.array((self.meta.last_hr, self.meta.last_cr,
+                         self.meta.threshold_number, self.meta.threshold_length,
+                         self.meta.threshold_err, self.meta.threshold_summary, self.meta.threshold_merge,
+                         self.meta.geohash.data_precision,
+                         self.meta.geohash.region.bottom, self.meta.geohash.region.up,
+                         self.meta.geohash.region.left, self.meta.geohash.region.right,
+                         self.weight, self.train_step, self.batch_num, self.learning_rate,
+                         self.meta.geohash.name),
+                        dtype=[("0", 'i4'), ("1", 'i4'), ("2", 'i2'), ("3", 'i2'), ("4", 'i2'), ("5", 'i2'),
+                               ("6", 'i2'), ("7", 'i1'),
+                               ("8", 'f8'), ("9", 'f8'), ("10", 'f8'), ("11", 'f8'),
+                               ("12", 'f4'), ("13", 'i2'), ("14", 'i2'), ("15", 'f4'),
+                               ("16", 'U16')])
+
+    def hrs_array(self):
+        return np.array([(hr.value, hr.length, hr.number, hr.state, hr.value_diff,
+                          hr.scope.bottom, hr.scope.up, hr.scope.left, hr.scope.right)
+                         for hr in self.history_ranges],
+                        dtype=[("0", 'i8'), ("1", 'i1'), ("2", 'i2'), ("3", 'i1'), ("4", 'i8'),
+                               ("5", 'f8'), ("6", 'f8'), ("7", 'f8'), ("8", 'f8')])
+
+    def crs_array(self):
         slbrin_crs = []
         for cr in self.current_ranges:
             if cr.value is None:
@@ -806,59 +1813,187 @@ class SLBRIN(SpatialIndex):
             else:
                 cr_list = [cr.value[0], cr.value[1], cr.value[2], cr.value[3], cr.number, cr.state]
             slbrin_crs.append(tuple(cr_list))
-        slbrin_crs = np.array(slbrin_crs, dtype=[("0", 'f8'), ("1", 'f8'), ("2", 'f8'), ("3", 'f8'),
-                                                 ("4", 'i2'), ("5", 'i1')])
-        np.save(os.path.join(self.model_path, 'slbrin_meta.npy'), slbrin_meta)
-        np.save(os.path.join(self.model_path, 'slbrin_model_cores.npy'), self.cores)
-        np.save(os.path.join(self.model_path, 'slbrin_hrs.npy'), slbrin_hrs)
-        np.save(os.path.join(self.model_path, 'slbrin_models.npy'), slbrin_models)
-        np.save(os.path.join(self.model_path, 'slbrin_crs.npy'), slbrin_crs)
-        index_entries = []
-        for ies in self.index_entries:
-            index_entries.extend(ies)
-        index_entries = np.array(index_entries, dtype=[("0", 'f8'), ("1", 'f8'), ("2", 'i8'), ("3", 'i4'), ("4", 'i4')])
-        np.save(os.path.join(self.model_path, 'slbrin_data.npy'), index_entries)
+        return np.array(slbrin_crs, dtype=[("0", 'f8'), ("1", 'f8'), ("2", 'f8'), ("3", 'f8'),
+                                           ("4", 'i2'), ("5", 'i1')])
 
-    def load(self):
-        slbrin_meta = np.load(os.path.join(self.model_path, 'slbrin_meta.npy'), allow_pickle=True).item()
-        slbrin_hrs = np.load(os.path.join(self.model_path, 'slbrin_hrs.npy'), allow_pickle=True)
-        slbrin_models = np.load(os.path.join(self.model_path, 'slbrin_models.npy'), allow_pickle=True)
-        slbrin_crs = np.load(os.path.join(self.model_path, 'slbrin_crs.npy'), allow_pickle=True)
-        index_entries = np.load(os.path.join(self.model_path, 'slbrin_data.npy'), allow_pickle=True)
+    def load_structure(self, slbrin_meta, slbrin_hrs, slbrin_models, slbrin_crs):
+        """
+        由meta_array/hrs_array/crs_array保存的数组恢复meta/hr/cr，index entries由调用方构建
+        """
         region = Region(slbrin_meta[8], slbrin_meta[9], slbrin_meta[10], slbrin_meta[11])
-        geohash = Geohash.init_by_precision(data_precision=slbrin_meta[7], region=region)
+        # 没有记录曲线的旧版本meta为Geohash
+        curve = curves[slbrin_meta[16]] if len(slbrin_meta) > 16 else Geohash
+        geohash = curve.init_by_precision(data_precision=slbrin_meta[7], region=region)
         self.meta = Meta(slbrin_meta[0], slbrin_meta[1], slbrin_meta[2], slbrin_meta[3], slbrin_meta[4], slbrin_meta[5],
                          slbrin_meta[6], geohash)
-        self.cores = np.load(os.path.join(self.model_path, 'slbrin_model_cores.npy'), allow_pickle=True).tolist()
         self.weight = slbrin_meta[12]
         self.train_step = slbrin_meta[13]
         self.batch_num = slbrin_meta[14]
         self.learning_rate = slbrin_meta[15]
-        # length从int32转int，不然位运算时候会超出限制变为负数
+        # length从int32转int，不然位运算时候会超出限制变为负数；number同理，不然累加offset时会溢出int16
         self.history_ranges = [
-            HistoryRange(slbrin_hrs[i][0], int(slbrin_hrs[i][1]), slbrin_hrs[i][2], slbrin_models[i], slbrin_hrs[i][3],
-                         Region(slbrin_hrs[i][5], slbrin_hrs[i][6], slbrin_hrs[i][7], slbrin_hrs[i][8]),
+            HistoryRange(slbrin_hrs[i][0], int(slbrin_hrs[i][1]), int(slbrin_hrs[i][2]), slbrin_models[i],
+                         slbrin_hrs[i][3], Region(slbrin_hrs[i][5], slbrin_hrs[i][6], slbrin_hrs[i][7], slbrin_hrs[i][8]),
                          slbrin_hrs[i][4]) for i in range(len(slbrin_hrs))]
+        for hr in self.history_ranges:
+            hr.model.compile()
+        self.hr_scopes = None
+        self.hr_directory = None
+        self.ie_offsets = None
         crs = []
         for i in range(len(slbrin_crs)):
             cr = slbrin_crs[i]
             if cr[0] == -1:
                 region = None
             else:
-                region = cr[:4]
-            crs.append(CurrentRange(region, cr[4], cr[5]))
+                region = [cr[0], cr[1], cr[2], cr[3]]
+            crs.append(CurrentRange(region, int(cr[4]), cr[5]))
         self.current_ranges = crs
-        index_entries = index_entries.tolist()
-        # 构建hr部分的ies
+        self.update_cr_mbrs()
+        self.cr_offset = 0
+        if self.query_cache is not None:
+            self.query_cache.clear()
+
+    def wal_path(self, wal_id):
+        return os.path.join(self.model_path, 'slbrin_wal_%d.bin' % wal_id)
+
+    def segment_path(self, segment, suffix=''):
+        return os.path.join(self.model_path, 'slbrin_segments', 'hr_%d%s.npy' % (segment, suffix))
+
+    def open_wal(self):
+        """
+        打开当前的wal，之后的insert/delete在修改索引前先记录到wal
+        """
+        if self.wal_file is None:
+            self.wal_file = open(self.wal_path(self.wal_id), 'ab')
+
+    def close_wal(self):
+        if self.wal_file is None:
+            return
+        with self.tail_lock:
+            self.flush_wal()
+            self.wal_file.close()
+            self.wal_file = None
+
+    def log_wal(self, ies, op):
+        """
+        把索引项记录到wal_buffer，满ts_summary条时group commit
+        调用方持有tail_lock，或者没有后台维护线程
+        """
+        if self.wal_file is None:
+            return
+        self.wal_buffer.extend(ie + (op,) for ie in ies)
+        if len(self.wal_buffer) >= self.meta.threshold_summary:
+            self.flush_wal()
+
+    def flush_wal(self):
+        """
+        把wal_buffer写入wal并fsync，崩溃时只会丢失最后一次group commit之后的记录
+        需要立即持久化时可以在插入后直接调用
+        """
+        if self.wal_file is None or not self.wal_buffer:
+            return
+        self.wal_file.write(np.array(self.wal_buffer, dtype=WAL_DTYPE).tobytes())
+        self.wal_file.flush()
+        os.fsync(self.wal_file.fileno())
+        self.wal_buffer = []
+
+    def checkpoint(self):
+        """
+        增量持久化，和save的全量文件互相独立
+        1. 压缩tombstone，segment为None的hr把index entries和model写入新编号的segment文件，其他hr的segment不变
+        2. 切换到新的wal，把meta/hr目录/cr/cr和tail的index entries写入临时文件，再原子替换slbrin_checkpoint.npz
+        3. 删除旧的wal和不再被引用的segment
+        新segment不覆盖旧文件，替换前旧checkpoint和旧wal始终完整，任意时刻崩溃都能recover
+        优化: 每次save重写全部hr和index entries->只重写合并/分裂/重训练/压缩过的hr
+        """
+        assert self.meta.threshold_number < 2 ** (16 - 1), "threshold_number exceed the store size int16"
+        with self.lock:
+            # 1. write dirty hrs into new segments
+            for hr_key in range(self.meta.last_hr + 1):
+                self.compact_hr(hr_key)
+            os.makedirs(os.path.join(self.model_path, 'slbrin_segments'), exist_ok=True)
+            for hr_key in range(self.meta.last_hr + 1):
+                hr = self.history_ranges[hr_key]
+                if hr.segment is None:
+                    save_durable(self.segment_path(self.next_segment), self.index_entries[hr_key])
+                    save_durable(self.segment_path(self.next_segment, '_model'), np.array([hr.model], dtype=object))
+                    hr.segment = self.next_segment
+                    self.next_segment += 1
+            # 2. switch wal and write checkpoint
+            # 切换wal和复制tail在tail_lock内完成，之后的插入只会出现在新的wal中
+            with self.tail_lock:
+                self.flush_wal()
+                old_wal_id = self.wal_id
+                self.wal_id += 1
+                if self.wal_file is not None:
+                    self.wal_file.close()
+                    self.wal_file = open(self.wal_path(self.wal_id), 'ab')
+                tail = self.tail[:]
+            cr_data = [ie for ies in self.index_entries[self.meta.last_hr + 1:] for ie in ies]
+            checkpoint_path = os.path.join(self.model_path, 'slbrin_checkpoint.npz')
+            with open(checkpoint_path + '.tmp', 'wb') as f:
+                np.savez(f, meta=self.meta_array(), cores=np.array(self.cores), hrs=self.hrs_array(),
+                         crs=self.crs_array(), cr_data=np.array(cr_data, dtype=IE_DTYPE),
+                         tail=np.array(tail, dtype=IE_DTYPE),
+                         segments=np.array([hr.segment for hr in self.history_ranges], dtype=np.int64),
+                         state=np.array([self.wal_id, self.next_segment], dtype=np.int64))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(checkpoint_path + '.tmp', checkpoint_path)
+            fsync_dir(self.model_path)
+            # 3. remove old wal and unreferenced segments
+            if os.path.exists(self.wal_path(old_wal_id)):
+                os.remove(self.wal_path(old_wal_id))
+            segments = set(hr.segment for hr in self.history_ranges)
+            segment_dir = os.path.join(self.model_path, 'slbrin_segments')
+            for file_name in os.listdir(segment_dir):
+                if int(file_name[3:-4].split('_')[0]) not in segments:
+                    os.remove(os.path.join(segment_dir, file_name))
+
+    def recover(self, mmap=False):
+        """
+        从slbrin_checkpoint.npz和hr的segment恢复，再重放wal中checkpoint之后的insert/delete，最后打开wal继续记录
+        mmap=True时segment以只读内存映射打开，和load一致
+        """
+        assert self.wal_file is None, "close wal before recover"
+        checkpoint = np.load(os.path.join(self.model_path, 'slbrin_checkpoint.npz'), allow_pickle=True)
+        segments = checkpoint['segments'].tolist()
+        slbrin_models = [np.load(self.segment_path(segment, '_model'), allow_pickle=True)[0] for segment in segments]
+        self.cores = checkpoint['cores'].tolist()
+        self.load_structure(checkpoint['meta'].item(), checkpoint['hrs'], slbrin_models, checkpoint['crs'])
+        self.wal_id, self.next_segment = checkpoint['state'].tolist()
         self.index_entries = []
+        for hr, segment in zip(self.history_ranges, segments):
+            hr.segment = segment
+            if mmap:
+                self.index_entries.append(np.load(self.segment_path(segment), mmap_mode='r'))
+            else:
+                self.index_entries.append(np.load(self.segment_path(segment)))
+        cr_data = checkpoint['cr_data']
         offset = 0
-        for hr in self.history_ranges:
-            self.index_entries.append(index_entries[offset:offset + hr.number])
-            offset += hr.number
-        # 构建cr部分的ies
         for cr in self.current_ranges:
-            self.index_entries.append(index_entries[offset:offset + cr.number])
+            self.index_entries.append(cr_data[offset:offset + cr.number].tolist())
             offset += cr.number
+        self.tail = []
+        self.wal_buffer = []
+        # checkpoint时还在tail中的索引项先于wal中的记录
+        for point in checkpoint['tail'].tolist():
+            self.insert_cr(point)
+        # replay wal
+        wal_path = self.wal_path(self.wal_id)
+        if os.path.exists(wal_path):
+            # 崩溃时最后一条记录可能只写了一部分，截掉
+            wal_size = os.path.getsize(wal_path)
+            with open(wal_path, 'r+b') as f:
+                f.truncate(wal_size - wal_size % np.dtype(WAL_DTYPE).itemsize)
+            for record in np.fromfile(wal_path, dtype=WAL_DTYPE).tolist():
+                if record[5]:
+                    self.insert_cr(record[:5])
+                else:
+                    self.delete((record[0], record[1], record[3], record[4]))
+        self.post_retrain_inefficient_model()
+        self.open_wal()
 
     def size(self):
         """
@@ -877,13 +2012,21 @@ class SLBRIN(SpatialIndex):
         # hr只存value/length/number/*model/state=hr_len*(8+1+2+4+1)=hr_len*16
         # cr只存value/number/state=cr_len*(8*4+2+1)=cr_len*35
         # index_entries为data_len*(8*3+4)=data_len*28
-        data_len = sum([hr.number for hr in self.history_ranges]) + sum([cr.number for cr in self.current_ranges])
+        # 压缩时hr部分为压缩页=hr_page_len*PAGE_SIZE，每个hr的压缩参数为CODEC_DTYPE=hr_len*41
         hr_len = self.meta.last_hr + 1
         cr_len = self.meta.last_cr + 1
+        if self.compression:
+            hr_page_len = sum([math.ceil(self.history_ranges[hr_key].number / self.hr_items_per_page(hr_key))
+                               for hr_key in range(hr_len)])
+            data_size = hr_len * np.dtype(CODEC_DTYPE).itemsize + hr_page_len * PAGE_SIZE + \
+                        sum([cr.number for cr in self.current_ranges]) * ITEM_SIZE
+        else:
+            data_len = sum([hr.number for hr in self.history_ranges]) + sum([cr.number for cr in self.current_ranges])
+            data_size = data_len * ITEM_SIZE
         return 19 + \
                hr_len * 16 + \
                os.path.getsize(os.path.join(self.model_path, "slbrin_models.npy")) - 128 + \
-               cr_len * 35, data_len * ITEM_SIZE
+               cr_len * 35, data_size
 
     def model_clear(self):
         """
@@ -928,6 +2071,7 @@ valid_position_funcs = [
     window[2] <= reg.right and window[0] <= reg.up and reg.bottom <= window[1],
     lambda reg, window:  # bottom-up-left-right
     window[2] <= reg.right and reg.left <= window[3] and window[0] <= reg.up and reg.bottom <= window[1]]
+# compare_func的x为(xs, ys)，用&代替and，同时支持标量和numpy列
 range_position_funcs = [
     lambda reg, window, gh1, gh2, geohash: (None, None, None),
     lambda reg, window, gh1, gh2, geohash: (  # right
@@ -941,7 +2085,7 @@ range_position_funcs = [
     lambda reg, window, gh1, gh2, geohash: (  # left-right
         geohash.encode(window[2], reg.bottom),
         geohash.encode(window[3], reg.up),
-        lambda x: window[2] <= x[0] <= window[3]),
+        lambda x: (window[2] <= x[0]) & (x[0] <= window[3])),
     lambda reg, window, gh1, gh2, geohash: (  # up
         None,
         geohash.encode(reg.right, window[1]),
@@ -949,15 +2093,15 @@ range_position_funcs = [
     lambda reg, window, gh1, gh2, geohash: (  # up-right
         None,
         gh2,
-        lambda x: window[3] >= x[0] and window[1] >= x[1]),
+        lambda x: (window[3] >= x[0]) & (window[1] >= x[1])),
     lambda reg, window, gh1, gh2, geohash: (  # up-left
         geohash.encode(window[2], reg.bottom),
         geohash.encode(reg.right, window[1]),
-        lambda x: window[2] <= x[0] and window[1] >= x[1]),
+        lambda x: (window[2] <= x[0]) & (window[1] >= x[1])),
     lambda reg, window, gh1, gh2, geohash: (  # up-left-right
         geohash.encode(window[2], reg.bottom),
         gh2,
-        lambda x: window[2] <= x[0] <= window[3] and window[1] >= x[1]),
+        lambda x: (window[2] <= x[0]) & (x[0] <= window[3]) & (window[1] >= x[1])),
     lambda reg, window, gh1, gh2, geohash: (  # bottom
         geohash.encode(reg.left, window[0]),
         None,
@@ -965,31 +2109,162 @@ range_position_funcs = [
     lambda reg, window, gh1, gh2, geohash: (  # bottom-right
         geohash.encode(reg.left, window[0]),
         geohash.encode(window[3], reg.up),
-        lambda x: window[3] >= x[0] and window[0] <= x[1]),
+        lambda x: (window[3] >= x[0]) & (window[0] <= x[1])),
     lambda reg, window, gh1, gh2, geohash: (  # bottom-left
         gh1,
         None,
-        lambda x: window[2] <= x[0] and window[0] <= x[1]),
+        lambda x: (window[2] <= x[0]) & (window[0] <= x[1])),
     lambda reg, window, gh1, gh2, geohash: (  # bottom-left-right
         gh1,
         geohash.encode(window[3], reg.up),
-        lambda x: window[2] <= x[0] <= window[3] and window[0] <= x[1]),
+        lambda x: (window[2] <= x[0]) & (x[0] <= window[3]) & (window[0] <= x[1])),
     lambda reg, window, gh1, gh2, geohash: (  # bottom-up
         geohash.encode(reg.left, window[0]),
         geohash.encode(reg.right, window[1]),
-        lambda x: window[0] <= x[1] <= window[1]),
+        lambda x: (window[0] <= x[1]) & (x[1] <= window[1])),
     lambda reg, window, gh1, gh2, geohash: (  # bottom-up-right
         geohash.encode(reg.left, window[0]),
         gh2,
-        lambda x: window[3] >= x[0] and window[0] <= x[1] <= window[1]),
+        lambda x: (window[3] >= x[0]) & (window[0] <= x[1]) & (x[1] <= window[1])),
     lambda reg, window, gh1, gh2, geohash: (  # bottom-up-left
         gh1,
         geohash.encode(reg.right, window[1]),
-        lambda x: window[2] <= x[0] and window[0] <= x[1] <= window[1]),
+        lambda x: (window[2] <= x[0]) & (window[0] <= x[1]) & (x[1] <= window[1])),
     lambda reg, window, gh1, gh2, geohash: (  # bottom-up-left-right
         gh1,
         gh2,
-        lambda x: window[2] <= x[0] <= window[3] and window[0] <= x[1] <= window[1])]
+        lambda x: (window[2] <= x[0]) & (x[0] <= window[3]) & (window[0] <= x[1]) & (x[1] <= window[1]))]
+
+
+def ies_distance(ies, x, y):
+    """
+    计算结构化数组ies到(x, y)的距离平方，返回[(dst, key)]
+    """
+    return list(zip(((ies['0'] - x) ** 2 + (ies['1'] - y) ** 2).tolist(), ies['4'].tolist()))
+
+
+def push_knn(heap, k, ies, x, y):
+    """
+    把结构化数组ies到(x, y)的距离放入大小为k的最大堆heap
+    堆中为(-dst, -key)，最终结果和sorted([(dst, key)])[:k]一致
+    """
+    if len(ies) == 0:
+        return
+    dsts = (ies['0'] - x) ** 2 + (ies['1'] - y) ** 2
+    keys = ies['4']
+    if len(heap) == k:
+        # 优化: 先在列上过滤掉比第k近还远的索引项
+        in_heap = dsts <= -heap[0][0]
+        dsts = dsts[in_heap]
+        keys = keys[in_heap]
+    for dst, key in zip(dsts.tolist(), keys.tolist()):
+        item = (-dst, -key)
+        if len(heap) < k:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+
+def get_codec(ies, geohash):
+    """
+    hr的index entries的压缩参数
+    1. x/y按data_precision量化为整数，存相对hr内最小值的偏移，geohash由量化前的坐标重新计算，不存储
+    2. t/key存相对hr内最小值的偏移(frame of reference)
+    3. 每项按x/y/t/key的位宽打包，每页的索引项数量=PAGE_SIZE*8/每项的位数
+    坐标不能无损量化或geohash和坐标不一致时is_packed=0，按IE_DTYPE原样存储
+    """
+    codec = np.zeros(1, dtype=CODEC_DTYPE)[0]
+    codec['items_per_page'] = PAGE_SIZE // np.dtype(IE_DTYPE).itemsize
+    if len(ies) == 0:
+        return codec
+    scale = 10 ** geohash.data_precision
+    xs = np.rint(ies['0'] * scale).astype(np.int64)
+    ys = np.rint(ies['1'] * scale).astype(np.int64)
+    if not (np.array_equal(xs / scale, ies['0']) and np.array_equal(ys / scale, ies['1']) and
+            np.array_equal(geohash.encode_batch(xs / scale, ys / scale), ies['2'])):
+        return codec
+    for name, column in zip(('x', 'y', 't', 'key'), (xs, ys, ies['3'], ies['4'])):
+        codec[name + '_min'] = column.min()
+        codec[name + '_bits'] = (int(column.max()) - int(column.min())).bit_length()
+    codec['is_packed'] = 1
+    codec['items_per_page'] = PAGE_SIZE * 8 // sum(get_codec_widths(codec))
+    return codec
+
+
+def get_codec_widths(codec):
+    # 至少1位，避免所有列的位宽都为0
+    return [int(codec['x_bits']), int(codec['y_bits']), int(codec['t_bits']), max(int(codec['key_bits']), 1)]
+
+
+def encode_pages(ies, codec, geohash):
+    """
+    按codec把hr的index entries编码为shape为(页数量, PAGE_SIZE)的uint8数组
+    """
+    items_per_page = int(codec['items_per_page'])
+    if len(ies) == 0:
+        return np.zeros((0, PAGE_SIZE), dtype=np.uint8)
+    if not codec['is_packed']:
+        page_num = math.ceil(len(ies) / items_per_page)
+        raw = np.zeros(page_num * items_per_page, dtype=IE_DTYPE)
+        raw[:len(ies)] = ies
+        pages = np.zeros((page_num, PAGE_SIZE), dtype=np.uint8)
+        pages[:, :items_per_page * raw.dtype.itemsize] = raw.view(np.uint8).reshape(page_num, -1)
+        return pages
+    scale = 10 ** geohash.data_precision
+    return pack_bits([np.rint(ies['0'] * scale).astype(np.int64) - codec['x_min'],
+                      np.rint(ies['1'] * scale).astype(np.int64) - codec['y_min'],
+                      ies['3'].astype(np.int64) - codec['t_min'],
+                      ies['4'].astype(np.int64) - codec['key_min']],
+                     get_codec_widths(codec), items_per_page, PAGE_SIZE)
+
+
+def decode_pages(pages, codec, number, geohash):
+    """
+    encode_pages的逆过程，pages为hr的全部或部分页，返回其中前number个索引项
+    """
+    items_per_page = int(codec['items_per_page'])
+    if not codec['is_packed']:
+        raw = np.ascontiguousarray(pages[:, :items_per_page * np.dtype(IE_DTYPE).itemsize])
+        return raw.view(IE_DTYPE).reshape(-1)[:number].copy()
+    xs, ys, ts, keys = unpack_bits(np.asarray(pages), get_codec_widths(codec), items_per_page, number)
+    scale = 10 ** geohash.data_precision
+    ies = np.empty(number, dtype=IE_DTYPE)
+    ies['0'] = (xs + codec['x_min']) / scale
+    ies['1'] = (ys + codec['y_min']) / scale
+    ies['2'] = geohash.encode_batch(ies['0'], ies['1'])
+    ies['3'] = ts + codec['t_min']
+    ies['4'] = keys + codec['key_min']
+    return ies
+
+
+def get_t_range(t_from, t_to):
+    """
+    时空查询的[t_from, t_to]，都为None时返回None表示不按时间过滤，只有一端为None时另一端不限
+    """
+    if t_from is None and t_to is None:
+        return None
+    return [-math.inf if t_from is None else t_from, math.inf if t_to is None else t_to]
+
+
+def save_durable(path, array):
+    """
+    np.save并fsync，保证返回时文件已经落盘
+    """
+    with open(path, 'wb') as f:
+        np.save(f, array)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def fsync_dir(path):
+    """
+    fsync目录，保证目录中文件的创建/替换已经落盘
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
 # for train
@@ -1009,6 +2284,48 @@ def build_nn(model_path, model_key, inputs, labels, is_new, is_simple, weight, c
     tmp_dict[model_key] = abstract_index
 
 
+def train_hr(inputs, labels, model_path, model_key, value, value_diff, is_new, is_simple, weight, core, train_step,
+             batch_num, learning_rate, use_threshold, threshold, retrain_time_limit):
+    """
+    TrainPool的任务：inputs为hr的geohash列在共享内存上的切片，labels不使用
+    """
+    # 训练数据为左下角点+分区数据+右上角点
+    inputs = inputs.tolist()
+    inputs.insert(0, value)
+    inputs.append(value + value_diff)
+    data_num = len(inputs)
+    labels = list(range(data_num))
+    batch_size = 2 ** math.ceil(math.log(data_num / batch_num, 2))
+    if batch_size < 1:
+        batch_size = 1
+    tmp_dict = {}
+    build_nn(model_path, model_key, inputs, labels, is_new, is_simple, weight, core, train_step, batch_size,
+             learning_rate, use_threshold, threshold, retrain_time_limit, tmp_dict)
+    return tmp_dict[model_key]
+
+
+def fit_spline(inputs, value, value_diff, err):
+    """
+    用误差有界的分段线性样条拟合hr，输入输出的归一化和nn一致，err为key的误差上限
+    """
+    number = len(inputs)
+    max_key = number - 1
+    xs = (np.asarray(inputs) - value) / value_diff - 0.5
+    if max_key > 0:
+        spline = ErrorBoundedSpline.fit(xs, np.arange(number) / max_key, err / max_key)
+    else:
+        spline = ErrorBoundedSpline.fit(xs, np.zeros(number), 0)
+    model = AbstractSpline(spline, 0, 0, err)
+    if number:
+        pres = spline.predicts(xs)
+        pres[pres < 0] = 0
+        pres[pres > 1] = 1
+        errs = pres * max_key - np.arange(number)
+        model.min_err = math.floor(errs.min())
+        model.max_err = math.ceil(errs.max())
+    return model
+
+
 class Meta:
     def __init__(self, last_hr, last_cr, threshold_number, threshold_length, threshold_err, threshold_summary,
                  threshold_merge, geohash):
@@ -1023,9 +2340,46 @@ class Meta:
         self.threshold_merge = threshold_merge
         # self.L = L  # geohash.sum_bits
         # For compute
+        # geohash: 构建时选择的空间填充曲线(Geohash/Hilbert)，name随meta保存
         self.geohash = geohash
 
 
+class EncodedEntries:
+    """
+    按压缩页保存、还没有解码的hr的index entries
+    """
+
+    def __init__(self, pages, codec, number, geohash):
+        self.pages = pages
+        self.codec = codec
+        self.number = number
+        self.geohash = geohash
+
+    def decode(self):
+        return decode_pages(self.pages, self.codec, self.number, self.geohash)
+
+
+class IndexEntries(list):
+    """
+    index entries的list，EncodedEntries在第一次访问时解码并替换为结构化数组
+    """
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            for i in range(*key.indices(len(self))):
+                self[i]
+            return super().__getitem__(key)
+        value = super().__getitem__(key)
+        if isinstance(value, EncodedEntries):
+            value = value.decode()
+            super().__setitem__(key, value)
+        return value
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
 class HistoryRange:
     def __init__(self, value, length, number, model, state, scope, value_diff):
         # BRIN
@@ -1039,25 +2393,60 @@ class HistoryRange:
         self.scope = scope
         self.value_diff = value_diff
         self.max_key = number - 1
+        # For delete: 和index entries对齐的bool数组，True为已删除；没有删除时为None
+        self.tombstones = None
+        self.deleted_number = 0
+        # For persistence: checkpoint中index entries和model所在的segment编号；被修改过（dirty）时为None
+        self.segment = None
+        # For query cache: index entries/tombstones/model变化时加1，query_cache中version不同的hr结果失效
+        self.version = 0
+        # For spatio-temporal query: index entries每页的t的zone map，shape为(页数量, 2)，每行为[min t, max t]
+        # index entries变化时置为None，使用时重建
+        self.t_blocks = None
+        # For compression: CODEC_DTYPE的压缩参数，index entries变化时置为None，使用时重建
+        self.codec = None
+
+    def live_entries(self, ies, offset):
+        """
+        过滤掉已删除的索引项，ies为hr的index entries从offset开始的切片
+        """
+        if self.tombstones is None:
+            return ies
+        return ies[~self.tombstones[offset:offset + len(ies)]]
 
     def model_predict(self, x):
-        x = self.model.predict((x - self.value) / self.value_diff - 0.5)
+        x = self.model.predict_fast((x - self.value) / self.value_diff - 0.5)
         if x <= 0:
             return 0
         elif x >= 1:
             return self.max_key
         return int(self.max_key * x)
 
-    def update_error_range(self, xs):
+    def model_predicts(self, xs):
+        """
+        model_predict的批量版本，xs为geohash的一维ndarray
+        """
+        xs = self.model.predicts(((xs - self.value) / self.value_diff - 0.5).reshape(-1, 1))
+        keys = np.zeros(len(xs), dtype=np.int64)
+        keys[xs >= 1] = self.max_key
+        inner = (xs > 0) & (xs < 1)
+        keys[inner] = (self.max_key * xs[inner]).astype(np.int64)
+        return keys
+
+    def update_error_range(self, xs, is_exact=False):
+        """
+        :param is_exact: 是否用所有的点计算误差，索引项的位置整体变化(如压缩tombstone)后采样的误差不能覆盖所有的点
+        """
         if self.number:
             # 数据量太多，predict很慢，因此用均匀采样得到100个点来计算误差
-            if self.number > 100:
+            # 样条的predicts是np.interp，用所有的点计算误差也很快，合并后的误差范围是准确的
+            if self.number > 100 and not is_exact and not isinstance(self.model, AbstractSpline):
                 step_size = self.number // 100
-                sample_keys = [i for i in range(0, step_size * 100, step_size)]
-                xs = np.array([[xs[i][2]] for i in sample_keys])
-                ys = np.array(sample_keys)
+                sample_keys = np.arange(0, step_size * 100, step_size)
+                xs = xs['2'][sample_keys].reshape(-1, 1)
+                ys = sample_keys
             else:
-                xs = np.array([[x[2]] for x in xs])
+                xs = xs['2'].reshape(-1, 1)
                 ys = np.arange(self.number)
             # 优化：单个predict->集体predict:时间比为19:1
             pres = self.model.predicts((xs - self.value) / self.value_diff - 0.5)
@@ -1070,6 +2459,23 @@ class HistoryRange:
             self.model.min_err = 0
             self.model.max_err = 0
 
+    def refit_model(self, xs):
+        """
+        用hr的数据重新拟合AbstractNN的输出层，训练数据和build一致为左下角点+分区数据+右上角点
+        误差范围没有变小时保留原模型
+        """
+        if not self.number or not isinstance(self.model, AbstractNN):
+            return
+        old_matrices = self.model.matrices
+        old_errs = (self.model.min_err, self.model.max_err)
+        inputs = np.concatenate(([-0.5], (xs['2'] - self.value) / self.value_diff - 0.5, [0.5]))
+        labels = np.concatenate(([0.0], np.arange(self.number) / max(self.max_key, 1), [1.0]))
+        self.model.refit(inputs, labels)
+        self.update_error_range(xs)
+        if self.model.max_err - self.model.min_err >= old_errs[1] - old_errs[0]:
+            self.model.matrices = old_matrices
+            self.model.min_err, self.model.max_err = old_errs
+
 
 class CurrentRange:
     def __init__(self, value, number, state):
@@ -1078,6 +2484,10 @@ class CurrentRange:
         # SLBRIN
         self.number = number
         self.state = state
+        # For query cache: 删除索引项时加1，query_cache中version不同的cr结果从头扫描
+        self.version = 0
+        # For spatio-temporal query: 统计MBR后的[min t, max t]
+        self.t_range = None
         # For compute
 
 
@@ -1155,31 +2565,109 @@ class AbstractNN:
             xs = relu(np.dot(xs, self.matrices[i * 2]) + self.matrices[i * 2 + 1])
         return (np.dot(xs, self.matrices[-2]) + self.matrices[-1]).flatten()
 
+    def compile(self):
+        """
+        隐藏层数=1时编译为PiecewiseLinearNN，供predict_fast使用
+        """
+        self.compiled = PiecewiseLinearNN(self.matrices) if self.hl_nums == 1 else None
+
+    def predict_fast(self, x):
+        """
+        单点predict的快速版本，predict/predicts作为参照
+        优化: 1x1数组+三次np.dot->一次bisect+一次乘加: 10us->0.4us
+        """
+        # 旧的模型文件没有compiled；matrices被重新训练替换后需要重新编译
+        compiled = self.__dict__.get('compiled')
+        if compiled is None or compiled.matrices is not self.matrices:
+            if self.hl_nums != 1:
+                return self.predict(x)
+            self.compile()
+            compiled = self.compiled
+        return compiled.predict(x)
+
+    def __getstate__(self):
+        # compiled可以由matrices重建，不写入模型文件
+        state = self.__dict__.copy()
+        state.pop('compiled', None)
+        return state
+
     def splits(self):
         """
-        将矩阵按照输入切割为四分，只限于隐藏层数=1
+        将矩阵按照输入切割为四分：第一层吸收输入的平移缩放，输出层吸收输出的重新归一化，中间的隐藏层不变
+        优化: 只限于隐藏层数=1->任意隐藏层数
         :return:
         """
-        w0, b0, w1, b1 = self.matrices
+        w0, b0 = self.matrices[0], self.matrices[1]
+        w1, b1 = self.matrices[-2], self.matrices[-1]
         xbks = [[-0.5], [-0.25], [0], [0.25], [0.5]]
         ybks = self.predicts(xbks)
         m_0 = 0.25 * w0
-        m01 = (-0.375 * w0 + b0).flatten()  # 隐藏层w是(1, 128), b是(128,)，算出来shape变为(1, 128)，所以需要flatten为(128,)
-        m02 = w1 / (ybks[1] - ybks[0])
-        m03 = (b1 - ybks[0]) / (ybks[1] - ybks[0])
-        m11 = (-0.125 * w0 + b0).flatten()
-        m12 = w1 / (ybks[2] - ybks[1])
-        m13 = (b1 - ybks[1]) / (ybks[2] - ybks[1])
-        m21 = (0.125 * w0 + b0).flatten()
-        m22 = w1 / (ybks[3] - ybks[2])
-        m23 = (b1 - ybks[2]) / (ybks[3] - ybks[2])
-        m31 = (0.375 * w0 + b0).flatten()
-        m32 = w1 / (ybks[4] - ybks[3])
-        m33 = (b1 - ybks[3]) / (ybks[4] - ybks[3])
-        return [AbstractNN([m_0, m01, m02, m03], self.hl_nums, 0, 0),
-                AbstractNN([m_0, m11, m12, m13], self.hl_nums, 0, 0),
-                AbstractNN([m_0, m21, m22, m23], self.hl_nums, 0, 0),
-                AbstractNN([m_0, m31, m32, m33], self.hl_nums, 0, 0)]
+        children = []
+        for i in range(4):
+            # 隐藏层w是(1, 128), b是(128,)，算出来shape变为(1, 128)，所以需要flatten为(128,)
+            m_1 = ((0.25 * i - 0.375) * w0 + b0).flatten()
+            m_2 = w1 / (ybks[i + 1] - ybks[i])
+            m_3 = (b1 - ybks[i]) / (ybks[i + 1] - ybks[i])
+            children.append(AbstractNN([m_0, m_1] + list(self.matrices[2:-2]) + [m_2, m_3], self.hl_nums, 0, 0))
+        return children
+
+    def refit(self, xs, ys):
+        """
+        固定隐藏层，用最小二乘重新求解输出层，支持任意隐藏层数
+        优化: 代替NN.build_simple的整个重训练，split_hr的子模型从TF训练->一次lstsq
+        """
+        xs = np.asarray(xs, dtype=np.float64).reshape(-1, 1)
+        for i in range(self.hl_nums):
+            xs = relu(np.dot(xs, self.matrices[i * 2]) + self.matrices[i * 2 + 1])
+        features = np.hstack((xs, np.ones((len(xs), 1))))
+        solution = np.linalg.lstsq(features, ys, rcond=None)[0]
+        dtype = self.matrices[-1].dtype
+        # 替换为新的list，predict_fast据此重新编译
+        self.matrices = list(self.matrices[:-2]) + [solution[:-1].reshape(-1, 1).astype(dtype),
+                                                    solution[-1:].astype(dtype)]
+
+
+class AbstractSpline:
+    """
+    误差有界的分段线性样条模型，可代替AbstractNN作为hr的模型
+    输入输出的归一化、min_err/max_err的含义和AbstractNN一致，err为拟合时key的误差上限，用于重新拟合
+    """
+
+    def __init__(self, spline, min_err, max_err, err):
+        self.spline = spline
+        self.min_err = min_err
+        self.max_err = max_err
+        self.err = err
+
+    def predict(self, x):
+        return self.spline.predict(x)
+
+    def predicts(self, xs):
+        return self.spline.predicts(np.asarray(xs, dtype=np.float64).flatten())
+
+    def compile(self):
+        """
+        样条本身就是分段线性函数，不需要编译
+        """
+        return
+
+    def predict_fast(self, x):
+        return self.spline.predict(x)
+
+    def splits(self):
+        """
+        和AbstractNN.splits一致，将样条按照输入切割为四份，子样条的输入输出重新归一化
+        """
+        ybks = self.predicts([-0.5, -0.25, 0, 0.25, 0.5])
+        knots_x = np.array(self.spline.knots_x)
+        knots_y = np.array(self.spline.knots_y)
+        children = []
+        for i in range(4):
+            y_diff = ybks[i + 1] - ybks[i]
+            child_knots_y = (knots_y - ybks[i]) / y_diff if y_diff > 0 else np.zeros(len(knots_y))
+            child_spline = ErrorBoundedSpline(((knots_x + 0.375 - 0.25 * i) / 0.25).tolist(), child_knots_y.tolist())
+            children.append(AbstractSpline(child_spline, 0, 0, self.err))
+        return children
 
 
 def main():
@@ -1,5 +1,4 @@
 import logging
-import multiprocessing
 import os
 import time
 
@@ -8,7 +7,7 @@ import numpy as np
 from src.experiment.common_utils import load_data, Distribution, load_query, data_precision, data_region
 from src.mlp import MLP
 from src.mlp_simple import MLPSimple
-from src.sli.zm_index import ZMIndex, Node, build_nn, Array
+from src.sli.zm_index import ZMIndex, Node, Array, fit_spline
 from src.utils.geohash_utils import Geohash
 
 PAGE_SIZE = 4096
@@ -32,7 +31,7 @@ class SLIBS(ZMIndex):
 
     def build(self, data_list, is_sorted, data_precision, region, is_new, is_simple, weight,
               stages, cores, train_steps, batch_nums, learning_rates, use_thresholds, thresholds, retrain_time_limits,
-              thread_pool_size):
+              thread_pool_size, leaf_model='nn', spline_err=32):
         """
         different from zm_index
         1. add the key bound into the inputs of each leaf node to reduce the err bound
@@ -59,9 +58,11 @@ class SLIBS(ZMIndex):
         data_len = len(data_list)
         self.max_key = data_len
         if not is_sorted:
-            data_list = [(data[0], data[1], self.geohash.encode(data[0], data[1]), data[2], data[3])
-                         for data in data_list]
-            data_list = sorted(data_list, key=lambda x: x[2])
+            # 优化: 逐点encode->encode_batch，sorted->argsort
+            ghs = self.geohash.encode_batch(data_list['0'], data_list['1'])
+            order = np.argsort(ghs, kind='stable')
+            data_list = list(zip(data_list['0'][order].tolist(), data_list['1'][order].tolist(), ghs[order].tolist(),
+                                 data_list['2'][order].tolist(), data_list['3'][order].tolist()))
         else:
             data_list = data_list.tolist()
         train_inputs[0][0] = data_list
@@ -75,15 +76,20 @@ class SLIBS(ZMIndex):
             use_threshold = use_thresholds[i]
             threshold = thresholds[i]
             retrain_time_limit = retrain_time_limits[i]
-            pool = multiprocessing.Pool(processes=thread_pool_size)
             task_size = stages[i]
-            mp_list = multiprocessing.Manager().list([None] * task_size)
+            mp_list = [None] * task_size
             train_input = train_inputs[i]
             train_label = train_labels[i]
+            # 优化: 同ZMIndex.build，复用TrainPool
+            all_inputs = []
+            all_labels = []
+            tasks = []
+            args = (self.model_path, i, is_new, is_simple, weight, core, train_step, batch_num, learning_rate,
+                    use_threshold, threshold, retrain_time_limit)
             # 2.1 create non-leaf node
             if i < self.non_leaf_stage_len:
                 for j in range(task_size):
-                    if train_label[j] is None:
+                    if not train_label[j]:
                         continue
                     else:
                         # build inputs
@@ -92,11 +98,11 @@ class SLIBS(ZMIndex):
                         divisor = stages[i + 1] * 1.0 / data_len
                         labels = [int(k * divisor) for k in train_label[j]]
                         # train model
-                        pool.apply_async(build_nn, (self.model_path, i, j, inputs, labels, is_new, is_simple,
-                                                    weight, core, train_step, batch_num, learning_rate,
-                                                    use_threshold, threshold, retrain_time_limit, mp_list))
-                pool.close()
-                pool.join()
+                        tasks.append((j, len(all_inputs), len(inputs), (j,) + args))
+                        all_inputs.extend(inputs)
+                        all_labels.extend(labels)
+                for j, model in self.train_nodes(thread_pool_size, all_inputs, all_labels, tasks).items():
+                    mp_list[j] = model
                 nodes = [Node(None, model, None) for model in mp_list]
                 for j in range(task_size):
                     node = nodes[j]
@@ -123,11 +129,14 @@ class SLIBS(ZMIndex):
                     inputs.insert(0, key_left_bounds[j])
                     inputs.append(key_left_bounds[j + 1] if j + 1 < task_size else 1 << self.geohash.sum_bits)
                     labels = list(range(0, len(inputs)))
-                    pool.apply_async(build_nn, (self.model_path, i, j, inputs, labels, is_new, is_simple,
-                                                weight, core, train_step, batch_num, learning_rate,
-                                                use_threshold, threshold, retrain_time_limit, mp_list))
-                pool.close()
-                pool.join()
+                    if leaf_model == 'spline':
+                        mp_list[j] = fit_spline(inputs, labels, spline_err)
+                        continue
+                    tasks.append((j, len(all_inputs), len(inputs), (j,) + args))
+                    all_inputs.extend(inputs)
+                    all_labels.extend(labels)
+                for j, model in self.train_nodes(thread_pool_size, all_inputs, all_labels, tasks).items():
+                    mp_list[j] = model
                 nodes = [Node(train_input[j], mp_list[j], Array()) for j in range(task_size)]
                 for node in nodes:
                     node.model.output_max -= 2  # remove the key bound
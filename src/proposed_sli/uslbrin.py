@@ -1,6 +1,5 @@
 import logging
 import math
-import multiprocessing
 import os
 import time
 
@@ -8,10 +7,12 @@ import numpy as np
 
 from src.experiment.common_utils import load_data, Distribution, data_precision, data_region, load_query
 from src.sli.zm_index import Array
-from src.proposed_sli.slbrin import SLBRIN, HistoryRange, NN, valid_position_funcs, range_position_funcs
+from src.proposed_sli.slbrin import SLBRIN, HistoryRange, NN, valid_position_funcs, IE_DTYPE, ies_distance, \
+    AbstractSpline, fit_spline, get_t_range
+from src.train_pool import get_train_pool
 from src.ts_predict import TimeSeriesModel
-from src.utils.common_utils import binary_search_less_max_duplicate, binary_search_less_max, merge_sorted_list, \
-    biased_search_duplicate, binary_search_duplicate, biased_search_almost
+from src.utils.common_utils import binary_search_less_max_duplicate, binary_search_less_max, binary_search_duplicate, \
+    searchsorted_duplicate, searchsorted_almost, merge_sorted_array
 
 PAGE_SIZE = 4096
 HR_SIZE = 8 + 1 + 2 + 4 + 1  # 16
@@ -29,6 +30,8 @@ class USLBRIN(SLBRIN):
 
     def __init__(self, model_path=None):
         super().__init__(model_path)
+        # for query cache: 条目为[hr_deps]，hr部分的结果同时记录hr_append的version和delta_index部分的结果
+        # delta_index的索引项插入/删除时只重新查询version变化的hr_append，见query_delta_cached
         # for update
         self.history_ranges_append = None
         self.start_time = 0
@@ -62,9 +65,16 @@ class USLBRIN(SLBRIN):
         # create the old_cdfs and old_max_keys for delta_model
         key_interval = hr.value_diff / self.cdf_width
         key_list = [int(hr.value + k * key_interval) for k in range(self.cdf_width)]
-        old_cdfs = [[] for k in range(int(self.time_id))]
-        for tmp in data:
-            old_cdfs[(tmp[3] - self.start_time) // self.time_interval].append(tmp[2])
+        # 优化: 逐个ie按time_id分桶->argsort后按time_id整体切分
+        time_ids = (data['3'] - self.start_time) // self.time_interval
+        # 按time_id切分会丢掉范围外的索引项，和逐个分桶时一样报错
+        if len(time_ids) and (time_ids.min() < 0 or time_ids.max() >= self.time_id):
+            raise IndexError("time_id of index entries [%d, %d] out of [0, %d)" %
+                             (time_ids.min(), time_ids.max(), self.time_id))
+        order = np.argsort(time_ids, kind='stable')
+        bounds = np.searchsorted(time_ids[order], np.arange(int(self.time_id) + 1))
+        ghs = data['2'][order]
+        old_cdfs = [ghs[bounds[k]:bounds[k + 1]].tolist() for k in range(int(self.time_id))]
         old_max_keys = [max(len(cdf) - 1, 0) for cdf in old_cdfs]
         # for empty and head old_cdfs, remove them
         l = 0
@@ -122,6 +132,8 @@ class USLBRIN(SLBRIN):
         retrain_delta_model_mae1 = 0
         retrain_delta_model_mae2 = 0
         self.history_ranges_append = []
+        if self.query_cache is not None:
+            self.query_cache.clear()
         if is_build:
             # 1. create delta_model with ts_model
             for i in range(self.meta.last_hr + 1):
@@ -175,8 +187,14 @@ class USLBRIN(SLBRIN):
         hr = self.history_ranges[hr_key]
         hr_append = self.history_ranges_append[hr_key]
         hr_append.delta_model.data_len += 1
-        tg_array = hr_append.delta_index[self.get_delta_index_key(gh, hr, hr_append)]
+        delta_index_key = self.get_delta_index_key(gh, hr, hr_append)
+        tg_array = hr_append.delta_index[delta_index_key]
         tg_array.insert(binary_search_less_max(tg_array.index, 2, gh, 0, tg_array.max_key) + 1, point)
+        hr_append.version += 1
+        if hr_append.t_blocks is not None:
+            t_block = hr_append.t_blocks[delta_index_key]
+            t_block[0] = min(t_block[0], point[3])
+            t_block[1] = max(t_block[1], point[3])
         # IO1: search key
         self.io_cost += math.ceil((tg_array.max_key + 1) / ITEMS_PER_PAGE)
 
@@ -195,15 +213,49 @@ class USLBRIN(SLBRIN):
             self.insert_time += time.time() - start_time
             self.insert_io += self.io_cost - io_cost
 
+    def delete(self, point):
+        """
+        删除索引项，point和insert的点一致为(x, y, t, key)
+        1. hr中的索引项和SLBRIN一致只打上tombstone，查询时跳过，存活比例低于threshold_live时压缩hr
+        2. delta_index中的索引项直接删除
+        3. update时合并delta_index的同时压缩hr中的tombstone
+        :return: 是否找到并删除
+        """
+        gh = self.meta.geohash.encode(point[0], point[1])
+        key = point[3]
+        # 1. find in hr
+        if self.delete_hr_entry(gh, key):
+            return True
+        # 2. find in delta_index
+        hr_key = self.point_query_hr(gh)
+        hr = self.history_ranges[hr_key]
+        hr_append = self.history_ranges_append[hr_key]
+        tg_array = hr_append.delta_index[self.get_delta_index_key(gh, hr, hr_append)]
+        for i in binary_search_duplicate(tg_array.index, 2, gh, 0, tg_array.max_key):
+            if tg_array.index[i][4] == key:
+                tg_array.delete(i)
+                hr_append.delta_model.data_len -= 1
+                hr_append.version += 1
+                return True
+        return False
+
     def update_hr(self, hr_key, points):
         """
         update hr by points
         """
         # merge cr data into hr data
         hr = self.history_ranges[hr_key]
-        # quicksort->merge_sorted_array->sorted->binary_search and insert => 50:2:1:0.5
         hr_data = self.index_entries[hr_key]
-        merge_sorted_list(hr_data, points)
+        hr.version += 1
+        hr.t_blocks = None
+        # 合并时压缩tombstone，之后的update_error_range/split_hr会重新计算模型误差
+        if hr.tombstones is not None:
+            hr_data = hr_data[~hr.tombstones]
+            hr.tombstones = None
+            hr.deleted_number = 0
+        # quicksort->merge_sorted_array->sorted->binary_search and insert => 50:2:1:0.5
+        hr_data = merge_sorted_array(hr_data, np.array(points, dtype=IE_DTYPE))
+        self.index_entries[hr_key] = hr_data
         hr_number = len(hr_data)
         if hr_number > self.meta.threshold_number and hr.length < self.meta.threshold_length:
             # split hr
@@ -214,10 +266,17 @@ class USLBRIN(SLBRIN):
             hr.max_key = hr_number - 1
             old_err = hr.model.max_err - hr.model.min_err
             hr.update_error_range(hr_data)
-            if hr.model.max_err - hr.model.min_err > self.threshold_err * old_err:
-                hr.state = 1
+            self.get_retrain_inefficient_model(hr_key, old_err)
             return 0
 
+    def get_retrain_inefficient_model(self, hr_key, old_err):
+        """
+        误差范围超过threshold_err时设为inefficient状态，在update中重训练
+        """
+        hr = self.history_ranges[hr_key]
+        if hr.model.max_err - hr.model.min_err > self.threshold_err * old_err:
+            hr.state = 1
+
     def split_hr(self, hr, hr_key, hr_data):
         # 1. create child hrs, of which model is inherited from parent hr and update err by inherited index entries
         region_offset = pow(10, -self.meta.geohash.data_precision - 1)
@@ -227,6 +286,7 @@ class USLBRIN(SLBRIN):
             cur = range_stack.pop(-1)
             if cur[2] > self.meta.threshold_number and cur[1] < self.meta.threshold_length:
                 child_regions = cur[4].split()
+                child_quadrants = self.meta.geohash.child_quadrants(cur[0], cur[1])
                 l_key = cur[3]
                 r_key = cur[3] + cur[2] - 1
                 tmp_l_key = l_key
@@ -236,8 +296,9 @@ class USLBRIN(SLBRIN):
                 for i in range(4):
                     value = r_bound
                     r_bound = cur[0] + (i + 1 << self.meta.geohash.sum_bits - length)
-                    tmp_r_key = binary_search_less_max(hr_data, 2, r_bound, tmp_l_key, r_key)
-                    child_list[i] = (value, length, tmp_r_key - tmp_l_key + 1, tmp_l_key, child_regions[i], cur[5])
+                    tmp_r_key = tmp_l_key + int(np.searchsorted(hr_data['2'][tmp_l_key:r_key + 1], r_bound)) - 1
+                    child_list[i] = (value, length, tmp_r_key - tmp_l_key + 1, tmp_l_key,
+                                     child_regions[child_quadrants[i]], cur[5])
                     tmp_l_key = tmp_r_key + 1
                 range_stack.extend(child_list[::-1])
             else:
@@ -265,6 +326,7 @@ class USLBRIN(SLBRIN):
             self.index_entries.insert(hr_key, child_range[2])
         # 3. update meta
         self.meta.last_hr += child_len - 1
+        self.hr_directory = None
         return child_len
 
     def update(self):
@@ -326,6 +388,8 @@ class USLBRIN(SLBRIN):
                 # IO1: merge data
                 self.io_cost += math.ceil(len(self.index_entries[i]) / ITEMS_PER_PAGE)
             else:
+                # 没有delta_index需要合并的hr也压缩tombstone
+                self.compact_hr(i + offset)
                 cdfs.append(None)
                 max_keys.append(None)
         hr_num += offset
@@ -336,18 +400,21 @@ class USLBRIN(SLBRIN):
             retrain_model_num = 0
             retrain_model_epoch = 0
             start_time = time.time()
-            pool = multiprocessing.Pool(processes=self.thread_retrain)
-            mp_dict = multiprocessing.Manager().dict()
+            # 优化: 每次新建Pool+Manager且pickle每个hr的index entries->复用TrainPool，geohash列通过shared_memory发布
+            inputs = []
+            tasks = []
+            offset = 0
             for i in range(0, hr_num):
                 hr = self.history_ranges[i]
                 if hr.state:
-                    pool.apply_async(retrain_model,
-                                     (self.model_path, i, self.index_entries[i], hr,
-                                      self.weight, self.cores, self.train_step, self.batch_num, self.learning_rate,
-                                      self.is_init, mp_dict))
-            pool.close()
-            pool.join()
-            for (key, value) in mp_dict.items():
+                    inputs.append(self.index_entries[i]['2'])
+                    tasks.append((i, offset, hr.number,
+                                  (self.model_path, i, hr, self.weight, self.cores, self.train_step, self.batch_num,
+                                   self.learning_rate, self.is_init)))
+                    offset += hr.number
+            results = get_train_pool(self.thread_retrain).map(
+                retrain_model, np.concatenate(inputs) if inputs else None, None, tasks)
+            for (key, value) in results.items():
                 value[0].state = 0
                 self.history_ranges[key] = value[0]
                 retrain_model_num += value[1]
@@ -387,6 +454,8 @@ class USLBRIN(SLBRIN):
                                                                         self.threshold_err_max_key)
                     hr_append.delta_index = [Array(self.child_length) for i in range(
                         hr_append.delta_model.max_keys[hr_append.delta_model.time_id] + 1)]
+                    hr_append.t_blocks = None
+                    hr_append.version += 1
                     retrain_delta_model_num1 += num_cdf
                     retrain_delta_model_num2 += num_max_key
                     if num_cdf or num_max_key:
@@ -411,6 +480,8 @@ class USLBRIN(SLBRIN):
                     self.history_ranges_append[i].delta_model = delta_models[i]
                     self.history_ranges_append[i].delta_index = [Array(self.child_length) for i in range(
                         delta_models[i].max_keys[delta_models[i].time_id] + 1)]
+                    self.history_ranges_append[i].t_blocks = None
+                    self.history_ranges_append[i].version += 1
             retrain_delta_model_mae1 = retrain_delta_model_mae1 / hr_num
             retrain_delta_model_mae2 = retrain_delta_model_mae2 / hr_num
         if self.is_save_delta:
@@ -432,37 +503,78 @@ class USLBRIN(SLBRIN):
         self.logging.info("Retrain index entry size: %s" % (index_len * ITEM_SIZE))
         self.logging.info("Retrain error bound: %s" % self.model_err())
 
+    def query_delta_cached(self, hr_deps, get_hr_list, query_hr, query_delta):
+        """
+        query_cache条目的hr和delta_index部分
+        1. hr部分和SLBRIN.query_hr_cached一致，按hr的version校验
+        2. delta_index部分按hr_append的version校验，只重新查询version变化的hr_append
+        :param query_delta: query_delta(hr, hr_append, arg)返回delta_index部分的结果
+        :return: 新的hr_deps，hr部分的结果为[hr的结果, hr_append, arg, hr_append.version, delta_index的结果]
+        """
+        hr_deps = self.query_hr_cached(hr_deps, get_hr_list,
+                                       lambda hr_key, arg: [query_hr(hr_key, arg), self.history_ranges_append[hr_key],
+                                                            arg, None, None])
+        for hr, version, result in hr_deps:
+            hr_append = result[1]
+            if result[3] != hr_append.version:
+                result[3] = hr_append.version
+                result[4] = query_delta(hr, hr_append, result[2])
+        return hr_deps
+
     def point_query_single(self, point):
         """
         1. compute geohash from x/y of points
         2. find hr within geohash by slbrin.point_query
         3. predict by leaf model
         4. biased search in scope [pre - max_err, pre + min_err]
+        5. search the target list of delta_index
         """
         # 1. compute geohash from x/y of point
         gh = self.meta.geohash.encode(point[0], point[1])
-        # 2. find hr within geohash by slbrin.point_query
-        hr_key = self.point_query_hr(gh)
+        if self.query_cache is None:
+            # 2. find hr within geohash by slbrin.point_query
+            hr_key = self.point_query_hr(gh)
+            result = self.point_query_hr_result(hr_key, gh)
+            result.extend(self.point_query_delta_result(self.history_ranges[hr_key],
+                                                        self.history_ranges_append[hr_key], gh))
+        else:
+            # 结果只取决于geohash，同一格子内的点共享条目
+            entry = self.query_cache.get(('point', gh), lambda: [[]])
+            entry[0] = self.query_delta_cached(entry[0], lambda: [(self.point_query_hr(gh), None)],
+                                               lambda hr_key, arg: self.point_query_hr_result(hr_key, gh),
+                                               lambda hr, hr_append, arg: self.point_query_delta_result(hr, hr_append,
+                                                                                                        gh))
+            hr_result = entry[0][0][2]
+            result = hr_result[0] + hr_result[4]
+        return result
+
+    def point_query_hr_result(self, hr_key, gh):
+        """
+        hr中geohash为gh的存活索引项的key
+        """
         hr = self.history_ranges[hr_key]
         if hr.number == 0:
-            result = []
-        else:
-            # 3. predict by leaf model
-            pre = hr.model_predict(gh)
-            target_ies = self.index_entries[hr_key]
-            # 4. biased search in scope [pre - max_err, pre + min_err]
-            l_bound = max(pre - hr.model.max_err, 0)
-            r_bound = min(pre - hr.model.min_err, hr.max_key)
-            self.io_cost += math.ceil((r_bound - l_bound) / ITEMS_PER_PAGE)
-            result = [target_ies[key][4] for key in biased_search_duplicate(target_ies, 2, gh, pre, l_bound, r_bound)]
-        hr_append = self.history_ranges_append[hr_key]
+            return []
+        # 3. predict by leaf model
+        pre = hr.model_predict(gh)
+        target_ies = self.index_entries[hr_key]
+        # 4. biased search in scope [pre - max_err, pre + min_err]
+        l_bound = max(pre - hr.model.max_err, 0)
+        r_bound = min(pre - hr.model.min_err, hr.max_key)
+        self.io_cost += math.ceil((r_bound - l_bound) / ITEMS_PER_PAGE)
+        l_key, r_key = searchsorted_duplicate(target_ies['2'], gh, l_bound, r_bound)
+        return hr.live_entries(target_ies[l_key:r_key], l_key)['4'].tolist()
+
+    def point_query_delta_result(self, hr, hr_append, gh):
+        """
+        delta_index中geohash为gh的索引项的key
+        """
+        # 5. search the target list of delta_index
         tg_array = hr_append.delta_index[self.get_delta_index_key(gh, hr, hr_append)]
-        result.extend([tg_array.index[key][4]
-                       for key in binary_search_duplicate(tg_array.index, 2, gh, 0, tg_array.max_key)])
         self.io_cost += math.ceil((tg_array.max_key + 1) / ITEMS_PER_PAGE)
-        return result
+        return [tg_array.index[key][4] for key in binary_search_duplicate(tg_array.index, 2, gh, 0, tg_array.max_key)]
 
-    def range_query_single(self, window):
+    def range_query_single(self, window, t_from=None, t_to=None):
         """
         1. compute geohash from window_left and window_right
         2. get all relative hrs with key and relationship
@@ -470,74 +582,154 @@ class USLBRIN(SLBRIN):
         4. predict min_key/max_key by nn
         5. filter all the point of scope[min_key/max_key] by range.contain(point)
         耗时操作：range_query_hr/nn predict/精确过滤: 15/24/37.6
+        :param t_from/t_to: 不为None时只返回t_from <= t <= t_to的索引项，按hr每页和delta_index每个Array的t的zone map跳过不相交的页
         """
+        t_range = get_t_range(t_from, t_to)
+        if self.query_cache is not None and t_range is None:
+            return self.range_query_cached(window)
         # 1. compute geohash of window_left and window_right
         gh1 = self.meta.geohash.encode(window[2], window[0])
         gh2 = self.meta.geohash.encode(window[3], window[1])
         # 2. get all relative hrs with key and relationship
         hr_list = self.range_query_hr(gh1, gh2)
         result = []
-        # 3. get min_geohash and max_geohash of every hr for different relation
         for hr_key in hr_list:
-            hr = self.history_ranges[hr_key]
-            hr_append = self.history_ranges_append[hr_key]
             position = hr_list[hr_key]
-            hr_data = self.index_entries[hr_key]
-            if position == 0:  # window contain hr
-                result.extend([ie[4] for ie in hr_data])
-                self.io_cost += math.ceil(len(hr_data) / ITEMS_PER_PAGE)
-                delta_index_len = 0
-                for child in hr_append.delta_index:
-                    result.extend([ie[4] for ie in child.index[:child.max_key + 1]])
-                    delta_index_len += child.max_key + 1
-                self.io_cost += math.ceil(delta_index_len / ITEMS_PER_PAGE)
-            else:
-                # wrong child hr from range_by_int
-                is_valid = valid_position_funcs[position](hr.scope, window)
-                if not is_valid:
-                    continue
-                # if-elif-else->lambda, 30->4
-                gh_new1, gh_new2, compare_func = range_position_funcs[position](hr.scope, window, gh1, gh2,
-                                                                                self.meta.geohash)
-                # 4 predict min_key/max_key by nn
-                if gh_new1:
-                    pre1 = hr.model_predict(gh_new1)
-                    l_bound1 = max(pre1 - hr.model.max_err, 0)
-                    r_bound1 = min(pre1 - hr.model.min_err, hr.max_key)
-                    left_key = min(biased_search_almost(hr_data, 2, gh_new1, pre1, l_bound1, r_bound1))
-                    left_key_append = self.get_delta_index_key(gh_new1, hr, hr_append)
-                else:
-                    l_bound1 = 0
-                    left_key = 0
-                    left_key_append = 0
-                if gh_new2:
-                    pre2 = hr.model_predict(gh_new2)
-                    l_bound2 = max(pre2 - hr.model.max_err, 0)
-                    r_bound2 = min(pre2 - hr.model.min_err, hr.max_key)
-                    right_key = max(biased_search_almost(hr_data, 2, gh_new2, pre2, l_bound2, r_bound2)) + 1
-                    right_key_append = self.get_delta_index_key(gh_new2, hr, hr_append) + 1
-                else:
-                    r_bound2 = hr.number
-                    right_key = hr.number
-                    right_key_append = len(hr_append.delta_index)
-                # 5 filter all the point of scope[min_key/max_key] by range.contain(point)
-                # 优化: region.contain->compare_func不同位置的点做不同的判断: 638->474mil
-                result.extend([ie[4] for ie in hr_data[left_key:right_key] if compare_func(ie)])
-                self.io_cost += math.ceil((r_bound2 - l_bound1) / ITEMS_PER_PAGE)
-                delta_index_len = 0
-                for child in hr_append.delta_index[left_key_append:right_key_append]:
-                    result.extend([ie[4] for ie in child.index[:child.max_key + 1] if compare_func(ie)])
-                    delta_index_len += child.max_key + 1
-                self.io_cost += math.ceil(delta_index_len / ITEMS_PER_PAGE)
+            ies = self.range_query_hr_entries(hr_key, position, window, gh1, gh2, t_range)
+            result.extend(ies['4'].tolist())
+            result.extend([ie[4] for ie in self.range_query_delta_entries(self.history_ranges[hr_key],
+                                                                          self.history_ranges_append[hr_key],
+                                                                          position, window, gh1, gh2, t_range)])
+        return result
+
+    def range_query_cached(self, window):
+        """
+        range_query_single的query_cache版本，和SLBRIN.range_query_cached一致
+        条目缓存key外扩10^-data_precision的window内的索引项，返回前按window精确过滤
+        """
+        key, cache_window, gh1, gh2 = self.get_cache_window(window)
+        entry = self.query_cache.get(('range',) + key, lambda: [[]])
+
+        def query_hr(hr_key, position):
+            return self.range_query_hr_entries(hr_key, position, cache_window, gh1, gh2)[['0', '1', '4']]
+
+        def query_delta(hr, hr_append, position):
+            return [(ie[0], ie[1], ie[4])
+                    for ie in self.range_query_delta_entries(hr, hr_append, position, cache_window, gh1, gh2)]
+
+        entry[0] = self.query_delta_cached(entry[0], lambda: sorted(self.range_query_hr(gh1, gh2).items()),
+                                           query_hr, query_delta)
+        result = []
+        for hr, version, (ies, hr_append, position, delta_version, delta_ies) in entry[0]:
+            result.extend(ies['4'][(window[0] <= ies['1']) & (ies['1'] <= window[1]) &
+                                   (window[2] <= ies['0']) & (ies['0'] <= window[3])].tolist())
+            result.extend([ie[2] for ie in delta_ies
+                           if window[0] <= ie[1] <= window[1] and window[2] <= ie[0] <= window[3]])
         return result
 
-    def knn_query_single(self, knn):
+    def range_query_hr_entries(self, hr_key, position, window, gh1, gh2, t_range=None):
+        """
+        hr中window内（和t_range内）的存活索引项
+        """
+        hr = self.history_ranges[hr_key]
+        if position == 0:  # window contain hr
+            return self.hr_entries(hr_key, 0, hr.number, 0, hr.number, t_range)
+        # wrong child hr from range_query_hr
+        if not valid_position_funcs[position](hr.scope, window):
+            return np.empty(0, dtype=IE_DTYPE)
+        hr_data = self.index_entries[hr_key]
+        # 3. get min_geohash and max_geohash of every hr for different relation
+        # if-elif-else->lambda, 30->4
+        gh_new1, gh_new2, compare_func = self.range_query_hr_geohashes(hr, position, window, gh1, gh2)
+        # 4 predict min_key/max_key by nn
+        if gh_new1:
+            pre1 = hr.model_predict(gh_new1)
+            l_bound1 = max(pre1 - hr.model.max_err, 0)
+            r_bound1 = min(pre1 - hr.model.min_err, hr.max_key)
+            left_key = searchsorted_almost(hr_data['2'], gh_new1, l_bound1, r_bound1)[0]
+        else:
+            l_bound1 = 0
+            left_key = 0
+        if gh_new2:
+            pre2 = hr.model_predict(gh_new2)
+            l_bound2 = max(pre2 - hr.model.max_err, 0)
+            r_bound2 = min(pre2 - hr.model.min_err, hr.max_key)
+            right_key = searchsorted_almost(hr_data['2'], gh_new2, l_bound2, r_bound2)[1]
+        else:
+            r_bound2 = hr.number
+            right_key = hr.number
+        # 5 filter all the point of scope[min_key/max_key] by range.contain(point)
+        # 优化: region.contain->compare_func不同位置的点做不同的判断: 638->474mil
+        # 优化: 逐个ie判断->在x/y列视图上整体判断
+        ies = self.hr_entries(hr_key, left_key, right_key, l_bound1, r_bound2, t_range)
+        return ies[compare_func((ies['0'], ies['1']))]
+
+    def range_query_delta_entries(self, hr, hr_append, position, window, gh1, gh2, t_range=None):
+        """
+        hr_append的delta_index中window内（和t_range内）的索引项
+        """
+        if position == 0:  # window contain hr
+            return self.delta_index_entries(hr_append, 0, len(hr_append.delta_index), t_range)
+        # wrong child hr from range_query_hr
+        if not valid_position_funcs[position](hr.scope, window):
+            return []
+        gh_new1, gh_new2, compare_func = self.range_query_hr_geohashes(hr, position, window, gh1, gh2)
+        left_key = self.get_delta_index_key(gh_new1, hr, hr_append) if gh_new1 else 0
+        right_key = self.get_delta_index_key(gh_new2, hr, hr_append) + 1 if gh_new2 else len(hr_append.delta_index)
+        return [ie for ie in self.delta_index_entries(hr_append, left_key, right_key, t_range) if compare_func(ie)]
+
+    def hr_entries(self, hr_key, left_key, right_key, l_bound, r_bound, t_range=None):
+        """
+        hr中[left_key, right_key)内未删除的索引项，[l_bound, r_bound)为需要扫描的范围
+        t_range不为None时只返回t在t_range内的索引项，按t的zone map只扫描相交的页
+        """
+        if t_range is None:
+            self.io_cost += math.ceil((r_bound - l_bound) / ITEMS_PER_PAGE)
+            return self.history_ranges[hr_key].live_entries(self.index_entries[hr_key][left_key:right_key], left_key)
+        ies = self.hr_time_entries(hr_key, left_key, right_key, t_range) if left_key < right_key else None
+        return np.empty(0, dtype=IE_DTYPE) if ies is None else ies
+
+    def delta_index_entries(self, hr_append, left_key, right_key, t_range=None):
+        """
+        delta_index中第[left_key, right_key)个Array的索引项
+        t_range不为None时只返回t在t_range内的索引项，按每个Array的t的zone map跳过不相交的Array
+        """
+        ies = []
+        delta_index_len = 0
+        if t_range is None:
+            for child in hr_append.delta_index[left_key:right_key]:
+                ies.extend(child.index[:child.max_key + 1])
+                delta_index_len += child.max_key + 1
+        else:
+            t_blocks = self.get_delta_t_blocks(hr_append)
+            for i in range(left_key, min(right_key, len(hr_append.delta_index))):
+                if t_blocks[i][0] <= t_range[1] and t_blocks[i][1] >= t_range[0]:
+                    child = hr_append.delta_index[i]
+                    ies.extend([ie for ie in child.index[:child.max_key + 1] if t_range[0] <= ie[3] <= t_range[1]])
+                    delta_index_len += child.max_key + 1
+        self.io_cost += math.ceil(delta_index_len / ITEMS_PER_PAGE)
+        return ies
+
+    def get_delta_t_blocks(self, hr_append):
+        """
+        delta_index中每个Array的t的zone map：[t_min, t_max]，空Array为[inf, -inf]
+        """
+        if hr_append.t_blocks is None:
+            hr_append.t_blocks = [[min(ie[3] for ie in child.index[:child.max_key + 1]),
+                                   max(ie[3] for ie in child.index[:child.max_key + 1])]
+                                  if child.max_key >= 0 else [math.inf, -math.inf]
+                                  for child in hr_append.delta_index]
+        return hr_append.t_blocks
+
+    def knn_query_single(self, knn, t_from=None, t_to=None):
         """
         1. get the nearest key of query point
         2. get the nn points to create range query window
         3. filter point by distance
         耗时操作：knn_query_hr/nn predict/精确过滤: 6.1/30/40.5
+        :param t_from/t_to: 不为None时只在t_from <= t <= t_to的索引项中找k个最近的
         """
+        t_range = get_t_range(t_from, t_to)
         x, y, k = knn
         k = int(k)
         # 1. get the nearest key of query point
@@ -552,8 +744,8 @@ class USLBRIN(SLBRIN):
             pre = qp_hr.model_predict(qp_g)
             l_bound = max(pre - qp_hr.model.max_err, 0)
             r_bound = min(pre - qp_hr.model.min_err, qp_hr.max_key)
-            qp_ie_key = biased_search_almost(qp_hr_data, 2, qp_g, pre, l_bound, r_bound)[0]
-            tp_ie_list = [qp_hr_data[qp_ie_key]]
+            qp_ie_key = searchsorted_almost(qp_hr_data['2'], qp_g, l_bound, r_bound)[0]
+            tp_ie_list = [qp_hr.live_entries(qp_hr_data[qp_ie_key:qp_ie_key + 1], qp_ie_key)]
         # 2. get the n points to create range query window
         cur_ie_key = qp_ie_key + 1
         cur_hr_data = qp_hr_data
@@ -563,10 +755,10 @@ class USLBRIN(SLBRIN):
         while i > 0:
             right_ie_len = cur_hr.number - cur_ie_key + 1
             if right_ie_len >= i:
-                tp_ie_list.extend(cur_hr_data[cur_ie_key:cur_ie_key + i])
+                tp_ie_list.append(cur_hr.live_entries(cur_hr_data[cur_ie_key:cur_ie_key + i], cur_ie_key))
                 break
             else:
-                tp_ie_list.extend(cur_hr_data[cur_ie_key:])
+                tp_ie_list.append(cur_hr.live_entries(cur_hr_data[cur_ie_key:], cur_ie_key))
                 if cur_hr_key == self.meta.last_hr:
                     break
                 i -= right_ie_len
@@ -577,26 +769,36 @@ class USLBRIN(SLBRIN):
         cur_ie_key = qp_ie_key
         cur_hr_key = qp_hr_key
         cur_hr_data = qp_hr_data
+        cur_hr = qp_hr
         i = k
         while i > 0:
             left_ie_len = cur_ie_key
             if left_ie_len >= i:
-                tp_ie_list.extend(cur_hr_data[cur_ie_key - i:cur_ie_key])
+                tp_ie_list.append(cur_hr.live_entries(cur_hr_data[cur_ie_key - i:cur_ie_key], cur_ie_key - i))
                 break
             else:
-                tp_ie_list.extend(cur_hr_data[cur_ie_key - left_ie_len:cur_ie_key])
+                tp_ie_list.append(cur_hr.live_entries(cur_hr_data[:cur_ie_key], 0))
                 if cur_hr_key == 0:
                     break
                 i -= left_ie_len
                 cur_hr_key -= 1
                 cur_hr_data = self.index_entries[cur_hr_key]
-                cur_ie_key = self.history_ranges[cur_hr_key].number
-        tp_list = sorted([[(tp_ie[0] - x) ** 2 + (tp_ie[1] - y) ** 2, tp_ie[4]] for tp_ie in tp_ie_list])[:k]
-        dst = tp_list[-1][0]
-        if dst == 0:
-            return [tp[1] for tp in tp_list]
-        dst_pow = dst ** 0.5
-        window = [y - dst_pow, y + dst_pow, x - dst_pow, x + dst_pow]
+                cur_hr = self.history_ranges[cur_hr_key]
+                cur_ie_key = cur_hr.number
+        tp_ies = np.concatenate(tp_ie_list) if tp_ie_list else np.empty(0, dtype=IE_DTYPE)
+        if t_range is not None:
+            tp_ies = tp_ies[(t_range[0] <= tp_ies['3']) & (tp_ies['3'] <= t_range[1])]
+        tp_list = sorted(ies_distance(tp_ies, x, y))[:k]
+        if len(tp_list) < k:
+            # 初始结果不足k个时无法确定距离上界，用整个region作为window
+            dst = math.inf
+            window = [-math.inf, math.inf, -math.inf, math.inf]
+        else:
+            dst = tp_list[-1][0]
+            if dst == 0:
+                return [tp[1] for tp in tp_list]
+            dst_pow = dst ** 0.5
+            window = [y - dst_pow, y + dst_pow, x - dst_pow, x + dst_pow]
         # 处理超出边界的情况
         self.meta.geohash.region.clip_region(window, self.meta.geohash.data_precision)
         gh1 = self.meta.geohash.encode(window[2], window[0])
@@ -607,60 +809,19 @@ class USLBRIN(SLBRIN):
             if tp_window_hr[2] > dst:
                 break
             hr_key = tp_window_hr[0]
-            hr = self.history_ranges[hr_key]
-            hr_append = self.history_ranges_append[hr_key]
             position = tp_window_hr[1]
-            hr_data = self.index_entries[hr_key]
-            if position == 0:  # window contain hr
-                tmp_list = [[(ie[0] - x) ** 2 + (ie[1] - y) ** 2, ie[4]] for ie in hr_data]
-                self.io_cost += math.ceil(len(hr_data) / ITEMS_PER_PAGE)
-                delta_index_len = 0
-                for child in hr_append.delta_index:
-                    tmp_list.extend([[(ie[0] - x) ** 2 + (ie[1] - y) ** 2, ie[4]]
-                                     for ie in child.index[:child.max_key + 1]])
-                    delta_index_len += child.max_key + 1
-                self.io_cost += math.ceil(delta_index_len / ITEMS_PER_PAGE)
-            else:
-                # wrong child hr from range_by_int
-                is_valid = valid_position_funcs[position](hr.scope, window)
-                if not is_valid:
-                    continue
-                gh_new1, gh_new2, compare_func = range_position_funcs[tp_window_hr[1]](hr.scope, window, gh1, gh2,
-                                                                                       self.meta.geohash)
-                if gh_new1:
-                    pre1 = hr.model_predict(gh_new1)
-                    l_bound1 = max(pre1 - hr.model.max_err, 0)
-                    r_bound1 = min(pre1 - hr.model.min_err, hr.max_key)
-                    left_key = min(biased_search_almost(hr_data, 2, gh_new1, pre1, l_bound1, r_bound1))
-                    left_key_append = self.get_delta_index_key(gh_new1, hr, hr_append)
-                else:
-                    l_bound1 = 0
-                    left_key = 0
-                    left_key_append = 0
-                if gh_new2:
-                    pre2 = hr.model_predict(gh_new2)
-                    l_bound2 = max(pre2 - hr.model.max_err, 0)
-                    r_bound2 = min(pre2 - hr.model.min_err, hr.max_key)
-                    right_key = max(biased_search_almost(hr_data, 2, gh_new2, pre2, l_bound2, r_bound2)) + 1
-                    right_key_append = self.get_delta_index_key(gh_new2, hr, hr_append) + 1
-                else:
-                    r_bound2 = hr.number
-                    right_key = hr.number
-                    right_key_append = len(hr_append.delta_index)
-                # 3. filter point by distance
-                tmp_list = [[(ie[0] - x) ** 2 + (ie[1] - y) ** 2, ie[4]]
-                            for ie in hr_data[left_key:right_key] if compare_func(ie)]
-                self.io_cost += math.ceil((r_bound2 - l_bound1) / ITEMS_PER_PAGE)
-                delta_index_len = 0
-                for child in hr_append.delta_index[left_key_append:right_key_append]:
-                    tmp_list.extend([[(ie[0] - x) ** 2 + (ie[1] - y) ** 2, ie[4]]
-                                     for ie in child.index[:child.max_key + 1] if compare_func(ie)])
-                    delta_index_len += child.max_key + 1
-                self.io_cost += math.ceil(delta_index_len / ITEMS_PER_PAGE)
+            # 3. filter point by distance
+            tmp_list = ies_distance(self.range_query_hr_entries(hr_key, position, window, gh1, gh2, t_range), x, y)
+            tmp_list.extend([((ie[0] - x) ** 2 + (ie[1] - y) ** 2, ie[4])
+                             for ie in self.range_query_delta_entries(self.history_ranges[hr_key],
+                                                                      self.history_ranges_append[hr_key],
+                                                                      position, window, gh1, gh2, t_range)])
             if len(tmp_list) > 0:
                 tp_list.extend(tmp_list)
                 tp_list = sorted(tp_list)[:k]
-                dst = tp_list[-1][0]
+                # 不足k个时第k近的距离仍未知，保持初始的上界
+                if len(tp_list) == k:
+                    dst = tp_list[-1][0]
         return [tp[1] for tp in tp_list]
 
     def save(self):
@@ -691,8 +852,8 @@ class USLBRIN(SLBRIN):
                 np.array(delta_indexes, dtype=[("0", 'f8'), ("1", 'f8'), ("2", 'i8'), ("3", 'i4'), ("4", 'i4')]))
         np.save(os.path.join(self.model_path, 'delta_index_lens.npy'), delta_index_lens)
 
-    def load(self):
-        super(USLBRIN, self).load()
+    def load(self, mmap=False):
+        super(USLBRIN, self).load(mmap)
         meta_append = np.load(os.path.join(self.model_path, 'meta_append.npy'), allow_pickle=True).item()
         self.start_time = meta_append[0]
         self.time_id = meta_append[1]
@@ -745,12 +906,22 @@ class HistoryRangeAppend:
     def __init__(self, delta_index, delta_model):
         self.delta_index = delta_index
         self.delta_model = delta_model
+        # For time-bounded query: delta_index中每个Array的t的zone map，delta_index重建时置为None，使用时重建
+        self.t_blocks = None
+        # For query cache: delta_index插入/删除/重建时加1，query_cache中version不同的delta_index结果失效
+        self.version = 0
 
 
-def retrain_model(model_path, model_key, inputs, hr,
+def retrain_model(inputs, labels, model_path, model_key, hr,
                   weight, cores, train_step, batch_num, learning_rate,
-                  is_init, mp_dict):
-    inputs = [data[2] for data in inputs]
+                  is_init):
+    """
+    TrainPool的任务：inputs为hr的geohash列在共享内存上的切片，labels不使用
+    """
+    if isinstance(hr.model, AbstractSpline):
+        hr.model = fit_spline(inputs, hr.value, hr.value_diff, hr.model.err)
+        return hr, 1, 0
+    inputs = inputs.tolist()
     inputs.insert(0, hr.value)
     inputs.append(hr.value + hr.value_diff)
     inputs_num = hr.number + 2
@@ -767,7 +938,7 @@ def retrain_model(model_path, model_key, inputs, hr,
     hr.model.matrices = tmp_index.get_matrices()
     hr.model.min_err = math.floor(tmp_index.min_err)
     hr.model.max_err = math.ceil(tmp_index.max_err)
-    mp_dict[model_key] = (hr, 1, tmp_index.get_epochs())
+    return hr, 1, tmp_index.get_epochs()
 
 
 def main():
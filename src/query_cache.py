@@ -0,0 +1,51 @@
+from collections import OrderedDict
+
+
+class QueryCache:
+    """
+    有界的查询结果缓存，按lru淘汰，用于重复的点查询和范围查询（固定的站点、电子围栏）
+    1. key为查询的几何(point/window)，value为索引自己定义的可变条目，索引在命中时按条目记录的依赖校验和增量更新
+    2. 只负责查找、插入和淘汰，不判断条目是否失效
+    """
+
+    def __init__(self, capacity):
+        """
+        :param capacity: 缓存的查询数量
+        """
+        assert capacity > 0, "capacity of query cache must be positive"
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        # {key: entry}，末尾为最近访问
+        self.entries = OrderedDict()
+
+    def stats(self):
+        """
+        :return: hits, misses
+        """
+        return self.hits, self.misses
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        """
+        清空缓存，不重置统计
+        """
+        self.entries.clear()
+
+    def get(self, key, create):
+        """
+        获取key的条目，不存在时用create()创建并插入，缓存已满则淘汰最久没有访问的条目
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        if len(self.entries) >= self.capacity:
+            self.entries.popitem(last=False)
+        entry = self.entries[key] = create()
+        return entry
@@ -14,6 +14,7 @@ PAGE_SIZE = 4096
 RANGE_SIZE = 8 * 4 + 4  # 36
 REVMAP_SIZE = 4 + 2  # 6
 ITEM_SIZE = 8 * 2 + 4  # 20
+RANGES_PER_PAGE = int(PAGE_SIZE / RANGE_SIZE)
 
 
 class BRINSpatial(SpatialIndex):
@@ -55,15 +56,7 @@ class BRINSpatial(SpatialIndex):
             # 1. compute geohash from x/y of point
             gh = self.meta.geohash.encode(point[0], point[1])
             # 2. encode p to geohash and create index entry(x, y, geohash, t, pointer)
-            point = (point[0], point[1], gh, point[2], point[3])
-            # 3. append in xy index
-            self.index_entries.append(tuple(point))
-            # 3. create tmp blk and sort last blk if point is on the breakpoint
-            if point[-1] % self.meta.datas_per_range == 0:
-                target_points = sorted(self.index_entries[-self.meta.datas_per_range:], key=lambda x: x[2])
-                self.block_ranges[-1].value = get_mbr_by_points(target_points)
-                self.index_entries[-self.meta.datas_per_range:] = target_points
-                self.create_tmp_blk()
+            self.insert_sorted_ie((point[0], point[1], gh, point[2], point[3]))
         else:
             # 1. append in xy index
             self.index_entries.append(tuple(point))
@@ -72,10 +65,28 @@ class BRINSpatial(SpatialIndex):
                 self.block_ranges[-1].value = get_mbr_by_points(self.index_entries[-self.meta.datas_per_range:])
                 self.create_tmp_blk()
 
+    def insert_sorted_ie(self, ie):
+        # 3. append in xy index
+        self.index_entries.append(ie)
+        # 3. create tmp blk and sort last blk if point is on the breakpoint
+        if ie[-1] % self.meta.datas_per_range == 0:
+            target_points = sorted(self.index_entries[-self.meta.datas_per_range:], key=lambda x: x[2])
+            self.block_ranges[-1].value = get_mbr_by_points(target_points)
+            self.index_entries[-self.meta.datas_per_range:] = target_points
+            self.create_tmp_blk()
+
     def insert(self, points):
-        points = points.tolist()
-        for point in points:
-            self.insert_single(point)
+        if self.meta.is_sorted:
+            # 优化: 逐点encode->encode_batch
+            ghs = self.meta.geohash.encode_batch(points['0'], points['1']).tolist()
+            points = points.tolist()
+            for i in range(len(points)):
+                point = points[i]
+                self.insert_sorted_ie((point[0], point[1], ghs[i], point[2], point[3]))
+        else:
+            points = points.tolist()
+            for point in points:
+                self.insert_single(point)
         # 如果整体插入已经结束，则主动更新tmp br的value
         self.sum_up_tmp_blk()
 
@@ -117,6 +128,7 @@ class BRINSpatial(SpatialIndex):
         """
         找到可能包含xy的blk
         """
+        self.read_items('brins_blk', 0, len(self.block_ranges), RANGES_PER_PAGE)
         return [blk
                 for blk in self.block_ranges
                 if blk.value[0] <= point[1] <= blk.value[1] and blk.value[2] <= point[0] <= blk.value[3]]
@@ -126,9 +138,17 @@ class BRINSpatial(SpatialIndex):
         找到可能和window相交的blk及其空间关系(相交=1/window包含value=2)
         包含关系可以加速查询，即包含意味着blk内所有数据都符合条件
         """
+        self.read_items('brins_blk', 0, len(self.block_ranges), RANGES_PER_PAGE)
         return [[blk, intersect(window, blk.value)]
                 for blk in self.block_ranges]
 
+    def read_blk(self, blk):
+        """
+        访问blk对应的index_entries.npy中的页
+        """
+        self.read_items('index_entries', blk.blknum, min(blk.blknum + self.meta.datas_per_range, len(self.index_entries)),
+                        self.meta.datas_per_page)
+
     def binary_search_duplicate(self, x, left, right):
         """
         binary search geohash in ies[left, right]
@@ -169,10 +189,13 @@ class BRINSpatial(SpatialIndex):
             result = []
             for blk in blks:
                 self.io_cost += self.meta.pages_per_range
+                self.read_blk(blk)
                 result.extend(self.binary_search_duplicate(gh, blk.blknum, blk.blknum + self.meta.datas_per_range - 1))
             return result
         else:
             self.io_cost += math.ceil(len(blks) * self.meta.pages_per_range)
+            for blk in blks:
+                self.read_blk(blk)
             return [ie[-1]
                     for blk in blks
                     for ie in self.index_entries[blk.blknum: blk.blknum + self.meta.datas_per_range]
@@ -194,12 +217,14 @@ class BRINSpatial(SpatialIndex):
             elif target_blk[1] == 2:
                 blk = target_blk[0]
                 self.io_cost += self.meta.pages_per_range
+                self.read_blk(blk)
                 result.extend([ie[-1]
                                for ie in self.index_entries[blk.blknum:blk.blknum + self.meta.datas_per_range]])
             # 2. 精确过滤相交的blks对应磁盘范围内的数据
             else:
                 blk = target_blk[0]
                 self.io_cost += self.meta.pages_per_range
+                self.read_blk(blk)
                 result.extend([ie[-1]
                                for ie in self.index_entries[blk.blknum:blk.blknum + self.meta.datas_per_range]
                                if window[0] <= ie[1] <= window[1] and window[2] <= ie[0] <= window[3]])
@@ -231,6 +256,7 @@ class BRINSpatial(SpatialIndex):
                     elif target_blk[1] == 2:
                         blk = target_blk[0]
                         self.io_cost += self.meta.pages_per_range
+                        self.read_blk(blk)
                         tmp_tp_list.extend(
                             [[(ie[0] - x) ** 2 + (ie[1] - y) ** 2, ie[-1]]
                              for ie in self.index_entries[blk.blknum:blk.blknum + self.meta.datas_per_range]
@@ -239,6 +265,7 @@ class BRINSpatial(SpatialIndex):
                     else:
                         blk = target_blk[0]
                         self.io_cost += self.meta.pages_per_range
+                        self.read_blk(blk)
                         tmp_tp_list.extend(
                             [[(ie[0] - x) ** 2 + (ie[1] - y) ** 2, ie[-1]]
                              for ie in self.index_entries[blk.blknum:blk.blknum + self.meta.datas_per_range]
@@ -251,12 +278,14 @@ class BRINSpatial(SpatialIndex):
                     elif target_blk[1] == 2:
                         blk = target_blk[0]
                         self.io_cost += self.meta.pages_per_range
+                        self.read_blk(blk)
                         tmp_tp_list.extend(
                             [[(ie[0] - x) ** 2 + (ie[1] - y) ** 2, ie[-1]]
                              for ie in self.index_entries[blk.blknum:blk.blknum + self.meta.datas_per_range]])
                     else:
                         blk = target_blk[0]
                         self.io_cost += self.meta.pages_per_range
+                        self.read_blk(blk)
                         tmp_tp_list.extend(
                             [[(ie[0] - x) ** 2 + (ie[1] - y) ** 2, ie[-1]]
                              for ie in self.index_entries[blk.blknum:blk.blknum + self.meta.datas_per_range]
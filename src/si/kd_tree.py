@@ -32,8 +32,11 @@ class KDTree(SpatialIndex):
         self.logging = logging.getLogger(self.name)
         # for compute
         self.io_cost = 0
+        # {node: 节点在kd_tree.npy中所在的页}，节点和save一致按先序排列，用于buffer_pool，树变化后置为None，查询时重建
+        self.node_pages = None
 
     def insert_single(self, point):
+        self.node_pages = None
         self.root_node = self.root_node.insert((point[0], point[1], point[3]))
 
     def insert(self, points):
@@ -42,10 +45,33 @@ class KDTree(SpatialIndex):
         # balance: 将树调整回平衡状态，检索效率会提升
         # 理论上要在insert和delete时处理最后被更新的node和所有上层node，但是balance太耗时，此处旨在整体insert是操作一次
         self.root_node.balance()
+        self.node_pages = None
 
     def delete(self, point):
+        self.node_pages = None
         self.root_node = self.root_node.delete(point)
 
+    def get_node_pages(self):
+        if self.node_pages is None:
+            self.node_pages = {}
+            stack = [self.root_node]
+            while stack:
+                node = stack.pop()
+                self.node_pages[node] = len(self.node_pages) // NODES_PER_RA
+                if node.right:
+                    stack.append(node.right)
+                if node.left:
+                    stack.append(node.left)
+        return self.node_pages
+
+    def read_node(self, node):
+        """
+        访问节点在kd_tree.npy中所在的页
+        """
+        if self.buffer_pool is not None:
+            page_id = self.get_node_pages()[node]
+            self.read_pages('kd_tree', page_id, page_id)
+
     def build_node(self, values, value_len, axis):
         """
         通过del减少内存占用
@@ -78,6 +104,7 @@ class KDTree(SpatialIndex):
         # self.root_node = KDNode(value=data_list[0], axis=0)
         # self.insert(data_list[1:])
         self.root_node.balance()
+        self.node_pages = None
         # self.visualize("1.txt")
 
     def visualize(self, output_path):
@@ -93,6 +120,7 @@ class KDTree(SpatialIndex):
         return result
 
     def point_query_node(self, node, point, result):
+        self.read_node(node)
         if point[node.axis] > node.value[node.axis]:
             if node.right:
                 self.point_query_node(node.right, point, result)
@@ -117,6 +145,7 @@ class KDTree(SpatialIndex):
         return result
 
     def range_query_node(self, node, window, result):
+        self.read_node(node)
         if contain_value_2d(window, node.value):
             result.append(node.value[-1])
         if node.left:
@@ -132,6 +161,7 @@ class KDTree(SpatialIndex):
         window = [window[2], window[3], window[0], window[1]]
         while len(stack):
             cur = stack.pop(-1)
+            self.read_node(cur)
             if contain_value_2d(window, cur.value):
                 result.append(cur.value[-1])
             if cur.left:
@@ -159,6 +189,7 @@ class KDTree(SpatialIndex):
         return [itr[1] for itr in result_heap]
 
     def knn_query_node(self, node, value, nearest_distance, result_heap, n):
+        self.read_node(node)
         # 右-自己-左
         if value[node.axis] >= node.value[node.axis]:
             if node.right:
@@ -201,6 +232,7 @@ class KDTree(SpatialIndex):
         stack = [self.root_node]
         while len(stack):
             cur = stack.pop(-1)
+            self.read_node(cur)
             dist = distance_value(cur.value, value)
             if len(result) < n:
                 heapq.heappush(result, (-dist, cur.value[-1]))
@@ -225,6 +257,7 @@ class KDTree(SpatialIndex):
     def load(self):
         kd_tree = np.load(os.path.join(self.model_path, 'kd_tree.npy'), allow_pickle=True)
         self.root_node = list_to_tree(kd_tree, 0)
+        self.node_pages = None
 
     def size(self):
         """
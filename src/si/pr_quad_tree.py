@@ -37,8 +37,12 @@ class PRQuadTree(SpatialIndex):
         self.logging = logging.getLogger(self.name)
         # for compute
         self.io_cost = 0
+        # {node: (节点在prquadtree_tree.npy中的位置, items在prquadtree_item.npy中的偏移)}，和save的DFS顺序一致
+        # 用于把节点映射到buffer_pool的页，树或items变化后置为None，查询时重建
+        self.node_offsets = None
 
     def insert_single(self, point):
+        self.node_offsets = None
         self.insert_node(Point(point[0], point[1], key=point[2]), self.root_node)
 
     def insert_node(self, point, node):
@@ -106,6 +110,7 @@ class PRQuadTree(SpatialIndex):
         combine_flag = False
         if node is None:
             node = self.root_node
+            self.node_offsets = None
         if node.is_leaf == 1:
             for i in range(len(node.items)):
                 if node.items[i] == point and node.items[i].key == point.key:
@@ -145,13 +150,43 @@ class PRQuadTree(SpatialIndex):
         node.LU = None
         node.RU = None
 
+    def get_node_offsets(self):
+        if self.node_offsets is None:
+            self.node_offsets = {}
+            item_offset = 0
+            stack = [self.root_node]
+            while stack:
+                node = stack.pop()
+                self.node_offsets[node] = (len(self.node_offsets), item_offset)
+                item_offset += len(node.items)
+                stack.extend([child for child in (node.RU, node.RB, node.LU, node.LB) if child is not None])
+        return self.node_offsets
+
+    def read_node(self, node):
+        """
+        访问节点在prquadtree_tree.npy中所在的页
+        """
+        if self.buffer_pool is not None:
+            page_id = self.get_node_offsets()[node][0] // NODES_PER_PAGE
+            self.read_pages('prquadtree_tree', page_id, page_id)
+
+    def read_leaf(self, node):
+        """
+        访问叶节点的items在prquadtree_item.npy中所在的页
+        """
+        if self.buffer_pool is not None:
+            item_offset = self.get_node_offsets()[node][1]
+            self.read_items('prquadtree_item', item_offset, item_offset + len(node.items), ITEMS_PER_PAGE)
+
     def search(self, point, node=None):
         if node is None:
             node = self.root_node
         if node.is_leaf == 1:
             self.io_cost += math.ceil(len(node.items) / ITEMS_PER_PAGE)
+            self.read_leaf(node)
             return [item.key for item in node.items if item == point]
         self.io_cost += 1
+        self.read_node(node)
         y_center = (node.region.up + node.region.bottom) / 2
         x_center = (node.region.left + node.region.right) / 2
         if point.lat < y_center:
@@ -177,6 +212,7 @@ class PRQuadTree(SpatialIndex):
         if node.is_leaf == 1:
             return node
         self.io_cost += 1
+        self.read_node(node)
         y_center = (node.region.up + node.region.bottom) / 2
         x_center = (node.region.left + node.region.right) / 2
         if point.lat < y_center:
@@ -194,6 +230,7 @@ class PRQuadTree(SpatialIndex):
         self.threshold_number = threshold_number
         self.max_depth = region.get_max_depth_by_region_and_precision(precision=data_precision)
         self.root_node = Node(region=region)
+        self.node_offsets = None
         self.insert(data_list)
 
     def point_query_single(self, point):
@@ -206,38 +243,41 @@ class PRQuadTree(SpatialIndex):
     def range_search_by_iter(self, region, result, node=None):
         node = self.root_node if node is None else node
         if node.region == region:
-            tmp_result = []
-            node.get_all_items(tmp_result)
-            for items in tmp_result:
-                self.io_cost += math.ceil(len(items) / ITEMS_PER_PAGE)
-                result.extend([item.key for item in items])
+            leaves = []
+            node.get_all_leaves(leaves)
+            for leaf in leaves:
+                self.io_cost += math.ceil(len(leaf.items) / ITEMS_PER_PAGE)
+                self.read_leaf(leaf)
+                result.extend([item.key for item in leaf.items])
             return
         if node.is_leaf == 1:
             self.io_cost += math.ceil(len(node.items) / ITEMS_PER_PAGE)
+            self.read_leaf(node)
             result.extend([item.key for item in node.items if region.contain_and_border_by_point(item)])
         else:
             self.io_cost += 1
+            self.read_node(node)
             # 所有的or：region的四至点刚好在子节点的region上，因为split的时候经纬度都是向上取整，所以子节点的重心在右和上
             if node.LB.region.contain(Point(region.left, region.bottom)):
-                self.range_search(Region(region.bottom, min(node.LB.region.up, region.up),
-                                         region.left, min(node.LB.region.right, region.right)),
-                                  result, node.LB)
+                self.range_search_by_iter(Region(region.bottom, min(node.LB.region.up, region.up),
+                                                 region.left, min(node.LB.region.right, region.right)),
+                                          result, node.LB)
             if node.RB.region.contain(Point(region.right, region.bottom)) \
                     or (region.bottom < node.RB.region.up and region.right == node.RB.region.right):
-                self.range_search(Region(region.bottom, min(node.LB.region.up, region.up),
-                                         max(node.RU.region.left, region.left), region.right),
-                                  result, node.RB)
+                self.range_search_by_iter(Region(region.bottom, min(node.LB.region.up, region.up),
+                                                 max(node.RU.region.left, region.left), region.right),
+                                          result, node.RB)
             if node.LU.region.contain(Point(region.left, region.up)) \
                     or (region.left < node.LU.region.right and region.up == node.LU.region.up):
-                self.range_search(Region(max(node.RU.region.bottom, region.bottom), region.up,
-                                         region.left, min(node.LB.region.right, region.right)),
-                                  result, node.LU)
+                self.range_search_by_iter(Region(max(node.RU.region.bottom, region.bottom), region.up,
+                                                 region.left, min(node.LB.region.right, region.right)),
+                                          result, node.LU)
             if node.RU.region.contain(Point(region.right, region.up)) \
                     or (region.right > node.RU.region.left and region.up == node.RU.region.up) \
                     or (region.up > node.RU.region.bottom and region.right == node.RU.region.right):
-                self.range_search(Region(max(node.RU.region.bottom, region.bottom), region.up,
-                                         max(node.RU.region.left, region.left), region.right),
-                                  result, node.RU)
+                self.range_search_by_iter(Region(max(node.RU.region.bottom, region.bottom), region.up,
+                                                 max(node.RU.region.left, region.left), region.right),
+                                          result, node.RU)
 
     def range_query_single(self, window):
         result = []
@@ -265,6 +305,7 @@ class PRQuadTree(SpatialIndex):
             if cur.region.within_distance_pow(point, -nearest_distance[0]):
                 if cur.is_leaf:
                     self.io_cost += math.ceil(len(cur.items) / ITEMS_PER_PAGE)
+                    self.read_leaf(cur)
                     for item in cur.items:
                         point_distance = point.distance_pow(item)
                         if len(point_heap) < n:
@@ -293,6 +334,7 @@ class PRQuadTree(SpatialIndex):
         point_heap = []
         point_node = self.search_node(point)
         self.io_cost += math.ceil(len(point_node.items) / ITEMS_PER_PAGE)
+        self.read_leaf(point_node)
         for item in point_node.items:
             point_distance = point.distance_pow(item)
             if len(point_heap) < n:
@@ -310,6 +352,7 @@ class PRQuadTree(SpatialIndex):
             if cur.region.within_distance_pow(point, -nearest_distance[0]):
                 if cur.is_leaf:
                     self.io_cost += math.ceil(len(cur.items) / ITEMS_PER_PAGE)
+                    self.read_leaf(cur)
                     for item in cur.items:
                         point_distance = point.distance_pow(item)
                         if len(point_heap) < n:
@@ -344,6 +387,7 @@ class PRQuadTree(SpatialIndex):
         prqt_item = np.load(os.path.join(self.model_path, 'prquadtree_item.npy'), allow_pickle=True)
         prqt_meta = np.load(os.path.join(self.model_path, 'prquadtree_meta.npy'))
         self.root_node = list_to_tree(prqt_tree, prqt_item)
+        self.node_offsets = None
         self.max_depth = prqt_meta[0]
         self.threshold_number = prqt_meta[1]
 
@@ -368,14 +412,14 @@ class Node:
         self.RU = RU
         self.items = items if items else []
 
-    def get_all_items(self, result):
+    def get_all_leaves(self, result):
         if self.is_leaf == 1:
-            result.append(self.items)
+            result.append(self)
         else:
-            self.LB.get_all_items(result)
-            self.RB.get_all_items(result)
-            self.LU.get_all_items(result)
-            self.RU.get_all_items(result)
+            self.LB.get_all_leaves(result)
+            self.RB.get_all_leaves(result)
+            self.LU.get_all_leaves(result)
+            self.RU.get_all_leaves(result)
 
 
 def tree_to_list(node, node_list, item_list):
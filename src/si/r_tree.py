@@ -32,13 +32,36 @@ class RTree(SpatialIndex):
         self.logging = logging.getLogger(self.name)
         # for compute
         self.io_cost = 0
+        # 叶节点的id和MBR[[minx, miny, maxx, maxy]]，RT_Disk下节点id即节点在rtree.data中的页，用于buffer_pool
+        # 树变化后置为None，查询时重建
+        self.leaf_pages = None
 
     def insert_single(self, point):
+        self.leaf_pages = None
         self.index.insert(point[-1], (point[0], point[1]))
 
     def delete(self, point):
+        self.leaf_pages = None
         self.index.delete(point.key, (point.lng, point.lat))
 
+    def get_leaf_pages(self):
+        if self.leaf_pages is None:
+            leaves = self.index.leaves()
+            self.leaf_pages = (np.array([leaf[0] for leaf in leaves], dtype=np.int64),
+                               np.array([leaf[2] for leaf in leaves], dtype=np.float64).reshape(-1, 4))
+        return self.leaf_pages
+
+    def read_leaves(self, window):
+        """
+        访问MBR和window=[y1, y2, x1, x2]相交的叶节点所在的页
+        树的遍历在libspatialindex内部，只统计查询必须访问的叶节点，非叶节点数量少且常驻缓存，不统计
+        """
+        if self.buffer_pool is not None:
+            leaf_ids, mbrs = self.get_leaf_pages()
+            for leaf_id in leaf_ids[(mbrs[:, 0] <= window[3]) & (window[2] <= mbrs[:, 2]) &
+                                    (mbrs[:, 1] <= window[1]) & (window[0] <= mbrs[:, 3])].tolist():
+                self.read_pages('rtree', leaf_id, leaf_id)
+
     def build(self, data_list, fill_factor, leaf_node_capacity, non_leaf_node_capacity, buffering_capacity):
         self.fill_factor = fill_factor
         self.leaf_node_capacity = leaf_node_capacity
@@ -56,6 +79,7 @@ class RTree(SpatialIndex):
         p.leaf_capacity = leaf_node_capacity
         p.index_capacity = non_leaf_node_capacity
         self.index = index.Index(os.path.join(self.model_path, 'rtree'), properties=p, overwrite=True)
+        self.leaf_pages = None
         # self.index = index.RtreeContainer(properties=p)  # 没有直接Index来得快，range_query慢了一倍
         self.insert(data_list)
 
@@ -64,13 +88,26 @@ class RTree(SpatialIndex):
         1. search by x/y
         2. for duplicate point: only return the first one
         """
+        self.read_leaves([point[1], point[1], point[0], point[0]])
         return list(self.index.intersection((point[0], point[1])))
 
     def range_query_single(self, window):
+        self.read_leaves(window)
         return list(self.index.intersection((window[2], window[0], window[3], window[1])))
 
     def knn_query_single(self, knn):
-        return list(self.index.nearest((knn[0], knn[1]), int(knn[2])))[:int(knn[2])]
+        if self.buffer_pool is None:
+            return list(self.index.nearest((knn[0], knn[1]), int(knn[2])))[:int(knn[2])]
+        items = list(self.index.nearest((knn[0], knn[1]), int(knn[2]), objects=True))[:int(knn[2])]
+        # 访问和查询点的距离不超过第k近邻的叶节点
+        if items:
+            dst = max((item.bbox[0] - knn[0]) ** 2 + (item.bbox[1] - knn[1]) ** 2 for item in items)
+            leaf_ids, mbrs = self.get_leaf_pages()
+            dxs = np.maximum(np.maximum(mbrs[:, 0] - knn[0], knn[0] - mbrs[:, 2]), 0)
+            dys = np.maximum(np.maximum(mbrs[:, 1] - knn[1], knn[1] - mbrs[:, 3]), 0)
+            for leaf_id in leaf_ids[dxs ** 2 + dys ** 2 <= dst].tolist():
+                self.read_pages('rtree', leaf_id, leaf_id)
+        return [item.id for item in items]
 
     def save(self):
         rtree_meta = (self.fill_factor, self.leaf_node_capacity, self.non_leaf_node_capacity, self.buffering_capacity)
@@ -95,6 +132,7 @@ class RTree(SpatialIndex):
         self.non_leaf_node_capacity = rtree_meta[2]
         self.buffering_capacity = rtree_meta[3]
         self.index = index.Index(os.path.join(self.model_path, 'rtree'), properties=p, overwrite=False)
+        self.leaf_pages = None
 
     def size(self):
         """
@@ -1,6 +1,5 @@
 import logging
 import math
-import multiprocessing
 import os
 import time
 
@@ -10,10 +9,11 @@ from src.experiment.common_utils import load_data, Distribution, data_region, da
 from src.mlp import MLP
 from src.mlp_simple import MLPSimple
 from src.spatial_index import SpatialIndex
+from src.train_pool import get_train_pool
 from src.utils.common_utils import Region, biased_search_duplicate, normalize_input_minmax, \
     denormalize_output_minmax, binary_search_less_max, binary_search_duplicate, normalize_output, normalize_input, \
-    relu, denormalize_outputs_minmax
-from src.utils.geohash_utils import Geohash
+    relu, denormalize_outputs_minmax, PiecewiseLinearNN, ErrorBoundedSpline
+from src.utils.geohash_utils import Geohash, curves
 
 PAGE_SIZE = 4096
 MODEL_SIZE = 2000
@@ -52,11 +52,13 @@ class ZMIndex(SpatialIndex):
 
     def build(self, data_list, is_sorted, data_precision, region, is_new, is_simple, weight,
               stages, cores, train_steps, batch_nums, learning_rates, use_thresholds, thresholds, retrain_time_limits,
-              thread_pool_size):
+              thread_pool_size, leaf_model='nn', spline_err=32, curve='Geohash'):
         """
         build index
         1. ordering x/y point by geohash
         2. create rmi to train geohash->key data
+        leaf_model: 叶节点的模型类型，nn=AbstractNN，spline=误差有界的分段线性样条AbstractSpline，spline_err为样条的key误差上限
+        curve: 空间填充曲线的name，Geohash=z-order，Hilbert=Hilbert曲线，见geohash_utils.curves
         """
         self.weight = weight
         self.cores = cores[-1]
@@ -69,7 +71,7 @@ class ZMIndex(SpatialIndex):
         model_png_dir = os.path.join(self.model_path, "../proposed_sli/png/")
         if os.path.exists(model_png_dir) is False:
             os.makedirs(model_png_dir)
-        self.geohash = Geohash.init_by_precision(data_precision=data_precision, region=region)
+        self.geohash = curves[curve].init_by_precision(data_precision=data_precision, region=region)
         self.stages = stages
         stage_len = len(stages)
         self.non_leaf_stage_len = stage_len - 1
@@ -80,9 +82,11 @@ class ZMIndex(SpatialIndex):
         data_len = len(data_list)
         self.max_key = data_len
         if not is_sorted:
-            data_list = [(data[0], data[1], self.geohash.encode(data[0], data[1]), data[2], data[3])
-                         for data in data_list]
-            data_list = sorted(data_list, key=lambda x: x[2])
+            # 优化: 逐点encode->encode_batch，sorted->argsort
+            ghs = self.geohash.encode_batch(data_list['0'], data_list['1'])
+            order = np.argsort(ghs, kind='stable')
+            data_list = list(zip(data_list['0'][order].tolist(), data_list['1'][order].tolist(), ghs[order].tolist(),
+                                 data_list['2'][order].tolist(), data_list['3'][order].tolist()))
         else:
             data_list = data_list.tolist()
         train_inputs[0][0] = data_list
@@ -96,15 +100,21 @@ class ZMIndex(SpatialIndex):
             use_threshold = use_thresholds[i]
             threshold = thresholds[i]
             retrain_time_limit = retrain_time_limits[i]
-            pool = multiprocessing.Pool(processes=thread_pool_size)
             task_size = stages[i]
-            mp_list = multiprocessing.Manager().list([None] * task_size)
+            mp_list = [None] * task_size
             train_input = train_inputs[i]
             train_label = train_labels[i]
+            # 优化: 每个stage新建Pool+Manager且pickle每个node的inputs/labels->复用TrainPool，
+            # 整个stage的inputs/labels拼接后通过shared_memory发布一次，任务只传(offset, length)
+            all_inputs = []
+            all_labels = []
+            tasks = []
+            args = (self.model_path, i, is_new, is_simple, weight, core, train_step, batch_num, learning_rate,
+                    use_threshold, threshold, retrain_time_limit)
             # 2.1 create non-leaf node
             if i < self.non_leaf_stage_len:
                 for j in range(task_size):
-                    if train_label[j] is None:
+                    if not train_label[j]:
                         continue
                     else:
                         # build inputs
@@ -113,11 +123,11 @@ class ZMIndex(SpatialIndex):
                         divisor = stages[i + 1] * 1.0 / data_len
                         labels = [int(k * divisor) for k in train_label[j]]
                         # train model
-                        pool.apply_async(build_nn, (self.model_path, i, j, inputs, labels, is_new, is_simple,
-                                                    weight, core, train_step, batch_num, learning_rate,
-                                                    use_threshold, threshold, retrain_time_limit, mp_list))
-                pool.close()
-                pool.join()
+                        tasks.append((j, len(all_inputs), len(inputs), (j,) + args))
+                        all_inputs.extend(inputs)
+                        all_labels.extend(labels)
+                for j, model in self.train_nodes(thread_pool_size, all_inputs, all_labels, tasks).items():
+                    mp_list[j] = model
                 nodes = [Node(None, model, None) for model in mp_list]
                 for j in range(task_size):
                     node = nodes[j]
@@ -137,17 +147,30 @@ class ZMIndex(SpatialIndex):
                     labels = list(range(0, len(inputs)))
                     if not labels:
                         continue
-                    pool.apply_async(build_nn, (self.model_path, i, j, inputs, labels, is_new, is_simple,
-                                                weight, core, train_step, batch_num, learning_rate,
-                                                use_threshold, threshold, retrain_time_limit, mp_list))
-                pool.close()
-                pool.join()
+                    if leaf_model == 'spline':
+                        mp_list[j] = fit_spline(inputs, labels, spline_err)
+                        continue
+                    tasks.append((j, len(all_inputs), len(inputs), (j,) + args))
+                    all_inputs.extend(inputs)
+                    all_labels.extend(labels)
+                for j, model in self.train_nodes(thread_pool_size, all_inputs, all_labels, tasks).items():
+                    mp_list[j] = model
                 nodes = [Node(train_input[j], mp_list[j], Array()) for j in range(task_size)]
             self.rmi[i] = nodes
             # clear the data already used
             train_inputs[i] = None
             train_labels[i] = None
 
+    def train_nodes(self, thread_pool_size, inputs, labels, tasks):
+        """
+        用TrainPool训练一个stage的nn节点
+        :return: {node_id: AbstractNN}
+        """
+        if not tasks:
+            return {}
+        return get_train_pool(thread_pool_size).map(train_node, np.array(inputs, dtype=np.int64),
+                                                    np.array(labels, dtype=np.int64), tasks)
+
     def get_leaf_node(self, key):
         """
         get the leaf node which contains the key
@@ -156,9 +179,24 @@ class ZMIndex(SpatialIndex):
         """
         node_key = 0
         for i in range(0, self.non_leaf_stage_len):
-            node_key = int(self.rmi[i][node_key].model.predict(key))
+            self.read_model(i, node_key)
+            node_key = int(self.rmi[i][node_key].model.predict_fast(key))
         return node_key
 
+    def read_model(self, stage, node_key):
+        """
+        访问第stage层第node_key个节点的model在models.npy中的页
+        """
+        if self.buffer_pool is not None:
+            model_key = sum(len(nodes) for nodes in self.rmi[:stage]) + node_key
+            self.buffer_pool.read_items('models', model_key, model_key + 1, MODELS_PER_PAGE)
+
+    def read_node(self, node_key, start, end, is_delta=False):
+        """
+        访问第node_key个叶节点的index(is_delta时为delta_index)中第[start, end)项所在的页
+        """
+        self.read_items(('delta_index' if is_delta else 'index', node_key), start, end, ITEMS_PER_PAGE)
+
     def insert_single(self, point):
         """
         1. compute geohash from x/y of point
@@ -177,6 +215,7 @@ class ZMIndex(SpatialIndex):
         delta_index.insert(binary_search_less_max(delta_index.index, 2, gh, 0, delta_index.max_key) + 1, point)
         # IO1: search key
         self.io_cost += math.ceil((delta_index.max_key + 1) / ITEMS_PER_PAGE)
+        self.read_node(node_key, 0, delta_index.max_key + 1, True)
 
     def insert(self, points):
         points = points.tolist()
@@ -203,7 +242,8 @@ class ZMIndex(SpatialIndex):
                     break
             return self.rmi[-1][node_key], node_key, self.rmi[-1][node_key].model.output_max, 0, 0
         # 3. predict the key by leaf_node
-        pre = int(leaf_node.model.predict(key))
+        self.read_model(len(self.stages) - 1, node_key)
+        pre = int(leaf_node.model.predict_fast(key))
         return leaf_node, node_key, pre, leaf_node.model.min_err, leaf_node.model.max_err
 
     def get_weight(self, key):
@@ -227,13 +267,14 @@ class ZMIndex(SpatialIndex):
         # 1. compute geohash from x/y of point
         gh = self.geohash.encode(point[0], point[1])
         # 2. predict by geohash and create key scope [pre - min_err, pre + max_err]
-        leaf_node, _, pre, min_err, max_err = self.predict(gh)
+        leaf_node, leaf_key, pre, min_err, max_err = self.predict(gh)
         l_bound = max(pre - max_err, leaf_node.model.output_min)
         r_bound = min(pre - min_err, leaf_node.model.output_max)
         # 3. binary search in scope
         result = [leaf_node.index[key][4] for key in
                   biased_search_duplicate(leaf_node.index, 2, gh, pre, l_bound, r_bound)]
         self.io_cost += math.ceil((r_bound - l_bound) / ITEMS_PER_PAGE)
+        self.read_node(leaf_key, l_bound, r_bound + 1)
         # 4. filter in delta index
         delta_index = leaf_node.delta_index
         if delta_index.max_key >= 0:
@@ -241,19 +282,19 @@ class ZMIndex(SpatialIndex):
                            for key in
                            binary_search_duplicate(delta_index.index, 2, gh, 0, delta_index.max_key)])
             self.io_cost += math.ceil((delta_index.max_key + 1) / ITEMS_PER_PAGE)
+            self.read_node(leaf_key, 0, delta_index.max_key + 1, True)
         return result
 
     def range_query_single(self, window):
         """
-        1. compute geohash from window_left and window_right
+        1. compute geohash range [gh1, gh2] of window, z-order is [window_left, window_right]
         2. find left_key by point query
         3. find right_key by point query
         4. filter all the points of scope[left_key, right_key] by range(x1/y1/x2/y2).contain(point)
         5. filter in delta index
         """
-        # 1. compute z of window_left and window_right
-        gh1 = self.geohash.encode(window[2], window[0])
-        gh2 = self.geohash.encode(window[3], window[1])
+        # 1. compute geohash range of window
+        gh1, gh2 = self.geohash.encode_window(window)
         # 2. find left_key by point query
         # if point not found, left_key = pre - min_err
         leaf_node1, leaf_key1, pre1, min_err1, max_err1 = self.predict(gh1)
@@ -277,6 +318,7 @@ class ZMIndex(SpatialIndex):
             result = [ie[4] for ie in leaf_node1.index[left_key:right_key + 1]
                       if window[0] <= ie[1] <= window[1] and window[2] <= ie[0] <= window[3]]
             io_index_len += r_bound2 - l_bound1
+            self.read_node(leaf_key1, l_bound1, r_bound2 + 1)
             # filter delta index
             delta_index = leaf_node1.delta_index
             if delta_index.max_key >= 0:
@@ -286,9 +328,16 @@ class ZMIndex(SpatialIndex):
                                for ie in delta_index.index[left_key:right_key + 1]
                                if window[0] <= ie[1] <= window[1] and window[2] <= ie[0] <= window[3]])
                 io_delta_index_len += delta_index.max_key + 1
+                self.read_node(leaf_key1, 0, delta_index.max_key + 1, True)
         else:
             # filter index
             io_index_len += len(leaf_node1.index) + r_bound2 - l_bound1
+            self.read_node(leaf_key1, l_bound1, len(leaf_node1.index))
+            self.read_node(leaf_key2, 0, r_bound2 + 1)
+            if self.buffer_pool is not None:
+                for leaf_key in range(leaf_key1 + 1, leaf_key2):
+                    self.read_node(leaf_key, 0, len(self.rmi[-1][leaf_key].index))
+                    self.read_node(leaf_key, 0, len(self.rmi[-1][leaf_key].delta_index.index), True)
             result = [ie[4]
                       for ie in leaf_node1.index[left_key:]
                       if window[0] <= ie[1] <= window[1] and window[2] <= ie[0] <= window[3]]
@@ -306,6 +355,7 @@ class ZMIndex(SpatialIndex):
             delta_index = leaf_node1.delta_index
             if delta_index.max_key >= 0:
                 io_index_len += delta_index.max_key + 1
+                self.read_node(leaf_key1, 0, delta_index.max_key + 1, True)
                 left_key = binary_search_less_max(delta_index.index, 2, gh1, 0, delta_index.max_key)
                 result.extend([ie[4]
                                for ie in delta_index.index[left_key:]
@@ -320,6 +370,7 @@ class ZMIndex(SpatialIndex):
             delta_index = leaf_node2.delta_index
             if delta_index.max_key >= 0:
                 io_index_len += delta_index.max_key + 1
+                self.read_node(leaf_key2, 0, delta_index.max_key + 1, True)
                 right_key = binary_search_less_max(delta_index.index, 2, gh1, 0, delta_index.max_key)
                 result.extend([ie[4]
                                for ie in delta_index.index[:right_key + 1]
@@ -348,8 +399,7 @@ class ZMIndex(SpatialIndex):
             # limit window within region
             self.geohash.region.clip_region(window, self.geohash.data_precision)
             # 2. iter: query target points by range query
-            gh1 = self.geohash.encode(window[2], window[0])
-            gh2 = self.geohash.encode(window[3], window[1])
+            gh1, gh2 = self.geohash.encode_window(window)
             leaf_node1, leaf_key1, pre1, min_err1, max_err1 = self.predict(gh1)
             l_bound1 = max(pre1 - max_err1, 0)
             r_bound1 = min(pre1 - min_err1, leaf_node1.model.output_max)
@@ -366,6 +416,7 @@ class ZMIndex(SpatialIndex):
                 tp_list = [ie for ie in leaf_node1.index[left_key:right_key]
                            if window[0] <= ie[1] <= window[1] and window[2] <= ie[0] <= window[3]]
                 io_index_len += right_key - left_key
+                self.read_node(leaf_key1, left_key, right_key)
                 delta_index = leaf_node1.delta_index
                 if delta_index.max_key >= 0:
                     delta_left_key = binary_search_less_max(delta_index.index, 2, gh1, 0, delta_index.max_key)
@@ -374,25 +425,30 @@ class ZMIndex(SpatialIndex):
                     tp_list.extend([ie for ie in delta_index.index[delta_left_key:delta_right_key]
                                     if window[0] <= ie[1] <= window[1] and window[2] <= ie[0] <= window[3]])
                     io_delta_index_len += delta_right_key - delta_left_key
+                    self.read_node(leaf_key1, delta_left_key, delta_right_key, True)
             else:
                 tp_list = [ie for ie in leaf_node1.index[left_key:]
                            if window[0] <= ie[1] <= window[1] and window[2] <= ie[0] <= window[3]]
                 io_index_len += len(leaf_node1.index) - left_key
+                self.read_node(leaf_key1, left_key, len(leaf_node1.index))
                 delta_index = leaf_node1.delta_index
                 if delta_index.max_key >= 0:
                     delta_left_key = binary_search_less_max(delta_index.index, 2, gh1, 0, delta_index.max_key)
                     tp_list.extend([ie for ie in delta_index.index[delta_left_key:]
                                     if window[0] <= ie[1] <= window[1] and window[2] <= ie[0] <= window[3]])
                     io_delta_index_len += delta_index.max_key - delta_left_key + 1
+                    self.read_node(leaf_key1, delta_left_key, delta_index.max_key + 1, True)
                 tp_list.extend([ie for ie in leaf_node2.index[:right_key]
                                 if window[0] <= ie[1] <= window[1] and window[2] <= ie[0] <= window[3]])
                 io_index_len += len(leaf_node1.index) + right_key
+                self.read_node(leaf_key2, 0, right_key)
                 delta_index = leaf_node2.delta_index
                 if delta_index.max_key >= 0:
                     delta_right_key = binary_search_less_max(delta_index.index, 2, gh2, 0, delta_index.max_key) + 1
                     tp_list.extend([ie for ie in delta_index.index[:delta_right_key]
                                     if window[0] <= ie[1] <= window[1] and window[2] <= ie[0] <= window[3]])
                     io_delta_index_len += delta_right_key
+                    self.read_node(leaf_key2, 0, delta_right_key, True)
                 tp_list.extend([ie for leaf_key in range(leaf_key1 + 1, leaf_key2)
                                 for ie in self.rmi[-1][leaf_key].index
                                 if window[0] <= ie[1] <= window[1] and window[2] <= ie[0] <= window[3]])
@@ -402,6 +458,10 @@ class ZMIndex(SpatialIndex):
                                 if window[0] <= ie[1] <= window[1] and window[2] <= ie[0] <= window[3]])
                 io_delta_index_len += sum(
                     [len(self.rmi[-1][leaf_key].delta_index.index) for leaf_key in range(leaf_key1 + 1, leaf_key2)])
+                if self.buffer_pool is not None:
+                    for leaf_key in range(leaf_key1 + 1, leaf_key2):
+                        self.read_node(leaf_key, 0, len(self.rmi[-1][leaf_key].index))
+                        self.read_node(leaf_key, 0, len(self.rmi[-1][leaf_key].delta_index.index), True)
             # 3. if target points is not enough, set window = 2 * window
             if len(tp_list) < k:
                 window_radius *= 2
@@ -421,10 +481,12 @@ class ZMIndex(SpatialIndex):
         meta = np.array((self.geohash.data_precision,
                          self.geohash.region.bottom, self.geohash.region.up,
                          self.geohash.region.left, self.geohash.region.right,
-                         self.weight, self.train_step, self.batch_num, self.learning_rate),
+                         self.weight, self.train_step, self.batch_num, self.learning_rate,
+                         self.geohash.name),
                         dtype=[("0", 'i4'),
                                ("1", 'f8'), ("2", 'f8'), ("3", 'f8'), ("4", 'f8'),
-                               ("5", 'f4'), ("6", 'i2'), ("7", 'i2'), ("8", 'f4')])
+                               ("5", 'f4'), ("6", 'i2'), ("7", 'i2'), ("8", 'f4'),
+                               ("9", 'U16')])
         np.save(os.path.join(self.model_path, 'meta.npy'), meta)
         np.save(os.path.join(self.model_path, 'stages.npy'), self.stages)
         np.save(os.path.join(self.model_path, 'cores.npy'), self.cores)
@@ -449,10 +511,16 @@ class ZMIndex(SpatialIndex):
                 np.array(delta_indexes, dtype=[("0", 'f8'), ("1", 'f8'), ("2", 'i8'), ("3", 'i4'), ("4", 'i4')]))
         np.save(os.path.join(self.model_path, 'delta_index_lens.npy'), delta_index_lens)
 
-    def load(self):
+    def load(self, mmap=False):
+        """
+        mmap=True时indexes.npy以只读内存映射打开，叶节点的index为映射上的视图而不是list，查询只读入实际访问的页
+        叶节点的index在查询中只读，插入只写delta_index，因此可以直接使用只读视图
+        """
         meta = np.load(os.path.join(self.model_path, 'meta.npy'), allow_pickle=True).item()
         region = Region(meta[1], meta[2], meta[3], meta[4])
-        self.geohash = Geohash.init_by_precision(data_precision=meta[0], region=region)
+        # 没有记录曲线的旧版本meta为Geohash
+        curve = curves[meta[9]] if len(meta) > 9 else Geohash
+        self.geohash = curve.init_by_precision(data_precision=meta[0], region=region)
         self.stages = np.load(os.path.join(self.model_path, 'stages.npy'), allow_pickle=True).tolist()
         self.non_leaf_stage_len = len(self.stages) - 1
         self.cores = np.load(os.path.join(self.model_path, 'cores.npy'), allow_pickle=True).tolist()
@@ -461,7 +529,10 @@ class ZMIndex(SpatialIndex):
         self.batch_num = meta[7]
         self.learning_rate = meta[8]
         models = np.load(os.path.join(self.model_path, 'models.npy'), allow_pickle=True)
-        indexes = np.load(os.path.join(self.model_path, 'indexes.npy'), allow_pickle=True).tolist()
+        if mmap:
+            indexes = np.load(os.path.join(self.model_path, 'indexes.npy'), mmap_mode='r')
+        else:
+            indexes = np.load(os.path.join(self.model_path, 'indexes.npy'), allow_pickle=True).tolist()
         index_lens = np.load(os.path.join(self.model_path, 'index_lens.npy'), allow_pickle=True).tolist()
         delta_indexes = np.load(os.path.join(self.model_path, 'delta_indexes.npy'), allow_pickle=True).tolist()
         delta_index_lens = np.load(os.path.join(self.model_path, 'delta_index_lens.npy'), allow_pickle=True).tolist()
@@ -489,6 +560,10 @@ class ZMIndex(SpatialIndex):
                     delta_index_cur += size
                     delta_index_len_cur += 2
                 self.rmi.append(leaf_nodes)
+        for stage in self.rmi:
+            for node in stage:
+                if node.model is not None:
+                    node.model.compile()
 
     def size(self):
         """
@@ -582,6 +657,38 @@ def build_nn(model_path, curr_stage, current_stage_step, inputs, labels, is_new,
     mp_list[current_stage_step] = abstract_index
 
 
+def train_node(inputs, labels, current_stage_step, model_path, curr_stage, is_new, is_simple,
+               weight, core, train_step, batch_num, learning_rate,
+               use_threshold, threshold, retrain_time_limit):
+    """
+    TrainPool的任务：inputs/labels为节点训练数据在共享内存上的切片
+    """
+    tmp_dict = {}
+    build_nn(model_path, curr_stage, current_stage_step, inputs.tolist(), labels.tolist(), is_new, is_simple,
+             weight, core, train_step, batch_num, learning_rate,
+             use_threshold, threshold, retrain_time_limit, tmp_dict)
+    return tmp_dict[current_stage_step]
+
+
+def fit_spline(inputs, labels, err):
+    """
+    用误差有界的分段线性样条拟合叶节点，输入输出的归一化和nn一致，err为key的误差上限
+    """
+    inputs = np.array(inputs)
+    labels = np.array(labels)
+    input_min, input_max = int(inputs[0]), int(inputs[-1])
+    output_min, output_max = int(labels[0]), int(labels[-1])
+    xs = normalize_input_minmax(inputs, input_min, input_max)
+    if output_max > output_min:
+        ys = (labels - output_min) / (output_max - output_min)
+        spline = ErrorBoundedSpline.fit(xs, ys, err / (output_max - output_min))
+    else:
+        spline = ErrorBoundedSpline.fit(xs, np.zeros(len(labels)), 0)
+    errs = denormalize_outputs_minmax(spline.predicts(xs), output_min, output_max) - labels
+    return AbstractSpline(spline, input_min, input_max, output_min, output_max,
+                          math.floor(errs.min()), math.ceil(errs.max()), err)
+
+
 class Node:
     def __init__(self, index, model, delta_index, delta_model=None):
         self.index = index
@@ -633,6 +740,33 @@ class AbstractNN:
         y = np.dot(y, self.matrices[-2]) + self.matrices[-1]
         return denormalize_output_minmax(y[0, 0], self.output_min, self.output_max)
 
+    def compile(self):
+        """
+        隐藏层数=1时编译为PiecewiseLinearNN，供predict_fast使用
+        """
+        self.compiled = PiecewiseLinearNN(self.matrices) if self.hl_nums == 1 else None
+
+    def predict_fast(self, input_key):
+        """
+        predict的快速版本，predict作为参照
+        优化: 1x1数组+三次np.dot->一次bisect+一次乘加
+        """
+        # 旧的模型文件没有compiled；matrices被重新训练替换后需要重新编译
+        compiled = self.__dict__.get('compiled')
+        if compiled is None or compiled.matrices is not self.matrices:
+            if self.hl_nums != 1:
+                return self.predict(input_key)
+            self.compile()
+            compiled = self.compiled
+        y = compiled.predict(normalize_input_minmax(input_key, self.input_min, self.input_max))
+        return denormalize_output_minmax(y, self.output_min, self.output_max)
+
+    def __getstate__(self):
+        # compiled可以由matrices重建，不写入模型文件
+        state = self.__dict__.copy()
+        state.pop('compiled', None)
+        return state
+
     def get_weight(self, input_key):
         """
         calculate weight
@@ -671,12 +805,64 @@ class AbstractNN:
             self.max_err = 0
 
 
+class AbstractSpline:
+    """
+    误差有界的分段线性样条模型，可代替叶节点的AbstractNN
+    输入输出的归一化、min_err/max_err的含义和AbstractNN一致，err为拟合时key的误差上限，用于重新拟合
+    """
+
+    def __init__(self, spline, input_min, input_max, output_min, output_max, min_err, max_err, err):
+        self.spline = spline
+        self.input_min = input_min
+        self.input_max = input_max
+        self.output_min = output_min
+        self.output_max = output_max
+        self.min_err = min_err
+        self.max_err = max_err
+        self.err = err
+
+    def predict(self, input_key):
+        y = self.spline.predict(normalize_input_minmax(input_key, self.input_min, self.input_max))
+        return denormalize_output_minmax(y, self.output_min, self.output_max)
+
+    def compile(self):
+        """
+        样条本身就是分段线性函数，不需要编译
+        """
+        return
+
+    def predict_fast(self, input_key):
+        return self.predict(input_key)
+
+    def get_weight(self, input_key):
+        """
+        calculate weight: 样条在input_key所在段的斜率
+        """
+        return self.spline.get_slope(normalize_input_minmax(input_key, self.input_min, self.input_max))
+
+    def update_error_range(self, xs):
+        xs_len = len(xs)
+        self.output_max = xs_len - 1
+        if xs_len:
+            # 样条的predicts是np.interp，不需要采样，用所有的点计算准确的误差
+            xs = np.asarray(xs)
+            ys = np.arange(xs_len)
+            pres = self.spline.predicts(normalize_input_minmax(xs, self.input_min, self.input_max))
+            errs = denormalize_outputs_minmax(pres, ys.min(), ys.max()) - ys
+            self.min_err = math.floor(errs.min())
+            self.max_err = math.ceil(errs.max())
+        else:
+            self.min_err = 0
+            self.max_err = 0
+
+
 class Array:
     """
     模拟python数组：
     1. 初始化：1个Page
     2. 扩容：每次扩容增大原来的1/8
     3. 插入：检查是否需要扩容，右移插入点后的所有数据，返回移动的数据数量
+    4. 删除：左移删除点后的所有数据，返回移动的数据数量
     """
 
     def __init__(self, size=ITEMS_PER_PAGE, max_key=-1, index=None):
@@ -699,6 +885,13 @@ class Array:
         self.index[key] = value
         return self.max_key - key + 1
 
+    def delete(self, key):
+        for i in range(key, self.max_key):
+            self.index[i] = self.index[i + 1]
+        self.index[self.max_key] = (0, 0, 0, 0, 0)
+        self.max_key -= 1
+        return self.max_key - key + 1
+
 
 def main():
     os.chdir(os.path.dirname(os.path.realpath(__file__)))
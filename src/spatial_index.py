@@ -1,9 +1,28 @@
+import numpy as np
+
+
 class SpatialIndex:
     """
     空间索引基础类
     """
     def __init__(self, name):
         self.name = name
+        # 页缓冲池(src.buffer_pool.BufferPool)，设置后查询访问的页按缓冲池统计hit/miss，io_cost仍按公式统计
+        self.buffer_pool = None
+
+    def read_pages(self, file, first_page, last_page):
+        """
+        访问file中第[first_page, last_page]页，没有设置缓冲池时忽略
+        """
+        if self.buffer_pool is not None:
+            self.buffer_pool.read(file, first_page, last_page)
+
+    def read_items(self, file, start, end, items_per_page):
+        """
+        访问file中第[start, end)项所在的页，没有设置缓冲池时忽略
+        """
+        if self.buffer_pool is not None:
+            self.buffer_pool.read_items(file, start, end, items_per_page)
 
     def insert_single(self, point):
         return
@@ -34,6 +53,21 @@ class SpatialIndex:
     def range_query(self, windows):
         return [self.range_query_single(window) for window in windows]
 
+    def range_count(self, window):
+        """
+        count keys by x1/y1/x2/y2 window
+        """
+        return len(self.range_query_single(window))
+
+    def range_query_iter(self, window, chunk_size=65536):
+        """
+        query key by x1/y1/x2/y2 window, yield key arrays of at most chunk_size keys
+        默认实现对range_query_single的结果分块，索引可以覆盖为不物化整个结果的流式实现
+        """
+        result = self.range_query_single(window)
+        for i in range(0, len(result), chunk_size):
+            yield np.array(result[i:i + chunk_size])
+
     def test_range_query(self, windows):
         for window in windows:
             self.range_query_single(window)
@@ -0,0 +1,162 @@
+import atexit
+import multiprocessing
+import queue
+import traceback
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+
+class TrainPool:
+    """
+    可复用的模型训练进程池，替代每次训练都新建的multiprocessing.Pool + Manager().dict
+    1. 进程在第一次map时启动，之后的build/update/retrain复用
+    2. 每次map把有序的inputs（和labels）通过shared_memory发布一次，任务只传(offset, length)
+    3. 训练结果通过结果队列返回，带上map_id，丢弃之前的map遗留的结果
+    4. 任务失败时等待本次map的所有结果返回后再抛出，worker异常退出时终止整个池，下次map重新启动
+    """
+
+    def __init__(self, processes, timeout=1.0):
+        """
+        :param timeout: 等待结果时检查worker是否存活的间隔，单位秒
+        """
+        self.processes = processes
+        self.timeout = timeout
+        self.task_queue = None
+        self.result_queue = None
+        self.workers = []
+        self.map_id = 0
+
+    def start(self):
+        if self.workers:
+            return
+        # worker和发布方共用同一个resource_tracker，共享内存只由发布方登记和unlink
+        resource_tracker.ensure_running()
+        self.task_queue = multiprocessing.Queue()
+        self.result_queue = multiprocessing.Queue()
+        self.workers = [multiprocessing.Process(target=train_worker, args=(self.task_queue, self.result_queue),
+                                                daemon=True)
+                        for i in range(self.processes)]
+        for worker in self.workers:
+            worker.start()
+
+    def map(self, func, inputs, labels, tasks):
+        """
+        inputs/labels: 一维ndarray，labels为None时func收到的labels也为None
+        tasks: [(key, offset, length, args)]，func(inputs[offset:offset + length], labels[...], *args)
+        return: {key: func的返回值}
+        """
+        if not tasks:
+            return {}
+        self.start()
+        shms = [publish_array(inputs)]
+        if labels is not None:
+            shms.append(publish_array(labels))
+        self.map_id += 1
+        try:
+            shm_infos = [(shm.name, array.dtype.str, len(array)) for shm, array in zip(shms, (inputs, labels))]
+            for key, offset, length, args in tasks:
+                self.task_queue.put((self.map_id, func, shm_infos, key, offset, length, args))
+            results = {}
+            errors = []
+            # 收齐本次map的所有结果后再抛出异常，之后才能释放共享内存
+            while len(results) + len(errors) < len(tasks):
+                try:
+                    map_id, key, result, error = self.result_queue.get(timeout=self.timeout)
+                except queue.Empty:
+                    if all(worker.is_alive() for worker in self.workers):
+                        continue
+                    self.terminate()
+                    raise RuntimeError("train worker exited unexpectedly, %s of %s tasks finished" %
+                                       (len(results) + len(errors), len(tasks)))
+                if map_id != self.map_id:
+                    continue
+                if error:
+                    errors.append((key, error))
+                else:
+                    results[key] = result
+            if errors:
+                raise RuntimeError("train task %s failed in worker:\n%s" % errors[0])
+            return results
+        finally:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+
+    def close(self):
+        for i in range(len(self.workers)):
+            self.task_queue.put(None)
+        for worker in self.workers:
+            worker.join(self.timeout)
+        self.terminate()
+
+    def terminate(self):
+        """
+        终止所有worker并丢弃队列中未完成的任务和结果
+        """
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+        self.workers = []
+        self.task_queue = None
+        self.result_queue = None
+
+
+train_pools = {}
+
+
+@atexit.register
+def close_train_pools():
+    for train_pool in train_pools.values():
+        train_pool.close()
+    train_pools.clear()
+
+
+def get_train_pool(processes):
+    """
+    按进程数复用TrainPool
+    """
+    if processes not in train_pools:
+        train_pools[processes] = TrainPool(processes)
+    return train_pools[processes]
+
+
+def publish_array(array):
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+    return shm
+
+
+def train_worker(task_queue, result_queue):
+    attached = {}
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        map_id, func, shm_infos, key, offset, length, args = task
+        arrays = None
+        try:
+            if set(attached) != set(info[0] for info in shm_infos):
+                # 新发布的数组到达时，释放旧的映射
+                attached = attach_arrays(attached, shm_infos)
+            arrays = [attached[info[0]][1][offset:offset + length] for info in shm_infos]
+            if len(arrays) == 1:
+                arrays.append(None)
+            result = func(arrays[0], arrays[1], *args)
+            result_queue.put((map_id, key, result, None))
+        except Exception:
+            result_queue.put((map_id, key, None, traceback.format_exc()))
+    attach_arrays(attached, [])
+
+
+def attach_arrays(attached, shm_infos):
+    for name in list(attached):
+        shm, array = attached.pop(name)
+        del array
+        shm.close()
+    for name, dtype, size in shm_infos:
+        # 共用resource_tracker时attach的重复登记不生效，worker不能unregister，否则发布方unlink时会找不到登记
+        shm = shared_memory.SharedMemory(name=name)
+        attached[name] = (shm, np.ndarray((size,), dtype=np.dtype(dtype), buffer=shm.buf))
+    return attached
@@ -1,6 +1,7 @@
 import math
+from bisect import bisect_right
 from collections import deque
-from itertools import chain
+from itertools import chain, islice
 from reprlib import repr
 from sys import getsizeof, stderr
 
@@ -440,6 +441,35 @@ def biased_search_almost(nums, field, x, mid, left, right):
     return [right] if nums[left][field] - x > x - nums[right][field] else [left]
 
 
+def searchsorted_duplicate(nums, x, left, right):
+    """
+    二分查找 + 有序数组 + 允许重复
+    nums为有序的一维ndarray，如index entries的geohash列，返回[left, right]内等于x的key范围[l, r)
+    优化: biased_search_duplicate逐个对象取值->np.searchsorted
+    """
+    nums = nums[left:right + 1]
+    return left + int(np.searchsorted(nums, x, side='left')), left + int(np.searchsorted(nums, x, side='right'))
+
+
+def searchsorted_almost(nums, x, left, right):
+    """
+    二分查找 + 有序数组 + 允许重复 + 找不到时取最接近的
+    和biased_search_almost一致：找不到x时返回[left, right]内最接近x的key，结果为key范围[l, r)
+    """
+    nums = nums[left:right + 1]
+    l = int(np.searchsorted(nums, x, side='left'))
+    r = int(np.searchsorted(nums, x, side='right'))
+    if l < r:
+        return left + l, left + r
+    if l == 0:
+        key = left
+    elif l == len(nums):
+        key = right
+    else:
+        key = left + l - 1 if nums[l] - x > x - nums[l - 1] else left + l
+    return key, key + 1
+
+
 def interpolation_search_less_max(nums, field, x, left, right):
     """
     插入查找 + 对象
@@ -533,6 +563,148 @@ def relu(x):
     return np.maximum(0, x)
 
 
+class PiecewiseLinearNN:
+    """
+    单隐藏层relu网络y=relu(x*w0+b0)*w1+b1的分段线性形式
+    隐藏层的断点-b0/w0把x轴分成若干段，段内网络为线性函数y=k*x+c，predict只需一次bisect和一次乘加
+    matrices为[w0, b0, w1, b1]，保留引用用于判断matrices是否被替换
+    """
+
+    def __init__(self, matrices):
+        self.matrices = matrices
+        w0, b0, w1, b1 = [np.asarray(m, dtype=np.float64).flatten() for m in matrices]
+        ks = w0 * w1
+        cs = b0 * w1
+        # w0=0的单元是常数relu(b0)*w1
+        is_const = w0 == 0
+        c = b1[0] + (relu(b0[is_const]) * w1[is_const]).sum()
+        w0, b0, ks, cs = w0[~is_const], b0[~is_const], ks[~is_const], cs[~is_const]
+        bks = -b0 / w0
+        order = np.argsort(bks, kind='stable')
+        # x趋于-inf时w0<0的单元激活，x从左往右越过断点时w0>0的单元激活，w0<0的单元失活
+        is_neg = w0 < 0
+        signs = np.where(is_neg, -1.0, 1.0)[order]
+        k_start = ks[is_neg].sum()
+        c_start = c + cs[is_neg].sum()
+        self.bks = bks[order].tolist()
+        self.ks = np.concatenate(([k_start], k_start + np.cumsum(signs * ks[order]))).tolist()
+        self.cs = np.concatenate(([c_start], c_start + np.cumsum(signs * cs[order]))).tolist()
+
+    def predict(self, x):
+        i = bisect_right(self.bks, x)
+        return self.ks[i] * x + self.cs[i]
+
+
+class ErrorBoundedSpline:
+    """
+    误差有界的分段线性样条（RadixSpline的GreedySplineCorridor）
+    对有序的xs单次遍历选出knots，使每个xs[i]在相邻knots间线性插值的结果与ys[i]的误差不超过err
+    超出knots范围的x取两端knot的值
+    """
+
+    def __init__(self, knots_x, knots_y):
+        self.knots_x = knots_x
+        self.knots_y = knots_y
+        self.slopes = [(knots_y[i + 1] - knots_y[i]) / (knots_x[i + 1] - knots_x[i])
+                       for i in range(len(knots_x) - 1)]
+
+    @staticmethod
+    def fit(xs, ys, err):
+        """
+        xs有重复时只用第一个，即预测重复值的最左位置
+        """
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        if len(xs) == 0:
+            return ErrorBoundedSpline([0.0], [0.0])
+        xs, first_keys = np.unique(xs, return_index=True)
+        ys = ys[first_keys]
+        # 优化: 上一段超过64个点时，这一段大概率也较长，用search_corridor在numpy上找到超出走廊的点，跳过逐点遍历
+        # 浮点运算和逐点遍历一致，所以knots完全相同；短的段numpy的固定开销更大，仍然逐点遍历
+        n = len(xs)
+        xs_list, ys_list = xs.tolist(), ys.tolist()
+        knot_keys = [0]
+        knot, knot_x, knot_y = 0, xs_list[0], ys_list[0]
+        pre_x, pre_y = knot_x, knot_y
+        upper, lower = math.inf, -math.inf
+        points = zip(range(1, n), xs_list[1:], ys_list[1:])
+        for i, x, y in points:
+            dx = x - knot_x
+            dy = y - knot_y
+            if not lower <= dy / dx <= upper:
+                # 超出走廊，上一个点作为knot，以它为起点重新计算走廊
+                seg_len = i - 1 - knot
+                knot, knot_x, knot_y = i - 1, pre_x, pre_y
+                knot_keys.append(knot)
+                out_key = None
+                while seg_len > 64:
+                    out_key = ErrorBoundedSpline.search_corridor(xs, ys, knot, err, 2 * seg_len)
+                    if out_key == n:
+                        break
+                    i, x, y = next(islice(points, out_key - i - 1, None))
+                    seg_len = i - 1 - knot
+                    knot, knot_x, knot_y = i - 1, xs_list[i - 1], ys_list[i - 1]
+                    knot_keys.append(knot)
+                if out_key == n:
+                    break
+                dx = x - knot_x
+                dy = y - knot_y
+                upper, lower = math.inf, -math.inf
+            cur_upper = (dy + err) / dx
+            cur_lower = (dy - err) / dx
+            if cur_upper < upper:
+                upper = cur_upper
+            if cur_lower > lower:
+                lower = cur_lower
+            pre_x, pre_y = x, y
+        if knot_keys[-1] != n - 1:
+            knot_keys.append(n - 1)
+        knots_x = xs[knot_keys].tolist()
+        knots_y = ys[knot_keys].tolist()
+        return ErrorBoundedSpline(knots_x, knots_y)
+
+    @staticmethod
+    def search_corridor(xs, ys, knot, err, window):
+        """
+        从knot出发，在窗口上用累积min/max一次算出每个点之前的走廊，窗口内都在走廊中时扩大窗口
+        :return: 第一个超出走廊的点，都在走廊中时为len(xs)
+        """
+        n = len(xs)
+        while True:
+            end = min(knot + 1 + window, n)
+            dx = xs[knot + 1:end] - xs[knot]
+            dy = ys[knot + 1:end] - ys[knot]
+            slopes = dy / dx
+            uppers = np.minimum.accumulate((dy + err) / dx)
+            lowers = np.maximum.accumulate((dy - err) / dx)
+            outs = np.flatnonzero((slopes[1:] < lowers[:-1]) | (slopes[1:] > uppers[:-1]))
+            if len(outs):
+                return knot + 2 + int(outs[0])
+            if end == n:
+                return n
+            window *= 4
+
+    def predict(self, x):
+        i = bisect_right(self.knots_x, x)
+        if i == 0:
+            return self.knots_y[0]
+        if i == len(self.knots_x):
+            return self.knots_y[-1]
+        return self.knots_y[i - 1] + self.slopes[i - 1] * (x - self.knots_x[i - 1])
+
+    def predicts(self, xs):
+        return np.interp(xs, self.knots_x, self.knots_y)
+
+    def get_slope(self, x):
+        """
+        x所在段的斜率，超出knots范围时为0
+        """
+        i = bisect_right(self.knots_x, x)
+        if i == 0 or i == len(self.knots_x):
+            return 0.0
+        return self.slopes[i - 1]
+
+
 def elu(x, alpha=1):
     a = x[x > 0]
     b = alpha * (np.exp(x[x < 0]) - 1)
@@ -577,6 +749,52 @@ def merge_sorted_list(lst1, lst2):
         max_key1 += 1
 
 
+def merge_sorted_array(arr1, arr2):
+    """
+    合并两个按geohash有序的index entries数组，返回新数组
+    优化: merge_sorted_list逐个binary search和list.insert->np.searchsorted和np.insert
+    """
+    return np.insert(arr1, np.searchsorted(arr1['2'], arr2['2'], side='right'), arr2)
+
+
+def pack_bits(columns, widths, items_per_page, page_size):
+    """
+    把多列非负整数按位宽紧凑打包为定长页，每页items_per_page项，项内按columns的顺序、低位在前
+    :param columns: 等长的非负整数ndarray的list
+    :param widths: 每列的位数，sum(widths) * items_per_page不超过page_size * 8
+    :return: shape为(页数量, page_size)的uint8数组
+    """
+    num = len(columns[0])
+    page_num = math.ceil(num / items_per_page)
+    bits = np.zeros((page_num * items_per_page, sum(widths)), dtype=np.uint8)
+    offset = 0
+    for column, width in zip(columns, widths):
+        column = np.asarray(column, dtype=np.uint64)
+        bits[:num, offset:offset + width] = column[:, None] >> np.arange(width, dtype=np.uint64) & np.uint64(1)
+        offset += width
+    pages = np.zeros((page_num, page_size), dtype=np.uint8)
+    packed = np.packbits(bits.reshape(page_num, -1), axis=1, bitorder='little')
+    pages[:, :packed.shape[1]] = packed
+    return pages
+
+
+def unpack_bits(pages, widths, items_per_page, num):
+    """
+    pack_bits的逆过程，返回前num项的每列，每列为int64的ndarray
+    """
+    entry_bits = sum(widths)
+    bits = np.unpackbits(pages, axis=1, count=items_per_page * entry_bits, bitorder='little')
+    bits = bits.reshape(-1, entry_bits)[:num]
+    columns = []
+    offset = 0
+    for width in widths:
+        weights = np.uint64(1) << np.arange(width, dtype=np.uint64)
+        columns.append((bits[:, offset:offset + width].astype(np.uint64) * weights).sum(axis=1, dtype=np.uint64)
+                       .astype(np.int64))
+        offset += width
+    return columns
+
+
 def plot_ts(ts):
     ts_len = len(ts)
     col = 5
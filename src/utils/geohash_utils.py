@@ -1,12 +1,23 @@
 import time
 from math import log10
 
+import numpy as np
 import pandas as pd
 
 from src.utils.common_utils import Point, Region
 
 
 class Geohash:
+    """
+    z-order空间填充曲线，也是其他曲线的基类：曲线按四叉树逐层把每个格子的2位写入编码，每个四叉树节点是连续的编码范围
+    曲线之间只有子节点的顺序不同，由children描述，索引的分区/递归四分只依赖children，不依赖具体的曲线
+    """
+    # children[state][i] = (第i个子节点的象限, 子节点的状态)，象限=纬度位 << 1 | 经度位，和Region.split()的顺序一致
+    # z-order每个节点的子节点都是左下、右下、左上、右上，只有一个状态
+    children = (((0, 0), (1, 0), (2, 0), (3, 0)),)
+    # 曲线在经度和纬度上都单调时，window和节点交集的编码范围由交集的左下角和右上角确定
+    monotone = True
+
     def __init__(self, sum_bits=0, region=Region(-90, 90, -180, 180), data_precision=0):
         self.name = "Geohash"
         self.dimensions = 2
@@ -19,10 +30,66 @@ class Geohash:
         self.region_width = region.right - region.left
         self.region_height = region.up - region.bottom
 
-    @staticmethod
-    def init_by_precision(data_precision, region):
+    @classmethod
+    def init_by_precision(cls, data_precision, region):
         sum_bits = region.get_bits_by_region_and_precision(data_precision) * 2
-        return Geohash(sum_bits, region, data_precision)
+        return cls(sum_bits, region, data_precision)
+
+    def node_state(self, value, length):
+        """
+        长度为length的节点value在children中的状态，z-order只有一个状态
+        """
+        return 0
+
+    def child_quadrants(self, value, length):
+        """
+        节点value的4个子节点按编码顺序对应的象限，用于把Region.split()的子region分给子节点
+        """
+        return [quadrant for quadrant, state in self.children[self.node_state(value, length)]]
+
+    def encode_window(self, window):
+        """
+        计算window=[y1, y2, x1, x2]内的最小和最大geohash_int，即window覆盖的编码范围
+        z-order在经度和纬度上都单调，因此为左下角和右上角的geohash_int
+        """
+        return self.encode(window[2], window[0]), self.encode(window[3], window[1])
+
+    def ranges_by_window(self, window, length=None):
+        """
+        把window=[y1, y2, x1, x2]分解为编码上的连续范围[[geohash_int1, geohash_int2], ...]，按编码有序且相邻的范围已合并
+        1. 从根节点按children递归四分，节点和window不相交时跳过，被window包含时整体作为一个范围
+        2. 节点长度达到length时不再四分，整体作为一个范围，length越小范围越少，但会包含window外的格子
+        """
+        max_length = self.sum_bits if length is None else length
+        x1 = min(max(round((window[2] - self.region.left) * self.max_num / self.region_width), 0), self.max_num - 1)
+        x2 = min(max(round((window[3] - self.region.left) * self.max_num / self.region_width), 0), self.max_num - 1)
+        y1 = min(max(round((window[0] - self.region.bottom) * self.max_num / self.region_height), 0), self.max_num - 1)
+        y2 = min(max(round((window[1] - self.region.bottom) * self.max_num / self.region_height), 0), self.max_num - 1)
+        result = []
+        # (节点的geohash_int, 节点的长度, 节点左下角的经度格子, 纬度格子, 节点的状态)
+        stack = [(0, 0, 0, 0, 0)]
+        while stack:
+            value, length, left, bottom, state = stack.pop()
+            size = 1 << self.dim_bits - length // 2
+            right = left + size - 1
+            up = bottom + size - 1
+            if left > x2 or x1 > right or bottom > y2 or y1 > up:
+                continue
+            if length >= max_length or x1 <= left and right <= x2 and y1 <= bottom and up <= y2:
+                last = value + (1 << self.sum_bits - length) - 1
+                if result and result[-1][1] + 1 == value:
+                    result[-1][1] = last
+                else:
+                    result.append([value, last])
+                continue
+            half = size >> 1
+            child_bits = self.sum_bits - length - 2
+            children = self.children[state]
+            for i in (3, 2, 1, 0):
+                quadrant, child_state = children[i]
+                stack.append((value + (i << child_bits), length + 2, left + (quadrant & 1) * half,
+                              bottom + (quadrant >> 1) * half, child_state))
+        return result
 
     def encode(self, lng, lat):
         """
@@ -48,27 +115,41 @@ class Geohash:
         lat = lat_zoom * self.region_height / self.max_num + self.region.bottom
         return round(lng, self.data_precision), round(lat, self.data_precision)
 
+    def encode_batch(self, lngs, lats):
+        """
+        批量计算points的geohash_int，结果与逐点encode一致
+        1. 经纬度数组整体归一化并缩放，np.rint和round一样是四舍六入五成双
+        2. 使用merge_bits_batch按位交错合并
+        优化: 逐点encode->encode_batch:字符串格式化和int(str, 2)变为整数组的位运算
+        """
+        lngs_zoom = np.rint((np.asarray(lngs, dtype=np.float64) - self.region.left) * self.max_num / self.region_width)
+        lats_zoom = np.rint((np.asarray(lats, dtype=np.float64) - self.region.bottom) * self.max_num / self.region_height)
+        return self.merge_bits_batch(lngs_zoom.astype(np.uint64), lats_zoom.astype(np.uint64))
+
+    def decode_batch(self, geohash_ints):
+        """
+        批量计算geohash_ints的points，结果与逐点decode一致
+        """
+        lngs_zoom, lats_zoom = self.split_bits_batch(geohash_ints)
+        lngs = lngs_zoom * self.region_width / self.max_num + self.region.left
+        lats = lats_zoom * self.region_height / self.max_num + self.region.bottom
+        return np.round(lngs, self.data_precision), np.round(lats, self.data_precision)
+
+    def merge_bits_batch(self, ints1, ints2):
+        """
+        批量合并整数的经纬度，int1放偶数位，int2放奇数位，和merge_bits的结果一致
+        """
+        return (spread_bits(ints1) | spread_bits(ints2) << np.uint64(1)).astype(np.int64)
+
+    def split_bits_batch(self, geohash_ints):
+        geohash_ints = np.asarray(geohash_ints, dtype=np.int64).astype(np.uint64)
+        return compact_bits(geohash_ints).astype(np.int64), compact_bits(geohash_ints >> np.uint64(1)).astype(np.int64)
+
     def merge_bits(self, int1, int2):
         self.geohash_template[1::2] = bin(int1)[2:].rjust(self.dim_bits, '0')
         self.geohash_template[0::2] = bin(int2)[2:].rjust(self.dim_bits, '0')
         return int(''.join(self.geohash_template), 2)
 
-    def batch_merge_bits(self, int_range1, int_range2, diff_dim_bits, range_size):
-        """
-        优化: merge_bits需要range_size次单维度geohash计算，batch后只需要宽*高次单维度geohash计算
-        """
-        result = [None] * range_size
-        i = 0
-        geohash_list1 = [bin(int1 << diff_dim_bits)[2:].rjust(self.dim_bits, '0') for int1 in int_range1]
-        geohash_list2 = [bin(int2 << diff_dim_bits)[2:].rjust(self.dim_bits, '0') for int2 in int_range2]
-        for geohash2 in geohash_list2:
-            self.geohash_template[0::2] = geohash2
-            for geohash1 in geohash_list1:
-                self.geohash_template[1::2] = geohash1
-                result[i] = [int(''.join(self.geohash_template), 2), 0]
-                i += 1
-        return result
-
     @staticmethod
     def merge_bits_by_length(result, int1, int2, length):
         result[1::2] = bin(int1)[2:].rjust(length, '0')
@@ -101,44 +182,6 @@ class Geohash:
     def int_to_geohash(geohash_int: int, length1, length2: int) -> str:
         return bin(geohash_int >> length2 - length1)[2:]
 
-    def ranges_by_int(self, geohash_int1: int, geohash_int2: int, length: int) -> (list, int, int):
-        diff_bits = self.sum_bits - length
-        diff_dim_bits = self.dim_bits - length // 2
-        geohash1 = bin(geohash_int1 >> diff_bits)[2:].rjust(length, '0')
-        geohash2 = bin(geohash_int2 >> diff_bits)[2:].rjust(length, '0')
-        lng_int1 = int(geohash1[1::2], 2)
-        lat_int1 = int(geohash1[0::2], 2)
-        lng_int2 = int(geohash2[1::2], 2) + 1
-        lat_int2 = int(geohash2[0::2], 2) + 1
-        lng_length = lng_int2 - lng_int1
-        lat_length = lat_int2 - lat_int1
-        result = self.batch_merge_bits(range(lng_int1, lng_int2), range(lat_int1, lat_int2), diff_dim_bits,
-                                       lng_length * lat_length)
-        # 优化：只计算边界点的grid_num，77mil=>6.7mil
-        for j in range(lat_length):
-            result[j * lng_length][1] += 2
-            result[j * lng_length + lng_length - 1][1] += 1
-        for i in range(lng_length):
-            result[i][1] += 8
-            result[-i - 1][1] += 4
-        return sorted(result)
-        # return sorted([[int(merge_bits_result(bits_result, i, j, child_length), 2),
-        #                 grid_num(i, j, lat_int2, lat_int1, lng_int2, lng_int1)]
-        #                for j in range(lat_int1, lat_int2)
-        #                for i in range(lng_int1, lng_int2)])
-
-    @staticmethod
-    def groupby_and_max(geohash_list: list) -> dict:
-        result = {}
-        for i in geohash_list:
-            # 优化: 4.55mil->2.93mil
-            result[i[0]] = result.get(i[0], 0) | i[1]
-            # if i[0] not in result.keys():
-            #     result[i[0]] = i[1]
-            # else:
-            #     result[i[0]] |= i[1]
-        return result
-
     @staticmethod
     def grid_num(i, j, lat_int2, lat_int1, lng_int2, lng_int1):
         """
@@ -163,6 +206,161 @@ class Geohash:
         return geohash1.startswith(geohash2) if len(geohash1) >= len(geohash2) else geohash2.startswith(geohash1)
 
 
+def spread_bits(ints):
+    """
+    把uint64数组的低32位分散到偶数位上：...b2b1b0 => ...0b20b10b0
+    原理：magic number逐级对半拆分，位移+掩码共5轮
+    """
+    ints = ints & np.uint64(0x00000000FFFFFFFF)
+    ints = (ints | ints << np.uint64(16)) & np.uint64(0x0000FFFF0000FFFF)
+    ints = (ints | ints << np.uint64(8)) & np.uint64(0x00FF00FF00FF00FF)
+    ints = (ints | ints << np.uint64(4)) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    ints = (ints | ints << np.uint64(2)) & np.uint64(0x3333333333333333)
+    return (ints | ints << np.uint64(1)) & np.uint64(0x5555555555555555)
+
+
+def compact_bits(ints):
+    """
+    spread_bits的逆运算：把uint64数组偶数位上的bit收拢到低32位
+    """
+    ints = ints & np.uint64(0x5555555555555555)
+    ints = (ints | ints >> np.uint64(1)) & np.uint64(0x3333333333333333)
+    ints = (ints | ints >> np.uint64(2)) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    ints = (ints | ints >> np.uint64(4)) & np.uint64(0x00FF00FF00FF00FF)
+    ints = (ints | ints >> np.uint64(8)) & np.uint64(0x0000FFFF0000FFFF)
+    return (ints | ints >> np.uint64(16)) & np.uint64(0x00000000FFFFFFFF)
+
+
+class Hilbert(Geohash):
+    """
+    Hilbert曲线：编码相邻的格子在空间上也相邻，没有z-order在象限之间的跳跃，window覆盖的编码范围更少
+    1. 节点的状态为子格子相对于z-order的变换：0=不变，1=沿主对角线翻转，2=沿副对角线翻转，3=旋转180度
+    2. 逐层按状态表查出格子的编码位和子节点的状态，和geohash一样每层写入2位
+    """
+    # digits[state][象限] = (子节点的编码位, 子节点的状态)，children为其逆映射
+    digits = (((0, 1), (3, 2), (1, 0), (2, 0)),
+              ((0, 0), (1, 1), (3, 3), (2, 1)),
+              ((2, 2), (3, 0), (1, 2), (0, 3)),
+              ((2, 3), (1, 3), (3, 1), (0, 2)))
+    monotone = False
+    children = (((0, 1), (2, 0), (3, 0), (1, 2)),
+                ((0, 0), (1, 1), (3, 1), (2, 3)),
+                ((3, 3), (2, 2), (0, 2), (1, 0)),
+                ((3, 2), (1, 3), (0, 3), (2, 1)))
+    digit_table = np.array([[digit for digit, state in row] for row in digits], dtype=np.uint64)
+    digit_state_table = np.array([[state for digit, state in row] for row in digits], dtype=np.int64)
+    quadrant_table = np.array([[quadrant for quadrant, state in row] for row in children], dtype=np.uint64)
+    quadrant_state_table = np.array([[state for quadrant, state in row] for row in children], dtype=np.int64)
+
+    def __init__(self, sum_bits=0, region=Region(-90, 90, -180, 180), data_precision=0):
+        super().__init__(sum_bits, region, data_precision)
+        self.name = "Hilbert"
+
+    def node_state(self, value, length):
+        state = 0
+        for shift in range(self.sum_bits - 2, self.sum_bits - length - 1, -2):
+            state = self.children[state][value >> shift & 3][1]
+        return state
+
+    def encode_window(self, window):
+        """
+        Hilbert在经度和纬度上不单调，编码范围的端点不是window的角
+        1. window两个角的格子的公共祖先节点以上，最小和最大编码的前缀相同，和encode一样逐层查表
+        2. 从公共祖先节点分别沿编码最小和最大的、和window相交的子节点下降，节点被window包含时直接取节点的首尾编码
+        """
+        x1 = min(max(round((window[2] - self.region.left) * self.max_num / self.region_width), 0), self.max_num - 1)
+        x2 = min(max(round((window[3] - self.region.left) * self.max_num / self.region_width), 0), self.max_num - 1)
+        y1 = min(max(round((window[0] - self.region.bottom) * self.max_num / self.region_height), 0), self.max_num - 1)
+        y2 = min(max(round((window[1] - self.region.bottom) * self.max_num / self.region_height), 0), self.max_num - 1)
+        # 1. 公共祖先节点的编码和状态
+        dim_shift = max((x1 ^ x2).bit_length(), (y1 ^ y2).bit_length())
+        digits = self.digits
+        prefix = prefix_state = 0
+        for shift in range(self.dim_bits - 1, dim_shift - 1, -1):
+            digit, prefix_state = digits[prefix_state][(y1 >> shift & 1) << 1 | x1 >> shift & 1]
+            prefix = prefix << 2 | digit
+        # 2. 分别下降到编码最小和最大的格子
+        result = []
+        for order in ((0, 1, 2, 3), (3, 2, 1, 0)):
+            value, state = prefix, prefix_state
+            left = x1 >> dim_shift << dim_shift
+            bottom = y1 >> dim_shift << dim_shift
+            shift = dim_shift
+            while shift:
+                size = 1 << shift
+                if x1 <= left and left + size <= x2 + 1 and y1 <= bottom and bottom + size <= y2 + 1:
+                    value = value << 2 * shift | (0 if order[0] == 0 else size * size - 1)
+                    break
+                shift -= 1
+                half = size >> 1
+                # 子节点和window相交时，编码最小/最大的子节点即沿order第一个相交的子节点
+                x_half = x2 >= left + half
+                x_low = x1 < left + half
+                y_half = y2 >= bottom + half
+                y_low = y1 < bottom + half
+                children = self.children[state]
+                for i in order:
+                    quadrant, child_state = children[i]
+                    if (x_half if quadrant & 1 else x_low) and (y_half if quadrant >> 1 else y_low):
+                        break
+                value = value << 2 | i
+                left += (quadrant & 1) * half
+                bottom += (quadrant >> 1) * half
+                state = child_state
+            result.append(value)
+        return result[0], result[1]
+
+    def merge_bits(self, int1, int2):
+        result = state = 0
+        for shift in range(self.dim_bits - 1, -1, -1):
+            digit, state = self.digits[state][(int2 >> shift & 1) << 1 | int1 >> shift & 1]
+            result = result << 2 | digit
+        return result
+
+    def split_bits(self, geohash_int):
+        int1 = int2 = state = 0
+        for shift in range(self.sum_bits - 2, -1, -2):
+            quadrant, state = self.children[state][geohash_int >> shift & 3]
+            int1 = int1 << 1 | quadrant & 1
+            int2 = int2 << 1 | quadrant >> 1
+        return int1, int2
+
+    def merge_bits_batch(self, ints1, ints2):
+        """
+        每层一次numpy查表，共dim_bits轮
+        """
+        ints1 = np.asarray(ints1, dtype=np.uint64)
+        ints2 = np.asarray(ints2, dtype=np.uint64)
+        result = np.zeros(ints1.shape, dtype=np.uint64)
+        states = np.zeros(ints1.shape, dtype=np.int64)
+        for shift in range(self.dim_bits - 1, -1, -1):
+            shift = np.uint64(shift)
+            quadrants = ((ints2 >> shift & np.uint64(1)) << np.uint64(1) | ints1 >> shift & np.uint64(1)).astype(np.int64)
+            result = result << np.uint64(2) | self.digit_table[states, quadrants]
+            states = self.digit_state_table[states, quadrants]
+        return result.astype(np.int64)
+
+    def split_bits_batch(self, geohash_ints):
+        geohash_ints = np.asarray(geohash_ints, dtype=np.int64).astype(np.uint64)
+        ints1 = np.zeros(geohash_ints.shape, dtype=np.uint64)
+        ints2 = np.zeros(geohash_ints.shape, dtype=np.uint64)
+        states = np.zeros(geohash_ints.shape, dtype=np.int64)
+        for shift in range(self.sum_bits - 2, -1, -2):
+            digits = (geohash_ints >> np.uint64(shift) & np.uint64(3)).astype(np.int64)
+            quadrants = self.quadrant_table[states, digits]
+            states = self.quadrant_state_table[states, digits]
+            ints1 = ints1 << np.uint64(1) | quadrants & np.uint64(1)
+            ints2 = ints2 << np.uint64(1) | quadrants >> np.uint64(1)
+        return ints1.astype(np.int64), ints2.astype(np.int64)
+
+
+# 可选的空间填充曲线，key为曲线的name，索引的meta中按name记录构建时使用的曲线
+curves = {
+    "Geohash": Geohash,
+    "Hilbert": Hilbert,
+}
+
+
 class Geohash2:
     """
     source code from pypi: python-geohash